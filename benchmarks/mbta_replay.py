@@ -0,0 +1,96 @@
+"""
+Replay recorded MBTA-realtime responses through MBTAArrivalGenerator and time
+the request path (response parsing, trip validation and merging with the
+schedule) without any network I/O.
+
+Recordings are named like the ones in tests/data/mbta:
+    predictionsbystop_<stop id>_<query start time>.json
+    predictionsbyroute_<route id>_<query start time>.json
+
+Usage: python benchmarks/mbta_replay.py [--gtfs PATH] [--repeat N] [DIR]
+"""
+
+import busbus
+from busbus.provider.mbta import MBTAProvider
+
+import argparse
+import arrow
+import contextlib
+import os
+import responses
+import shutil
+import six
+import tempfile
+import timeit
+import zipfile
+
+
+def read_gtfs(path):
+    """Return a GTFS zip's contents, zipping it first if path is a dir."""
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    with contextlib.closing(six.BytesIO()) as data:
+        with zipfile.ZipFile(data, 'w') as z:
+            for filename in os.listdir(path):
+                z.write(os.path.join(path, filename), filename)
+        return data.getvalue()
+
+
+def recordings(path):
+    for filename in sorted(os.listdir(path)):
+        if not filename.startswith('predictionsby'):
+            continue
+        endpoint, rest = filename[:-len('.json')].split('_', 1)
+        id, start = rest.rsplit('_', 1)
+        with open(os.path.join(path, filename), 'rb') as f:
+            yield endpoint, id, start, f.read()
+
+
+def replay(provider, endpoint, id, start):
+    kwargs = {'start_time': arrow.get(start)}
+    if endpoint == 'predictionsbystop':
+        kwargs['stop'] = provider.get(busbus.Stop, id)
+    else:
+        kwargs['route'] = provider.get(busbus.Route, id)
+    return len(list(provider.arrivals.where(**kwargs)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('dir', nargs='?', default=os.path.join(
+        os.path.dirname(__file__), '..', 'tests', 'data', 'mbta'))
+    parser.add_argument('--gtfs', help='MBTA GTFS zip or directory '
+                        '(default: DIR/gtfs)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    gtfs = read_gtfs(args.gtfs or os.path.join(args.dir, 'gtfs'))
+
+    busbus_dir = tempfile.mkdtemp()
+    try:
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, MBTAProvider.gtfs_url, body=gtfs,
+                     status=200, content_type='application/zip')
+            engine = busbus.Engine({'busbus_dir': busbus_dir})
+            provider = MBTAProvider('fake API key', engine)
+
+        for endpoint, id, start, body in recordings(args.dir):
+            with responses.RequestsMock() as mock:
+                mock.add(responses.GET, provider.mbta_realtime_url + endpoint,
+                         body=body, status=200,
+                         content_type='application/json; charset=utf-8')
+                # the first run fetches (and caches) the response; the timed
+                # runs only process it
+                count = replay(provider, endpoint, id, start)
+                timer = timeit.Timer(
+                    lambda: replay(provider, endpoint, id, start))
+                best = min(timer.repeat(args.repeat, 1))
+            print('{0} {1} @ {2}: {3} arrivals, {4:.1f}ms'.format(
+                endpoint, id, start, count, best * 1000))
+    finally:
+        shutil.rmtree(busbus_dir)
+
+
+if __name__ == '__main__':
+    main()
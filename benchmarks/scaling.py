@@ -0,0 +1,180 @@
+"""
+Measure how GTFS ingest and queries scale with the size of the feed, using
+synthetic feeds (see synthetic_gtfs.py) of several sizes.
+
+For each size, the feed is ingested into a fresh in-memory database and then
+arrivals at the busiest stop and on the busiest route, stops_find and
+Route.directions are timed. The best time of --repeat runs of each is written
+as JSON (to stdout, or --output), along with the feed parameters and the
+commit, so that the results of two commits can be compared: with --baseline,
+the benchmarks that got more than --threshold times slower than in an earlier
+result file are listed and the exit status is 1.
+
+Usage: python benchmarks/scaling.py [--sizes NAME,...] [--repeat N]
+           [--output FILE] [--baseline FILE] [--threshold RATIO]
+"""
+
+from __future__ import print_function
+
+from busbus.provider import ProviderBase
+from busbus.provider.gtfs import GTFSMixin
+from busbus import web
+
+import argparse
+import arrow
+import collections
+import json
+import os
+import platform
+import responses
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_gtfs  # noqa
+
+SIZES = collections.OrderedDict((
+    ('small', {'stops': 100, 'routes': 10, 'trips_per_route': 20,
+               'frequency_trips': 2, 'exceptions': 5}),
+    ('medium', {'stops': 1000, 'routes': 50, 'trips_per_route': 40,
+                'frequency_trips': 5, 'exceptions': 20}),
+    ('large', {'stops': 5000, 'routes': 200, 'trips_per_route': 60,
+               'frequency_trips': 10, 'exceptions': 50}),
+))
+
+# a weekday morning within the synthetic feeds' calendar
+START_TIME = arrow.get('2015-06-03T07:00:00-05:00')
+
+
+class SyntheticProvider(GTFSMixin, ProviderBase):
+    gtfs_url = 'http://busbus.invalid/synthetic-gtfs.zip'
+
+    def __init__(self, engine):
+        super(SyntheticProvider, self).__init__(engine, self.gtfs_url)
+
+
+def ingest(data):
+    """Load a feed into a new engine and return the provider."""
+    busbus_dir = tempfile.mkdtemp()
+    try:
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, SyntheticProvider.gtfs_url, body=data,
+                     status=200, content_type='application/zip')
+            engine = web.Engine({'busbus_dir': busbus_dir,
+                                 'gtfs_db_path': ':memory:'})
+            return SyntheticProvider(engine)
+    finally:
+        shutil.rmtree(busbus_dir)
+
+
+def query_benchmarks(provider):
+    """Return {name: function} of the query benchmarks for a provider."""
+    stop = max(provider.stops, key=lambda s: len(list(s.routes)))
+    route = max(provider.routes, key=lambda r: len(list(r.stops)))
+    routes = list(provider.routes)
+
+    def arrivals(**kwargs):
+        return len(list(provider.arrivals.where(start_time=START_TIME,
+                                                **kwargs)))
+
+    def stops_find():
+        return len(list(provider.engine.stops_find(
+            latitude=stop.latitude, longitude=stop.longitude,
+            distance=1000)))
+
+    def directions():
+        return sum(len(list(r.directions)) for r in routes)
+
+    return collections.OrderedDict((
+        ('arrivals_by_stop', lambda: arrivals(stop=stop)),
+        ('arrivals_by_route', lambda: arrivals(route=route)),
+        ('stops_find', stops_find),
+        ('route_directions', directions),
+    ))
+
+
+def run_size(name, params, repeat):
+    data = synthetic_gtfs.generate(**params)
+    results = []
+
+    def record(benchmark, func, count):
+        best = min(timeit.Timer(func).repeat(repeat, 1))
+        results.append({'size': name, 'benchmark': benchmark,
+                        'seconds': best, 'count': count})
+        print('{0} {1}: {2:.4f}s'.format(name, benchmark, best),
+              file=sys.stderr)
+
+    # count is the zip's size for ingest, otherwise the number of results
+    record('ingest', lambda: ingest(data), len(data))
+    provider = ingest(data)
+    for benchmark, func in query_benchmarks(provider).items():
+        record(benchmark, func, func())
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, threshold):
+    """Yield (size, benchmark, ratio) for results slower than baseline."""
+    before = {(r['size'], r['benchmark']): r['seconds']
+              for r in baseline['results']}
+    for r in results['results']:
+        old = before.get((r['size'], r['benchmark']))
+        if old and r['seconds'] / old > threshold:
+            yield r['size'], r['benchmark'], r['seconds'] / old
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='small,medium',
+                        help='comma-separated, of: ' + ', '.join(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(',')
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error('unknown sizes: ' + ', '.join(unknown))
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'sizes': {name: SIZES[name] for name in sizes},
+        'results': [],
+    }
+    for name in sizes:
+        results['results'].extend(run_size(name, SIZES[name], args.repeat))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = list(regressions(results, json.load(f), args.threshold))
+        for size, benchmark, ratio in slower:
+            print('{0} {1}: {2:.2f}x slower than the baseline'.format(
+                size, benchmark, ratio), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare the two ways busbus.web can serialize a list of entities: the
+original unexpand_init() + BaseEntityJSONEncoder path and the precompiled
+per-class serializers. Both must produce the same bytes.
+
+Usage: python benchmarks/serialization.py [--arrivals N] [--repeat N]
+"""
+
+import busbus
+from busbus.entity import BaseEntityJSONEncoder, StreamingJSONEncoder
+from busbus.provider import ProviderBase
+from busbus.queryable import Queryable
+from busbus import web
+
+import argparse
+import arrow
+import timeit
+
+
+class BenchmarkProvider(ProviderBase):
+    credit = 'busbus benchmarks'
+
+    def __init__(self, engine, count):
+        super(BenchmarkProvider, self).__init__(engine)
+        agency = busbus.Agency(self, id='A', name='Agency',
+                               timezone='America/Chicago')
+        stops = [busbus.Stop(self, id='S{0}'.format(i),
+                             name=u'Stop {0}'.format(i),
+                             latitude=38.9 + i / 1000.0, longitude=-95.2)
+                 for i in range(50)]
+        routes = [busbus.Route(self, id='R{0}'.format(i), agency=agency,
+                               short_name=str(i), name=u'Route {0}'.format(i))
+                  for i in range(10)]
+        start = arrow.get('2015-05-01T12:00:00-05:00')
+        self._arrivals = [
+            busbus.Arrival(self, stop=stops[i % len(stops)],
+                           route=routes[i % len(routes)],
+                           time=start.replace(seconds=i * 30),
+                           departure_time=start.replace(seconds=i * 30 + 10),
+                           headsign=u'Downtown', bikes_ok=bool(i % 2),
+                           realtime=False)
+            for i in range(count)]
+
+    def get(self, entity, id, default=None):
+        return default
+
+    @property
+    def agencies(self):
+        return Queryable(())
+
+    @property
+    def stops(self):
+        return Queryable(())
+
+    @property
+    def routes(self):
+        return Queryable(())
+
+    @property
+    def arrivals(self):
+        return Queryable(self._arrivals)
+
+
+def unexpand_path(arrivals, to_expand):
+    return BaseEntityJSONEncoder().encode(
+        {'arrivals': web.unexpand_init(arrivals, to_expand)})
+
+
+def serializer_path(arrivals, to_expand):
+    return ''.join(StreamingJSONEncoder().stream(
+        {'arrivals': web.serializer_for(to_expand).encode_all(arrivals)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--arrivals', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = busbus.Engine()
+    provider = BenchmarkProvider(engine, args.arrivals)
+
+    for to_expand in ([], ['stops', 'routes'], list(web.EXPAND_TYPES)):
+        old = unexpand_path(provider.arrivals, to_expand)
+        new = serializer_path(provider.arrivals, to_expand)
+        assert old == new, 'serializer output differs from unexpand'
+
+        results = {}
+        for name, func in (('unexpand', unexpand_path),
+                           ('serializer', serializer_path)):
+            timer = timeit.Timer(lambda: func(provider.arrivals, to_expand))
+            results[name] = min(timer.repeat(args.repeat, 1))
+        print('{0} arrivals, _expand={1}: unexpand {2:.3f}s, serializer '
+              '{3:.3f}s ({4:.1f}x)'.format(
+                  args.arrivals, ','.join(to_expand) or '(none)',
+                  results['unexpand'], results['serializer'],
+                  results['unexpand'] / results['serializer']))
+
+
+if __name__ == '__main__':
+    main()
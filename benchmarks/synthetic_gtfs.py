@@ -0,0 +1,159 @@
+"""
+Generate a synthetic GTFS feed of a given size. The same parameters (and
+seed) always give the same zip, byte for byte, so that benchmark results from
+different commits are comparable.
+
+Stops are laid out on a grid. Each route runs along its own random sequence
+of stops, with half of its trips in each direction spread over the service
+day, plus frequency-based trips. Weekday and weekend services run all year,
+with random calendar exceptions.
+
+Usage: python benchmarks/synthetic_gtfs.py [--stops N] [--routes N]
+           [--trips-per-route N] [--frequency-trips N] [--exceptions N]
+           [--seed N] OUTPUT
+"""
+
+import argparse
+import contextlib
+import datetime
+import math
+import random
+import six
+import zipfile
+
+START_DATE = datetime.date(2015, 1, 1)
+END_DATE = datetime.date(2015, 12, 31)
+# service_id: days it runs (monday to sunday)
+SERVICES = (('WKDY', (1, 1, 1, 1, 1, 0, 0)),
+            ('WKND', (0, 0, 0, 0, 0, 1, 1)))
+
+
+def _time(seconds):
+    return '{0}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _date(date):
+    return date.strftime('%Y%m%d')
+
+
+def generate_files(stops=100, routes=10, trips_per_route=20,
+                   frequency_trips=2, exceptions=5, seed=0):
+    """Return the feed's files as {filename: [row, ...]}, header first."""
+    rng = random.Random(seed)
+    files = {}
+    files['agency.txt'] = [
+        ('agency_id', 'agency_name', 'agency_url', 'agency_timezone'),
+        ('SYN', 'Synthetic Transit', 'http://busbus.invalid/',
+         'America/Chicago')]
+
+    side = int(math.ceil(math.sqrt(stops)))
+    files['stops.txt'] = [('stop_id', 'stop_name', 'stop_lat', 'stop_lon')]
+    for i in range(stops):
+        files['stops.txt'].append((
+            'S{0}'.format(i), 'Stop {0}'.format(i),
+            '{0:.6f}'.format(38.9 + i // side * 0.002),
+            '{0:.6f}'.format(-95.3 + i % side * 0.002)))
+
+    files['routes.txt'] = [('route_id', 'agency_id', 'route_short_name',
+                            'route_long_name', 'route_type')]
+    files['trips.txt'] = [('route_id', 'service_id', 'trip_id',
+                           'trip_headsign', 'direction_id')]
+    files['stop_times.txt'] = [('trip_id', 'arrival_time', 'departure_time',
+                                'stop_id', 'stop_sequence')]
+    files['frequencies.txt'] = [('trip_id', 'start_time', 'end_time',
+                                 'headway_secs')]
+    for i in range(routes):
+        route_id = 'R{0}'.format(i)
+        files['routes.txt'].append((route_id, 'SYN', str(i + 1),
+                                    'Route {0}'.format(i + 1), '3'))
+        path = rng.sample(range(stops),
+                          rng.randint(min(10, stops), min(30, stops)))
+        offsets = [0]
+        for _ in path[1:]:
+            offsets.append(offsets[-1] + rng.randint(60, 180))
+
+        def add_trip(trip_id, service_id, direction, start):
+            stop_ids = path if direction == 0 else path[::-1]
+            files['trips.txt'].append((
+                route_id, service_id, trip_id,
+                'to Stop {0}'.format(stop_ids[-1]), str(direction)))
+            for seq, (stop, offset) in enumerate(zip(stop_ids, offsets)):
+                time = _time(start + offset)
+                files['stop_times.txt'].append((
+                    trip_id, time, time, 'S{0}'.format(stop), str(seq + 1)))
+
+        # spread each direction's trips from 5:00 to midnight
+        spacing = 19 * 3600 // max(1, (trips_per_route + 1) // 2)
+        for j in range(trips_per_route):
+            service_id = SERVICES[1 if j % 4 == 3 else 0][0]
+            add_trip('{0}T{1}'.format(route_id, j), service_id, j % 2,
+                     5 * 3600 + j // 2 * spacing)
+        for j in range(frequency_trips):
+            trip_id = '{0}F{1}'.format(route_id, j)
+            add_trip(trip_id, SERVICES[0][0], j % 2, 0)
+            start = 6 * 3600 + j * 3 * 3600
+            files['frequencies.txt'].append((
+                trip_id, _time(start), _time(start + 3 * 3600 - 1),
+                str(rng.choice((300, 600, 900)))))
+
+    files['calendar.txt'] = [('service_id', 'monday', 'tuesday', 'wednesday',
+                              'thursday', 'friday', 'saturday', 'sunday',
+                              'start_date', 'end_date')]
+    for service_id, days in SERVICES:
+        files['calendar.txt'].append(
+            (service_id,) + tuple(str(d) for d in days) +
+            (_date(START_DATE), _date(END_DATE)))
+
+    files['calendar_dates.txt'] = [('service_id', 'date', 'exception_type')]
+    seen = set()
+    num_days = (END_DATE - START_DATE).days + 1
+    for _ in range(min(exceptions, num_days * len(SERVICES))):
+        while True:
+            service_id, days = rng.choice(SERVICES)
+            date = START_DATE + datetime.timedelta(rng.randrange(num_days))
+            if (service_id, date) not in seen:
+                break
+        seen.add((service_id, date))
+        # remove the service from a day it runs, or add it to one it doesn't
+        files['calendar_dates.txt'].append((
+            service_id, _date(date), '2' if days[date.weekday()] else '1'))
+    return files
+
+
+def generate(**kwargs):
+    """Return the zip of a feed; see generate_files for the parameters."""
+    files = generate_files(**kwargs)
+    with contextlib.closing(six.BytesIO()) as data:
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as z:
+            for filename in sorted(files):
+                text = ''.join(','.join(row) + '\r\n'
+                               for row in files[filename])
+                # a fixed timestamp keeps the zip deterministic
+                info = zipfile.ZipInfo(filename, (1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                z.writestr(info, text.encode('utf-8'))
+        return data.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output')
+    parser.add_argument('--stops', type=int, default=100)
+    parser.add_argument('--routes', type=int, default=10)
+    parser.add_argument('--trips-per-route', type=int, default=20)
+    parser.add_argument('--frequency-trips', type=int, default=2)
+    parser.add_argument('--exceptions', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = generate(stops=args.stops, routes=args.routes,
+                    trips_per_route=args.trips_per_route,
+                    frequency_trips=args.frequency_trips,
+                    exceptions=args.exceptions, seed=args.seed)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 from busbus.entity import BaseEntity
 from busbus.queryable import Queryable
-from busbus.util import Config, dist
+from busbus.subscription import Subscription
+from busbus.util import Config, dist, profiling
 
 import errno
 import os
 import six
+import threading
+import time
 
 
 class Engine(object):
@@ -16,6 +19,11 @@ class Engine(object):
     def __init__(self, config=None):
         self.config = Config(config)
         self._providers = {}
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
+
+        if self.config['profiling'] and profiling.registry() is None:
+            profiling.enable()
 
         try:
             os.mkdir(self.config['busbus_dir'])
@@ -26,29 +34,87 @@ class Engine(object):
     def _register_provider(self, provider):
         self._providers[provider.id] = provider
 
+    def _ready_providers(self):
+        """Providers that have finished loading their data."""
+        return [p for p in self._providers.values() if p.ready]
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until every provider is ready (or timeout seconds have passed)
+        and return whether they all are.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for provider in list(self._providers.values()):
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.time()))
+            if not provider.wait_ready(remaining):
+                return False
+        return True
+
+    def subscribe(self, entity, callback, horizon=3600, **kwargs):
+        """
+        Subscribe to the arrivals or alerts (entity) matching kwargs, as given
+        to where, and return the busbus.subscription.Subscription.
+
+        callback(added, changed, removed) is called with the entities that
+        are there at first, and then with the changes whenever a provider
+        reports new data or the subscription's window of arrivals (from now
+        to horizon seconds ahead) moves with advance.
+        """
+        subscription = Subscription(self, entity, callback, horizon, **kwargs)
+        with self._subscriptions_lock:
+            self._subscriptions.append(subscription)
+        try:
+            subscription.refresh()
+        except Exception:
+            subscription.cancel()
+            raise
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._subscriptions_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _active_subscriptions(self):
+        with self._subscriptions_lock:
+            return list(self._subscriptions)
+
+    def advance(self, now=None):
+        """
+        Move the window of every subscription to start at now (the current
+        time by default).
+        """
+        for subscription in self._active_subscriptions():
+            subscription.advance(now)
+
+    def _provider_updated(self, provider, route_ids=None):
+        for subscription in self._active_subscriptions():
+            subscription.update(provider, route_ids)
+
     @property
     def providers(self):
         return Queryable(self._providers.values())
 
     @property
     def agencies(self):
-        return Queryable.chain(*[p.agencies for p in self._providers.values()])
+        return Queryable.chain(*[p.agencies for p in self._ready_providers()])
 
     @property
     def stops(self):
-        return Queryable.chain(*[p.stops for p in self._providers.values()])
+        return Queryable.chain(*[p.stops for p in self._ready_providers()])
 
     @property
     def routes(self):
-        return Queryable.chain(*[p.routes for p in self._providers.values()])
+        return Queryable.chain(*[p.routes for p in self._ready_providers()])
 
     @property
     def arrivals(self):
-        return Queryable.chain(*[p.arrivals for p in self._providers.values()])
+        return Queryable.chain(*[p.arrivals for p in self._ready_providers()])
 
     @property
     def alerts(self):
-        return Queryable.chain(*[p.alerts for p in self._providers.values()])
+        return Queryable.chain(*[p.alerts for p in self._ready_providers()])
 
 
 class Agency(BaseEntity):
@@ -105,6 +171,13 @@ class Arrival(BaseEntity):
                  'short_name', 'bikes_ok', 'realtime')
     __repr_attrs__ = ('route', 'stop', 'time')
 
+    def __init__(self, provider, **kwargs):
+        # The provider's id for the trip making this arrival, if it has one.
+        # This isn't one of the public attributes; it identifies arrivals
+        # across queries (e.g. for cursors in busbus.web).
+        self._trip_id = kwargs.pop('_trip_id', None)
+        super(Arrival, self).__init__(provider, **kwargs)
+
     def __lt__(self, other):
         return self.time < other.time
 
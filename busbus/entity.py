@@ -4,6 +4,7 @@ from busbus import util
 import arrow
 import collections
 import json
+import six
 from six.moves import reduce
 
 
@@ -78,3 +79,75 @@ class BaseEntityJSONEncoder(json.JSONEncoder):
         elif isinstance(o, collections.Iterable):
             return list(o)
         return super(BaseEntityJSONEncoder, self).default(o)
+
+
+class EncodedList(util.Iterable):
+    """
+    Iterator of values that are already encoded as JSON strings.
+    StreamingJSONEncoder writes these into an array verbatim.
+    """
+
+    def __init__(self, it):
+        self.it = iter(it)
+
+    def __next__(self):
+        return next(self.it)
+
+
+class StreamingJSONEncoder(BaseEntityJSONEncoder):
+    """
+    BaseEntityJSONEncoder that can write its output incrementally.
+
+    stream() walks dicts and iterators itself so that items are encoded one at
+    a time as the iterator produces them, rather than collected into a list
+    first (which is what default() does). Everything else is encoded in one
+    piece. The output is identical to encode(), split into chunks of roughly
+    chunk_size characters.
+
+    stream() also accepts EncodedList values, which encode() does not.
+    """
+
+    chunk_size = 8192
+
+    def stream(self, o):
+        buf = []
+        size = 0
+        for s in self._stream(o):
+            buf.append(s)
+            size += len(s)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+    def _stream(self, o):
+        if isinstance(o, dict):
+            yield '{'
+            for i, (key, value) in enumerate(o.items()):
+                if i:
+                    yield self.item_separator
+                if not isinstance(key, six.string_types):
+                    key = six.text_type(key)
+                yield self.encode(key)
+                yield self.key_separator
+                for s in self._stream(value):
+                    yield s
+            yield '}'
+        elif isinstance(o, EncodedList):
+            yield '['
+            for i, value in enumerate(o):
+                if i:
+                    yield self.item_separator
+                yield value
+            yield ']'
+        elif isinstance(o, collections.Iterator):
+            yield '['
+            for i, value in enumerate(o):
+                if i:
+                    yield self.item_separator
+                yield self.encode(value)
+            yield ']'
+        else:
+            yield self.encode(o)
@@ -1,4 +1,5 @@
 import busbus
+from busbus.queryable import Queryable
 from busbus.util import clsname
 
 from abc import ABCMeta, abstractmethod, abstractproperty
@@ -7,10 +8,23 @@ from cachecontrol.caches import FileCache
 import hashlib
 import requests
 import six
+import threading
 import uuid
 
 
-@six.add_metaclass(ABCMeta)
+class ProviderMeta(ABCMeta):
+    """
+    Starts a provider (see ProviderBase._start) once its most-derived
+    __init__ has returned.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        provider = super(ProviderMeta, cls).__call__(*args, **kwargs)
+        provider._start()
+        return provider
+
+
+@six.add_metaclass(ProviderMeta)
 class ProviderBase(object):
 
     def __init__(self, engine, **kwargs):
@@ -22,6 +36,12 @@ class ProviderBase(object):
             self.engine = engine
         else:
             self.engine = busbus.Engine()
+
+        # Set once the provider has loaded its data (see _start); the engine
+        # only serves providers that are ready.
+        self._ready = threading.Event()
+        self.load_error = None
+
         self.engine._register_provider(self)
 
         self._requests = requests.Session()
@@ -31,12 +51,49 @@ class ProviderBase(object):
         self._cached_requests = CacheControl(self._requests, cache=FileCache(
             self.engine.config['url_cache_dir']))
 
+    @property
+    def ready(self):
+        return self._ready.is_set() and self.load_error is None
+
+    @property
+    def status(self):
+        if self.load_error is not None:
+            return 'failed'
+        return 'ready' if self._ready.is_set() else 'loading'
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until the provider has loaded its data (or timeout seconds have
+        passed) and return whether it is ready. Raises the exception that
+        stopped it from loading, if any.
+        """
+        self._ready.wait(timeout)
+        if self.load_error is not None:
+            raise self.load_error
+        return self.ready
+
+    def _start(self):
+        """
+        Load the provider's data and set _ready when it's done (perhaps in
+        the background, see GTFSMixin). It's called once the provider is
+        constructed, so that loading never sees a half-initialized provider.
+        """
+        self._ready.set()
+
     def _new_entity(self, entity):
         """
         Method to receive knowledge of a new entity -- does nothing if not
         overridden
         """
 
+    def _updated(self, route_ids=None):
+        """
+        Tell the engine's subscriptions that this provider's data (e.g. its
+        realtime predictions) changed, on the given routes (by id) or on any
+        route if route_ids is None.
+        """
+        self.engine._provider_updated(self, route_ids)
+
     @abstractmethod
     def get(self, entity, id, default=None):
         """Return the requested entity, or default if it doesn't exist"""
@@ -62,6 +119,18 @@ class ProviderBase(object):
         """Return an iterator of current alerts for this provider"""
         return iter(())
 
+    def _resume(self, entity, after=None):
+        """
+        Return a Queryable of a static entity ('agencies', 'stops' or
+        'routes') ordered by id, starting after the given id (or from the
+        beginning if after is None).
+
+        This default sorts all the entities in memory; providers that can seek
+        by id should override it.
+        """
+        entities = sorted(getattr(self, entity), key=lambda e: e.id)
+        return Queryable(e for e in entities if after is None or e.id > after)
+
     def __getitem__(self, name):
         try:
             return getattr(self, name)
@@ -69,6 +138,7 @@ class ProviderBase(object):
             raise KeyError(name)
 
     def keys(self):
-        for attr in ('id', 'legal', 'credit', 'credit_url', 'country'):
+        for attr in ('id', 'status', 'legal', 'credit', 'credit_url',
+                     'country'):
             if getattr(self, attr, None) is not None:
                 yield attr
@@ -4,26 +4,59 @@ import busbus
 import busbus.entity
 from busbus.queryable import Queryable
 from busbus import util
+from busbus.provider.timetable import Timetable, build_timetable
 from busbus.util.arrivals import ArrivalQueryable, ArrivalGeneratorBase
 from busbus.util.csv import CSVReader
+from busbus.util import profiling, snapshot
 
 import apsw
 import arrow
 import collections
+import contextlib
 import datetime
+import errno
 import hashlib
 import heapq
 import itertools
+import math
 import operator
 import os
 import phonenumbers
 from pkg_resources import resource_string
 import six
+import threading
+import timeit
 import zipfile
 
 
 # This must be the same as the user_version pragma in gtfs.sql
-SCHEMA_USER_VERSION = 2015020201
+SCHEMA_USER_VERSION = 2026101902
+
+# Steps upgrading a database from an older user_version, applied in turn:
+# {user_version: (next user_version, script)}
+SCHEMA_MIGRATIONS = {
+    # the last released schema; the feeds' stop patterns are built once the
+    # tables exist (see GTFSMixin._init_schema)
+    2015020201: (2026101901, '''create table _patterns (
+        _feed integer not null, pattern_id integer not null,
+        route_id text not null, trip_headsign text, trip_short_name text,
+        bikes_allowed integer, primary key (_feed, pattern_id));
+    create table _pattern_stops (
+        _feed integer not null, pattern_id integer not null,
+        position integer not null, stop_id text not null,
+        primary key (_feed, pattern_id, position));
+    create index idx_patterns_route on _patterns (route_id, _feed);'''),
+    2026101901: (2026101902, '''alter table _feeds add column etag text;
+    alter table _feeds add column last_modified text;
+    alter table _feeds add column content_length integer;'''),
+}
+
+# (entity class, columns, named_params) -> SQLEntityMixin._build_select query
+_select_cache = {}
+
+# Providers loading in parallel download and hash their feeds concurrently,
+# but take turns writing to the same database (path or connection -> lock)
+_ingest_locks = {}
 
 
 def parse_gtfs_time(timestr):
@@ -70,6 +103,15 @@ class SQLEntityMixin(object):
 
     @classmethod
     def _build_select(cls, columns, named_params=False):
+        key = (cls, tuple(columns), named_params)
+        query = _select_cache.get(key)
+        if query is None:
+            query = _select_cache[key] = cls._format_select(columns,
+                                                            named_params)
+        return query
+
+    @classmethod
+    def _format_select(cls, columns, named_params):
         query = 'select {0} from {1}'.format(
             ', '.join('{1} as {0}'.format(k, v)
                       for k, v in cls.__field_map__.items()),
@@ -93,7 +135,7 @@ class SQLEntityMixin(object):
         and to fetch by a specific column name.
         """
         id_field = cls.__field_map__['id']
-        result = provider._query(cls, **{id_field: id}).fetchone()
+        result = next(provider._query(cls, **{id_field: id}), None)
         if result is None:
             return default
         else:
@@ -151,7 +193,9 @@ class GTFSStop(SQLEntityMixin, busbus.Stop):
 
     @property
     def routes(self):
-        result = self.provider.conn.cursor().execute(
+        if self.provider._catalog is not None:
+            return Queryable(self.provider._catalog.routes(self.id))
+        result = self.provider._execute(
             '''select route_id from _stops_routes where
             stop_id=? and _feed=?''',
             (self.id, self.provider.feed_id))
@@ -192,40 +236,107 @@ class GTFSRoute(SQLEntityMixin, busbus.Route):
 
     @property
     def stops(self):
-        result = self.provider.conn.cursor().execute(
+        if self.provider._catalog is not None:
+            return Queryable(self.provider._catalog.stops(self.id))
+        result = self.provider._execute(
             '''select stop_id from _stops_routes where
             route_id=? and _feed=?''',
             (self.id, self.provider.feed_id))
         return Queryable(self.provider.get(busbus.Stop, row['stop_id'])
                          for row in result)
 
+    # stop patterns are computed at ingest; see GTFSMixin._build_patterns
+    _directions_query = '''select p.pattern_id as _pattern_id,
+        p.trip_headsign as _headsign, p.trip_short_name as _short_name,
+        p.bikes_allowed as _bikes_allowed, {0} from _patterns as p
+        left join _pattern_stops as ps
+        on p.pattern_id=ps.pattern_id and p._feed=ps._feed
+        left join stops as s on ps.stop_id=s.stop_id and ps._feed=s._feed
+        where p.route_id=:route_id and p._feed=:_feed
+        order by p.pattern_id asc, ps.position asc'''.format(
+        ', '.join('s.{1} as {0}'.format(k, v)
+                  for k, v in GTFSStop.__field_map__.items()))
+
     @property
     def directions(self):
-        hashes = []
-        t_query = """select trip_headsign, trip_short_name, bikes_allowed,
-        trip_id from trips where route_id=:route_id and _feed=:_feed"""
-        t_filter = {'route_id': self.id, '_feed': self.provider.feed_id}
-        cur = self.provider.conn.cursor()
-        for trip in cur.execute(t_query, t_filter):
-            direction = {}
-            innercur = self.provider.conn.cursor()
-            result = innercur.execute(
-                """select s.* from stop_times as st join stops as s
-                on st.stop_id=s.stop_id and st._feed=s._feed
-                where st.trip_id=:t_id and st._feed=:_feed""",
-                {'t_id': trip['trip_id'], '_feed': self.provider.feed_id})
-            direction['stops'] = [GTFSStop(self.provider, **dict(row))
-                                  for row in result]
-            if trip['trip_headsign'] is not None:
-                direction['headsign'] = trip['trip_headsign']
-            if trip['trip_short_name'] is not None:
-                direction['short_name'] = trip['trip_short_name']
-            if trip['bikes_allowed'] is not None:
-                direction['bikes_ok'] = trip['bikes_allowed']
-            h = util.freezehash(direction)
-            if h not in hashes:
-                hashes.append(h)
-                yield direction
+        result = self.provider._execute(
+            self._directions_query,
+            {'route_id': self.id, '_feed': self.provider.feed_id})
+        for _, rows in itertools.groupby(
+                result, key=operator.itemgetter('_pattern_id')):
+            rows = list(rows)
+            direction = {
+                'stops': [GTFSStop(self.provider, **row) for row in rows
+                          if row['id'] is not None],
+            }
+            if rows[0]['_headsign'] is not None:
+                direction['headsign'] = rows[0]['_headsign']
+            if rows[0]['_short_name'] is not None:
+                direction['short_name'] = rows[0]['_short_name']
+            if rows[0]['_bikes_allowed'] is not None:
+                direction['bikes_ok'] = rows[0]['_bikes_allowed']
+            yield direction
+
+
+class GTFSCatalog(object):
+    """
+    A feed's agencies, stops and routes and which routes serve each stop,
+    kept in memory. It's made from the data of GTFSMixin._catalog_data, which
+    is snapshotted along with these indexes, and an entity is only built the
+    first time it's used.
+    """
+
+    # the layout of the data, which is part of the snapshot's key
+    version = 2
+
+    classes = (GTFSAgency, GTFSStop, GTFSRoute)
+
+    def __init__(self, provider, data):
+        self.provider = provider
+        self.timezone = data['timezone']
+        self._columns = {}
+        self._rows = {}
+        self._by_id = {}
+        self._entities = {}
+        for cls in self.classes:
+            table = data[cls.__table__]
+            index = table['columns'].index('id')
+            self._columns[cls] = table['columns']
+            self._rows[cls] = table['rows']
+            self._by_id[cls] = {row[index]: row for row in table['rows']}
+            self._entities[cls] = {}
+        self._routes_by_stop = data['routes_by_stop']
+        self._stops_by_route = data['stops_by_route']
+
+    def get(self, cls, id, default=None):
+        entity = self._entities[cls].get(id)
+        if entity is None:
+            row = self._by_id[cls].get(id)
+            if row is None:
+                return default
+            # setdefault, so that threads building the same entity at once
+            # still end up sharing one
+            entity = self._entities[cls].setdefault(id, self._build(cls, row))
+        return entity
+
+    def _build(self, cls, row):
+        data = dict(zip(self._columns[cls], row))
+        if cls is GTFSStop and not data.get('timezone'):
+            # the provider would look it up in the catalog being built
+            data['timezone'] = self.timezone
+        return cls(self.provider, **data)
+
+    def entities(self, cls):
+        index = self._columns[cls].index('id')
+        return [self.get(cls, row[index]) for row in self._rows[cls]]
+
+    def routes(self, stop_id):
+        return [self.get(GTFSRoute, route_id)
+                for route_id in self._routes_by_stop.get(stop_id, ())]
+
+    def stops(self, route_id):
+        return [self.get(GTFSStop, stop_id)
+                for stop_id in self._stops_by_route.get(route_id, ())]
 
 
 class GTFSArrivalGenerator(ArrivalGeneratorBase):
@@ -258,46 +369,80 @@ class GTFSArrivalGenerator(ArrivalGeneratorBase):
         self.it = None
 
     def _stop_times(self, stop, route):
-        return self.provider.conn.cursor().execute(
-            '''select t.*, arr, departure_time from
+        return self.provider._execute(
+            '''select t.*, arr, departure_time, stop_sequence from
                 (select trip_id, _min_arrival_time, service_id, trip_headsign,
                 trip_short_name, bikes_allowed from trips where
                 route_id=:route_id and _feed=:_feed) as t
             join
                 (select trip_id, coalesce(arrival_time, _arrival_interpolate)
-                as arr, departure_time from stop_times where stop_id=:stop_id
-                and _feed=:_feed) as st
+                as arr, departure_time, stop_sequence from stop_times where
+                stop_id=:stop_id and _feed=:_feed) as st
             on t.trip_id=st.trip_id order by arr asc''',
             {'stop_id': stop.id, 'route_id': route.id,
-             '_feed': self.provider.feed_id})
+             '_feed': self.provider.feed_id}, span='gtfs.stop_times')
 
     def _build_iterable(self):
-        iters = []
         stops = busbus.Stop.add_children(self.stops)
-        for stop, route in itertools.product(stops, self.routes):
-            for stop_time in self._stop_times(stop, route):
-                iters.append(self._build_arrivals(stop, route, stop_time))
-        return heapq.merge(*iters)
+        return heapq.merge(*[self._scheduled_arrivals(stop, route)
+                             for stop, route
+                             in itertools.product(stops, self.routes)])
+
+    def _scheduled_arrivals(self, stop, route):
+        """Return an iterator of the arrivals at stop on route in order."""
+        if getattr(self.provider, 'timetable', None) is not None:
+            return self._timetable_arrivals(stop, route)
+        # each stop time's arrivals are in time order
+        return heapq.merge(*[
+            profiling.timed('gtfs.build_arrivals',
+                            self._build_arrivals(stop, route, stop_time))
+            for stop_time in self._stop_times(stop, route)])
+
+    def _lookup_window(self):
+        """
+        The (start, end) of the scheduled times to look up arrivals in; the
+        arrivals themselves are in the window from self.start to self.end.
+        """
+        return self.start, self.end
+
+    def _timetable_arrivals(self, stop, route):
+        timetable = self.provider.timetable
+        start, end = self._lookup_window()
+        days = arrow.Arrow.range('day', start.floor('day'), end.ceil('day'))
+        # GTFS time is relative to noon
+        its = [profiling.timed('gtfs.timetable_arrivals', self._timetable_day(
+            timetable, stop, route, day.replace(hours=12))) for day in days]
+        its.extend(
+            profiling.timed('gtfs.build_arrivals',
+                            self._build_arrivals(stop, route, stop_time))
+            for stop_time in timetable.frequency_stop_times(stop.id, route.id))
+        return heapq.merge(*its)
+
+    def _timetable_day(self, timetable, stop, route, day):
+        """
+        Yield the arrivals at stop on route on one service day (noon local
+        time) of trips that don't run at a frequency.
+        """
+        start, end = self._lookup_window()
+        start = int(math.floor((start - day).total_seconds()))
+        end = int(math.ceil((end - day).total_seconds()))
+        runs = {}
+        for stop_time in timetable.stop_times(stop.id, route.id, start, end):
+            if timetable.has_frequencies(stop_time['trip_id']):
+                continue
+            service_id = stop_time['service_id']
+            if service_id not in runs:
+                runs[service_id] = timetable.runs(service_id, day.date())
+            if runs[service_id]:
+                arrival = self._build_arrival(stop, route, stop_time, day)
+                if arrival:
+                    yield arrival
 
     def _build_arrivals(self, stop, route, stop_time):
-        def build_arr(day, offset=None):
-            if offset is None:
-                offset = datetime.timedelta()
-            time = day + datetime.timedelta(seconds=stop_time['arr']) + offset
-            if not (self.start <= time <= self.end):
-                return
-            dep = (day + stop_time['departure_time'] + offset if
-                   stop_time['departure_time'] else None)
-            bikes_ok = {1: True, 2: False}.get(stop_time['bikes_allowed'])
-            return busbus.Arrival(self.provider, stop=stop, route=route,
-                                  time=time, departure_time=dep,
-                                  headsign=stop_time['trip_headsign'],
-                                  short_name=stop_time['trip_short_name'],
-                                  bikes_ok=bikes_ok, realtime=False)
-
+        start, end = self._lookup_window()
         days = filter(self._valid_date_filter(stop_time['service_id']),
-                      arrow.Arrow.range('day', self.start.floor('day'),
-                                        self.end.ceil('day')))
+                      arrow.Arrow.range('day', start.floor('day'),
+                                        end.ceil('day')))
         freqs = self._frequencies(stop_time['trip_id'])
         trip_start = stop_time['_min_arrival_time']
         for day in days:
@@ -309,16 +454,44 @@ class GTFSArrivalGenerator(ArrivalGeneratorBase):
                 rel_time = freq_start - (day + trip_start)
                 offset = datetime.timedelta()
                 while freq_start + offset <= freq_end:
-                    arrival = build_arr(day, offset + rel_time)
+                    arrival = self._build_arrival(stop, route, stop_time, day,
+                                                  offset + rel_time)
                     if arrival:
                         yield arrival
                     offset += freq['headway_secs']
             if not freqs:
-                arrival = build_arr(day)
+                arrival = self._build_arrival(stop, route, stop_time, day)
                 if arrival:
                     yield arrival
 
+    def _build_arrival(self, stop, route, stop_time, day, offset=None,
+                       window=None):
+        """
+        Build the arrival for one occurrence of a stop time on a service day
+        (noon local time), or return None if it's outside window (this
+        generator's time window by default).
+        """
+        start, end = window or (self.start, self.end)
+        if offset is None:
+            offset = datetime.timedelta()
+        time = day + datetime.timedelta(seconds=stop_time['arr']) + offset
+        if not (start <= time <= end):
+            return
+        dep = (day + stop_time['departure_time'] + offset if
+               stop_time['departure_time'] else None)
+        bikes_ok = {1: True, 2: False}.get(stop_time['bikes_allowed'])
+        return busbus.Arrival(self.provider, stop=stop, route=route,
+                              time=time, departure_time=dep,
+                              headsign=stop_time['trip_headsign'],
+                              short_name=stop_time['trip_short_name'],
+                              bikes_ok=bikes_ok, realtime=False,
+                              _trip_id=stop_time['trip_id'])
+
     def _valid_date_filter(self, service_id):
+        timetable = getattr(self.provider, 'timetable', None)
+        if timetable is not None:
+            return lambda day: timetable.runs(service_id, day.date())
+
         def valid_date(day):
             serv = self._service(service_id)
             weekday = day.format('dddd').lower()
@@ -330,13 +503,16 @@ class GTFSArrivalGenerator(ArrivalGeneratorBase):
         return valid_date
 
     def _frequencies(self, trip_id):
+        timetable = getattr(self.provider, 'timetable', None)
+        if timetable is not None:
+            return timetable.frequencies(trip_id)
         if trip_id not in self.freq_cache:
             query = """select start_time, end_time, headway_secs
             from frequencies where trip_id=:trip_id and
             _feed=:_feed order by start_time asc"""
             filter = {'trip_id': trip_id, '_feed': self.provider.feed_id}
-            cur = self.provider.conn.cursor()
-            self.freq_cache[trip_id] = cur.execute(query, filter).fetchall()
+            self.freq_cache[trip_id] = list(
+                self.provider._execute(query, filter))
         return self.freq_cache[trip_id]
 
     def _service(self, id):
@@ -345,27 +521,107 @@ class GTFSArrivalGenerator(ArrivalGeneratorBase):
             wednesday, thursday, friday, saturday, sunday from calendar
             where service_id=:service_id and _feed=:_feed"""
             c_filter = {'service_id': id, '_feed': self.provider.feed_id}
-            cur = self.provider.conn.cursor()
-            self.service_cache[id] = dict(next(cur.execute(c_query, c_filter)))
+            self.service_cache[id] = dict(next(
+                self.provider._execute(c_query, c_filter)))
 
             cd_query = """select date, exception_type as e from calendar_dates
             where service_id=:service_id and _feed=:_feed"""
-            cd_result = cur.execute(cd_query, c_filter)
+            cd_result = self.provider._execute(cd_query, c_filter)
             self.service_cache[id]['exceptions'] = {r['date']: r['e']
                                                     for r in cd_result}
         return self.service_cache[id]
 
 
+def _parse_date(s):
+    return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+
+
+def _parse_seconds(i):
+    return datetime.timedelta(seconds=i)
+
+
+# declared column type -> converter
+ROW_CONVERTERS = {
+    'date': _parse_date,
+    'gtfstime': _parse_seconds,
+    'timedelta': _parse_seconds,
+}
+
+
+class _RowColumns(object):
+    """Column names, positions and converters shared by a query's rows."""
+    __slots__ = ('names', 'index', 'converters')
+
+    def __init__(self, description):
+        self.names = tuple(name for name, _ in description)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.converters = tuple(ROW_CONVERTERS.get(decltype)
+                                for _, decltype in description)
+
+
+class GTFSRow(collections.Mapping):
+    """
+    A read-only row of a query result, accessed by column name. Values are
+    kept as SQLite returned them and converted (see ROW_CONVERTERS) only
+    when they are read.
+    """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        i = self._columns.index[key]
+        value = self._values[i]
+        convert = self._columns.converters[i]
+        if convert is None or value is None:
+            return value
+        return convert(value)
+
+    def __iter__(self):
+        return iter(self._columns.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'GTFSRow({0!r})'.format(dict(self))
+
+
+# cursor description -> _RowColumns
+_row_columns = {}
+
+
 def gtfs_row_tracer(cur, row):
-    type_map = {
-        'date': lambda s: datetime.date(int(s[:4]), int(s[5:7]), int(s[8:])),
-        'gtfstime': lambda i: datetime.timedelta(seconds=i),
-        'timedelta': lambda i: datetime.timedelta(seconds=i),
-    }
     desc = cur.getdescription()
-    return {desc[i][0]: (type_map.get(desc[i][1], lambda s: s)(x)
-                         if row[i] is not None else None)
-            for i, x in enumerate(row)}
+    columns = _row_columns.get(desc)
+    if columns is None:
+        columns = _row_columns.setdefault(desc, _RowColumns(desc))
+    return GTFSRow(columns, row)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _same_feed(stored, headers):
+    """
+    Whether response headers describe the same file as a stored _feeds row:
+    the ETags are equal or, without an ETag, both Last-Modified and the
+    content length are.
+    """
+    etag = headers.get('ETag')
+    if stored['etag'] is not None and etag is not None:
+        return stored['etag'] == etag
+    length = headers.get('Content-Length')
+    return (stored['last_modified'] is not None and
+            stored['last_modified'] == headers.get('Last-Modified') and
+            length is not None and int(length) == stored['content_length'])
 
 
 class GTFSMixin(object):
@@ -375,16 +631,221 @@ class GTFSMixin(object):
     GTFS is defined at https://developers.google.com/transit/gtfs/
     """
 
+    # the feed's Timetable, if config['gtfs_timetable_dir'] is set
+    timetable = None
+
+    # the feed's GTFSCatalog, if config['snapshot_dir'] is set
+    _catalog = None
+
     def __init__(self, engine, gtfs_url):
         super(GTFSMixin, self).__init__(engine)
 
-        if isinstance(self.engine.config['gtfs_db_path'], apsw.Connection):
-            self.conn = self.engine.config['gtfs_db_path']
+        if isinstance(gtfs_url, six.binary_type):
+            gtfs_url = gtfs_url.decode('utf-8')
+        if self.engine.config['gtfs_db_dir'] is not None:
+            path = self._shard_path(self.engine.config['gtfs_db_dir'],
+                                    gtfs_url)
+        else:
+            path = self.engine.config['gtfs_db_path']
+        if isinstance(path, apsw.Connection):
+            self._writer = path
+            self._writer.setrowtrace(gtfs_row_tracer)
+            self._db_path = None
+        else:
+            self._writer = self._connect(path)
+            # an in-memory database only exists on its own connection
+            self._db_path = path if path not in ('', ':memory:') else None
+        if self._db_path is not None:
+            # lets readers on other connections run during an ingest
+            self._writer.cursor().execute('pragma journal_mode=wal')
+        self._readers = threading.local()
+        self.statement_stats = util.StatementStats()
+        self._ingest_lock = _ingest_locks.setdefault(path, threading.RLock())
+        self._gtfs_url = gtfs_url
+
+    def _start(self):
+        if self.engine.config['background_init']:
+            self._load_thread = threading.Thread(
+                target=self._load_in_background, args=(self._gtfs_url,),
+                name='busbus-load-' + self.id[:8])
+            self._load_thread.daemon = True
+            self._load_thread.start()
         else:
-            self.conn = apsw.Connection(self.engine.config['gtfs_db_path'])
-        self.conn.setrowtrace(gtfs_row_tracer)
-        cur = self.conn.cursor()
+            self._load(self._gtfs_url)
+            if self.load_error is not None:
+                raise self.load_error
+
+    @staticmethod
+    def _shard_path(shard_dir, gtfs_url):
+        """The database file storing only the feed from gtfs_url."""
+        _makedirs(shard_dir)
+        name = hashlib.sha1(gtfs_url.encode('utf-8')).hexdigest()
+        return os.path.join(shard_dir, name + '.sqlite3')
+
+    @staticmethod
+    def _connect(path, flags=None):
+        if flags is None:
+            conn = apsw.Connection(path)
+        else:
+            conn = apsw.Connection(path, flags=flags)
+        # other processes (or providers) may be ingesting
+        conn.setbusytimeout(60 * 1000)
+        conn.setrowtrace(gtfs_row_tracer)
+        return conn
+
+    @property
+    def conn(self):
+        """
+        The connection for queries on the current thread. For a database
+        file, each thread gets its own read-only connection, so that queries
+        on different threads run concurrently; writes go through the
+        connection only the ingest uses.
+        """
+        if self._db_path is None:
+            return self._writer
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._readers.conn = self._connect(
+                self._db_path, apsw.SQLITE_OPEN_READONLY)
+        return conn
+
+    def _execute(self, query, params=(), span='gtfs.sql'):
+        """
+        Return an iterator of the rows of a query on this thread's connection,
+        recording the time SQLite spends on it and the rows it returns in
+        statement_stats (and, if profiling, as the given span).
+        """
+        timer = timeit.default_timer
+        elapsed = 0.0
+        rows = 0
+        start = timer()
+        try:
+            it = iter(profiling.timed(
+                span, self.conn.cursor().execute(query, params)))
+            while True:
+                row = next(it, None)
+                elapsed += timer() - start
+                if row is None:
+                    break
+                rows += 1
+                yield row
+                start = timer()
+        finally:
+            self.statement_stats.record(query, elapsed, rows)
+            profiling.incr('gtfs.rows', rows)
+
+    def _load(self, gtfs_url):
+        try:
+            self._load_feed(gtfs_url)
+            if self.engine.config['gtfs_timetable_dir'] is not None:
+                self.timetable = self._load_timetable(
+                    self.engine.config['gtfs_timetable_dir'])
+            if self.engine.config['snapshot_dir'] is not None:
+                self._catalog = self._load_catalog(
+                    self.engine.config['snapshot_dir'])
+        except Exception as exc:
+            self.load_error = exc
+        finally:
+            self._ready.set()
+
+    def _load_in_background(self, gtfs_url):
+        self._load(gtfs_url)
+        # for the subscriptions made while the provider was loading
+        self._updated()
+
+    def _load_feed(self, gtfs_url):
+        """
+        Download the feed and ingest it unless it is already loaded.
 
+        If the feed was loaded before, the request is conditional on the
+        stored ETag and Last-Modified headers, and the stored feed is reused
+        without reading or hashing the zip if the server reports it unchanged.
+        """
+        with self._ingest_lock:
+            self._init_schema()
+            stored = self._stored_feed(gtfs_url)
+
+        headers = {}
+        if stored is not None and stored['etag'] is not None:
+            headers['If-None-Match'] = stored['etag']
+        if stored is not None and stored['last_modified'] is not None:
+            headers['If-Modified-Since'] = stored['last_modified']
+        resp = self._cached_requests.get(gtfs_url, headers=headers,
+                                         stream=True)
+        with contextlib.closing(resp):
+            if stored is not None and (resp.status_code == 304 or
+                                       _same_feed(stored, resp.headers)):
+                self.feed_id = stored['id']
+                return
+            zip = resp.content
+        hash = hashlib.sha256(zip).hexdigest()
+        metadata = (resp.headers.get('ETag'),
+                    resp.headers.get('Last-Modified'),
+                    int(resp.headers.get('Content-Length', len(zip))))
+
+        with self._ingest_lock:
+            self._ingest(gtfs_url, zip, hash, metadata)
+
+    def _load_timetable(self, timetable_dir):
+        """
+        Open the timetable of the loaded feed (see busbus.provider.timetable),
+        building it first if there isn't one for this version of the feed.
+        """
+        _makedirs(timetable_dir)
+        path = os.path.join(timetable_dir,
+                            self._feed_sha256sum() + '.timetable')
+        try:
+            return Timetable(path)
+        except (IOError, OSError, ValueError):
+            build_timetable(self.conn, self.feed_id, path)
+            return Timetable(path)
+
+    def _feed_sha256sum(self):
+        return next(self.conn.cursor().execute(
+            'select sha256sum from _feeds where id=?',
+            (self.feed_id,)))['sha256sum']
+
+    def _load_catalog(self, snapshot_dir):
+        """
+        Build the feed's GTFSCatalog from its snapshot (see
+        busbus.util.snapshot), taking and writing one first if needed.
+        """
+        _makedirs(snapshot_dir)
+        sha256sum = self._feed_sha256sum()
+        path = os.path.join(snapshot_dir, sha256sum + '.catalog')
+        key = 'GTFSCatalog:{0}:{1}:{2}'.format(
+            SCHEMA_USER_VERSION, GTFSCatalog.version, sha256sum)
+        data = snapshot.read(path, key)
+        if data is None:
+            data = self._catalog_data()
+            snapshot.write(path, key, data)
+        return GTFSCatalog(self, data)
+
+    def _catalog_data(self):
+        data = {}
+        for cls in GTFSCatalog.classes:
+            rows = [dict(row) for row in self._query(cls)]
+            if cls is GTFSAgency:
+                data['timezone'] = next((row['timezone'] for row in rows
+                                         if row['timezone']), None)
+            columns = sorted(rows[0]) if rows else ['id']
+            data[cls.__table__] = {
+                'columns': columns,
+                'rows': [[row[c] for c in columns] for row in rows],
+            }
+        routes_by_stop = collections.defaultdict(list)
+        stops_by_route = collections.defaultdict(list)
+        for row in self._execute(
+                '''select stop_id, route_id from _stops_routes
+                where _feed=?''', (self.feed_id,)):
+            routes_by_stop[row['stop_id']].append(row['route_id'])
+            stops_by_route[row['route_id']].append(row['stop_id'])
+        data['routes_by_stop'] = routes_by_stop
+        data['stops_by_route'] = stops_by_route
+        return data
+
+    def _init_schema(self):
+        cur = self._writer.cursor()
         version = next(cur.execute('pragma user_version'))['user_version']
         if version == 0:
             script = resource_string(
@@ -392,40 +853,69 @@ class GTFSMixin(object):
             if isinstance(script, six.binary_type):
                 script = script.decode('utf-8')
             cur.execute(script)
+        elif version in SCHEMA_MIGRATIONS:
+            cur.execute('begin transaction')
+            try:
+                while version != SCHEMA_USER_VERSION:
+                    old_version = version
+                    version, script = SCHEMA_MIGRATIONS[version]
+                    cur.execute(script)
+                    if old_version == 2015020201:
+                        for row in list(cur.execute('select id from _feeds')):
+                            self._build_patterns(row['id'])
+                cur.execute('pragma user_version = {0}'.format(version))
+            except BaseException:
+                cur.execute('rollback transaction')
+                raise
+            cur.execute('commit transaction')
         elif version < SCHEMA_USER_VERSION:
-            raise NotImplementedError()
+            raise RuntimeError('Database version is {0}, which cannot be '
+                               'upgraded to version {1}; delete the database '
+                               'to load the feeds again'.format(
+                                   version, SCHEMA_USER_VERSION))
         elif version > SCHEMA_USER_VERSION:
             raise RuntimeError('Database version is {0}, but only version {1} '
                                'is known'.format(version, SCHEMA_USER_VERSION))
 
-        tables = [r['name'] for r in cur.execute('select name from '
-                                                 'sqlite_master where '
-                                                 'type="table"')
-                  if not r['name'].startswith('_')]
+    def _stored_feed(self, gtfs_url):
+        """Return the _feeds row most recently loaded from a URL, if any."""
+        return next(self._writer.cursor().execute(
+            '''select id, etag, last_modified, content_length from _feeds
+            where url=? order by id desc limit 1''', (gtfs_url,)), None)
 
-        if isinstance(gtfs_url, six.binary_type):
-            gtfs_url = gtfs_url.decode('utf-8')
-        resp = self._cached_requests.get(gtfs_url)
-        zip = six.BytesIO(resp.content).getvalue()
-        hash = hashlib.sha256(zip).hexdigest()
+    def _ingest(self, gtfs_url, zip, hash, metadata):
+        cur = self._writer.cursor()
+
+        all_tables = [r['name'] for r in cur.execute('select name from '
+                                                     'sqlite_master where '
+                                                     'type="table"')]
+        tables = [t for t in all_tables if not t.startswith('_')]
+        # tables computed from the feed at ingest
+        derived_tables = [t for t in all_tables
+                          if t.startswith('_') and t != '_feeds']
 
         resp = [x['id'] for x in cur.execute(
             'select id from _feeds where url=? AND sha256sum=?',
             (gtfs_url, hash))]
         if len(resp) == 1:
             self.feed_id = resp[0]
+            cur.execute('''update _feeds set etag=?, last_modified=?,
+                        content_length=? where id=?''',
+                        metadata + (self.feed_id,))
         else:
             cur.execute('begin transaction')
             old_ids = [(x['id'],) for x in cur.execute(
                 '''select id from _feeds where url=?''', (gtfs_url,))]
             cur.executemany('delete from _feeds where id=?', old_ids)
-            for table in tables:
+            for table in tables + derived_tables:
                 cur.executemany('delete from {0} where _feed=?'.format(table),
                                 old_ids)
 
-            cur.execute('insert into _feeds (url, sha256sum) '
-                        'values (?, ?)', (gtfs_url, hash))
-            self.feed_id = self.conn.last_insert_rowid()
+            cur.execute('''insert into _feeds (url, sha256sum, etag,
+                        last_modified, content_length)
+                        values (?, ?, ?, ?, ?)''',
+                        (gtfs_url, hash) + metadata)
+            self.feed_id = self._writer.last_insert_rowid()
             with zipfile.ZipFile(six.BytesIO(zip)) as z:
                 for table in tables:
                     filename = table + '.txt'
@@ -462,11 +952,11 @@ class GTFSMixin(object):
             for row in cur.execute(
                     '''select trip_id from trips where _feed=?''',
                     (self.feed_id,)):
-                innercur = self.conn.cursor()
+                innercur = self._writer.cursor()
                 trip_id = row['trip_id']
 
                 # interpolate missing stop times
-                known_times = {r['seq']: dict(r) for r in innercur.execute(
+                known_times = {r['seq']: r for r in innercur.execute(
                     '''select arrival_time as a, departure_time as d,
                     stop_sequence as seq from stop_times where trip_id=:trip_id
                     and _feed=:_feed and arrival_time is not null
@@ -512,19 +1002,83 @@ class GTFSMixin(object):
                 as st join
                 (select trip_id, route_id, _feed from trips where _feed=:_feed)
                 as t on st.trip_id=t.trip_id''', {'_feed': self.feed_id})
+            self._build_patterns(self.feed_id)
             cur.execute('commit transaction')
 
+    def _build_patterns(self, feed_id):
+        """
+        Find the distinct stop patterns of each route (the ordered sequence of
+        stops a trip visits, along with the trip attributes exposed as part
+        of Route.directions) and store them in _patterns/_pattern_stops.
+
+        This is a single pass over stop_times; patterns are numbered in the
+        order their first trip appears in trips.txt.
+        """
+        cur = self._writer.cursor()
+        result = cur.execute(
+            '''select t.trip_id, t.route_id, t.trip_headsign,
+            t.trip_short_name, t.bikes_allowed, st.stop_id from trips as t
+            left join stop_times as st
+            on t.trip_id=st.trip_id and t._feed=st._feed
+            where t._feed=:_feed order by t.rowid asc, st.stop_sequence asc''',
+            {'_feed': feed_id})
+        patterns = {}
+        for _, rows in itertools.groupby(result,
+                                         key=operator.itemgetter('trip_id')):
+            rows = list(rows)
+            key = (rows[0]['route_id'], rows[0]['trip_headsign'],
+                   rows[0]['trip_short_name'], rows[0]['bikes_allowed'],
+                   tuple(row['stop_id'] for row in rows
+                         if row['stop_id'] is not None))
+            if key not in patterns:
+                patterns[key] = len(patterns) + 1
+
+        cur.executemany(
+            '''insert into _patterns (pattern_id, route_id, trip_headsign,
+            trip_short_name, bikes_allowed, _feed)
+            values (?, ?, ?, ?, ?, ?)''',
+            ((pattern_id,) + key[:4] + (feed_id,)
+             for key, pattern_id in patterns.items()))
+        cur.executemany(
+            '''insert into _pattern_stops (pattern_id, position, stop_id,
+            _feed) values (?, ?, ?, ?)''',
+            ((pattern_id, position, stop_id, feed_id)
+             for key, pattern_id in patterns.items()
+             for position, stop_id in enumerate(key[4])))
+
     def _query(self, cls, **kwargs):
         if '_feed' not in kwargs:
             kwargs['_feed'] = self.feed_id
-        cur = self.conn.cursor()
-        return cur.execute(cls._build_select(
-            kwargs.keys(), named_params=True), kwargs)
+        # sorted, so that the same filters always use the same statement
+        return self._execute(cls._build_select(
+            sorted(kwargs), named_params=True), kwargs, span='gtfs.query')
 
     def _entity_builder(self, cls, **kwargs):
+        if self._catalog is not None and not kwargs:
+            return Queryable(iter(self._catalog.entities(cls)))
         query = self._query(cls, **kwargs)
         return Queryable(cls(self, **row) for row in query)
 
+    def _resume(self, entity, after=None):
+        classes = {
+            'agencies': GTFSAgency,
+            'stops': GTFSStop,
+            'routes': GTFSRoute,
+        }
+        if entity not in classes:
+            return super(GTFSMixin, self)._resume(entity, after)
+        cls = classes[entity]
+        id_field = cls.__field_map__['id']
+        query = cls._build_select(['_feed'], named_params=True)
+        params = {'_feed': self.feed_id}
+        if after is not None:
+            # keyset pagination: seek in the (_feed, id) primary key index
+            query += ' and {0}>:after'.format(id_field)
+            params['after'] = after
+        query += ' order by {0} asc'.format(id_field)
+        result = self._execute(query, params)
+        return Queryable(cls(self, **row) for row in result)
+
     def get(self, cls, id, default=None):
         typemap = {
             busbus.Agency: GTFSAgency,
@@ -535,13 +1089,17 @@ class GTFSMixin(object):
             cls = util.entity_type(cls)
         except TypeError:
             return default
-        if cls in typemap:
+        if cls in typemap and self._catalog is not None:
+            return self._catalog.get(typemap[cls], id, default)
+        elif cls in typemap:
             return typemap[cls].from_id(self, id, default)
         else:
             return default
 
     @property
     def _timezone(self):
+        if self._catalog is not None:
+            return self._catalog.timezone
         for agency in self.agencies:
             if agency.timezone:
                 return agency.timezone
@@ -1,5 +1,5 @@
 -- this must be the same as SCHEMA_USER_VERSION in gtfs.py
-pragma user_version = 2015020201;
+pragma user_version = 2026101902;
 
 -- TABLES ---------------------------------------------------------------------
 
@@ -7,6 +7,10 @@ create table _feeds (
     id integer not null,
     url text not null,
     sha256sum text not null,
+    -- response headers, for revalidating the feed without downloading it
+    etag text,
+    last_modified text,
+    content_length integer,
     primary key (id)
 );
 
@@ -64,6 +68,26 @@ create table _stops_routes (
     route_id text not null
 );
 
+-- distinct stop patterns of each route: one row per ordered sequence of stops
+-- plus the trip attributes that distinguish a direction
+create table _patterns (
+    _feed integer not null,
+    pattern_id integer not null,
+    route_id text not null,
+    trip_headsign text,
+    trip_short_name text,
+    bikes_allowed integer,
+    primary key (_feed, pattern_id)
+);
+
+create table _pattern_stops (
+    _feed integer not null,
+    pattern_id integer not null,
+    position integer not null,
+    stop_id text not null,
+    primary key (_feed, pattern_id, position)
+);
+
 create table trips (
     _feed integer not null,
     route_id text not null,
@@ -196,6 +220,7 @@ create index idx_stops_id_feed on stops (stop_id, _feed);
 create index idx_routes_id_feed on routes (route_id, _feed);
 create index idx_stops_routes_stops on _stops_routes (stop_id, _feed);
 create index idx_stops_routes_routes on _stops_routes (route_id, _feed);
+create index idx_patterns_route on _patterns (route_id, _feed);
 create index idx_trips_id_feed on trips(trip_id, _feed);
 create index idx_trips_route_feed on trips (route_id, _feed);
 create index idx_trips_min_arrival_time on trips (_min_arrival_time);
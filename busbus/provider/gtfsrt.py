@@ -0,0 +1,449 @@
+import busbus
+from busbus.provider.gtfs import GTFSArrivalGenerator
+from busbus.util.arrivals import ArrivalQueryable
+
+from array import array
+import arrow
+import collections
+import datetime
+from google.protobuf.message import DecodeError
+from google.transit import gtfs_realtime_pb2
+import itertools
+import logging
+import operator
+import requests
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# compact per-trip records of GTFS-Realtime TripUpdates; stops are in the
+# feed's order, which the spec requires to be sorted by stop_sequence
+RealtimeTrip = collections.namedtuple('RealtimeTrip', (
+    'route_id', 'start_date', 'canceled', 'delay', 'stops'))
+RealtimeStop = collections.namedtuple('RealtimeStop', (
+    'stop_sequence', 'stop_id', 'time', 'delay', 'skipped'))
+
+
+def _realtime_trip(trip_update):
+    descriptor = trip_update.trip
+    stops = []
+    for update in trip_update.stop_time_update:
+        event = None
+        for name in ('arrival', 'departure'):
+            if update.HasField(name):
+                event = getattr(update, name)
+                break
+        stops.append(RealtimeStop(
+            update.stop_sequence if update.HasField('stop_sequence') else None,
+            update.stop_id or None,
+            event.time if event is not None and event.HasField('time')
+            else None,
+            event.delay if event is not None and event.HasField('delay')
+            else None,
+            update.schedule_relationship == update.SKIPPED))
+    start_date = None
+    if descriptor.start_date:
+        start_date = datetime.datetime.strptime(descriptor.start_date,
+                                                '%Y%m%d').date()
+    return RealtimeTrip(
+        descriptor.route_id or None, start_date,
+        descriptor.schedule_relationship == descriptor.CANCELED,
+        trip_update.delay if trip_update.HasField('delay') else None,
+        tuple(stops))
+
+
+class TripUpdateIndex(object):
+    """
+    The trips in a GTFS-Realtime TripUpdates feed, keyed by trip id.
+
+    Snapshots are applied incrementally: only the entities that changed since
+    the previous snapshot are parsed again. Readers get the trips dict through
+    the trips attribute; it is replaced, never modified, by each update.
+    """
+
+    def __init__(self):
+        self.trips = {}
+        self.timestamp = None
+        self._entities = {}  # trip id -> serialized entity
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.trips)
+
+    def update(self, data):
+        """
+        Apply a serialized FeedMessage and return the set of trip ids that
+        were added, changed or removed.
+        """
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(data)
+        full = (feed.header.incrementality ==
+                gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+
+        with self._lock:
+            trips = dict(self.trips)
+            entities = dict(self._entities)
+            changed = set()
+            seen = set()
+            for entity in feed.entity:
+                if not entity.HasField('trip_update'):
+                    continue
+                trip_id = entity.trip_update.trip.trip_id
+                if not trip_id:
+                    # frequency-based trips identified by route and start
+                    # time aren't supported
+                    continue
+                seen.add(trip_id)
+                if entity.is_deleted:
+                    if trips.pop(trip_id, None) is not None:
+                        changed.add(trip_id)
+                    entities.pop(trip_id, None)
+                    continue
+                serialized = entity.trip_update.SerializeToString()
+                if entities.get(trip_id) == serialized:
+                    continue
+                entities[trip_id] = serialized
+                trips[trip_id] = _realtime_trip(entity.trip_update)
+                changed.add(trip_id)
+            if full:
+                for trip_id in set(trips) - seen:
+                    del trips[trip_id]
+                    del entities[trip_id]
+                    changed.add(trip_id)
+
+            self._entities = entities
+            self.trips = trips
+            if feed.header.HasField('timestamp'):
+                self.timestamp = feed.header.timestamp
+            else:
+                self.timestamp = int(time.time())
+        return changed
+
+
+def _accumulate(values):
+    # itertools.accumulate, which Python 2 doesn't have
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+class TripDelays(object):
+    """
+    Predicted delays (in seconds) at every stop of the trips in a
+    TripUpdateIndex.
+
+    Each trip's stops are kept as arrays in stop_sequence order. The delays
+    reported by the feed are placed at their stops as steps from the previous
+    delay, and a cumulative sum carries each one forward to the following
+    stops until the next report. Looking up a (trip, stop) is then O(1).
+
+    Instances don't change: update() returns a new TripDelays that shares the
+    trips that didn't change.
+    """
+
+    # array typecode and value for stops without a prediction
+    _typecode = 'l'
+    _unknown = -2 ** 31
+    # flags
+    _skipped = 1
+    _no_data = 2
+
+    # SQLite allows at most 999 parameters per statement
+    _max_trips_per_query = 500
+
+    def __init__(self, provider, trips=None, schedules=None):
+        self.provider = provider
+        # trip id -> (stop_sequence positions, delays, flags), or False if
+        # the trip is canceled
+        self.trips = {} if trips is None else trips
+        # trip id -> (stop_sequences, stop_ids, scheduled times); shared by
+        # every version
+        self._schedules = {} if schedules is None else schedules
+        self._extent = None
+
+    def update(self, index, changed):
+        """Return a TripDelays for the index after a change to some trips."""
+        trips = dict(self.trips)
+        self._load_schedules([trip_id for trip_id in changed
+                              if trip_id in index.trips])
+        for trip_id in changed:
+            trip = index.trips.get(trip_id)
+            schedule = self._schedules.get(trip_id)
+            if trip is None or schedule is None:
+                trips.pop(trip_id, None)
+            elif trip.canceled:
+                trips[trip_id] = False
+            else:
+                trips[trip_id] = self._propagate(trip, schedule,
+                                                 index.timestamp)
+        return TripDelays(self.provider, trips, self._schedules)
+
+    def delay(self, trip_id, stop_sequence):
+        """
+        Return the predicted delay at a stop of a trip, False if the trip
+        doesn't stop there (it's canceled or the stop is skipped), or None if
+        there is no prediction.
+        """
+        trip = self.trips.get(trip_id)
+        if trip is None or trip is False:
+            return trip
+        positions, delays, flags = trip
+        i = positions.get(stop_sequence)
+        if i is None or flags[i] == self._no_data:
+            return None
+        if flags[i] == self._skipped:
+            return False
+        if delays[i] == self._unknown:
+            return None
+        return delays[i]
+
+    def extent(self):
+        """
+        Return the (earliest, latest) predicted delay of any trip, counting
+        stops without a prediction as on time.
+        """
+        if self._extent is None:
+            known = [0]
+            for trip in self.trips.values():
+                if trip:
+                    known.extend(d for d in trip[1] if d != self._unknown)
+            self._extent = (min(known), max(known))
+        return self._extent
+
+    def _load_schedules(self, trip_ids):
+        trip_ids = [t for t in trip_ids if t not in self._schedules]
+        cur = self.provider.conn.cursor()
+        for i in range(0, len(trip_ids), self._max_trips_per_query):
+            chunk = trip_ids[i:i + self._max_trips_per_query]
+            query = '''select trip_id, stop_sequence, stop_id,
+                coalesce(arrival_time, _arrival_interpolate) as arr
+                from stop_times where _feed=? and trip_id in ({0})
+                order by trip_id, stop_sequence'''.format(
+                ', '.join('?' * len(chunk)))
+            rows = cur.execute(query, [self.provider.feed_id] + chunk)
+            for trip_id, stops in itertools.groupby(
+                    rows, operator.itemgetter('trip_id')):
+                stops = list(stops)
+                self._schedules[trip_id] = (
+                    array(self._typecode, (s['stop_sequence'] for s in stops)),
+                    tuple(s['stop_id'] for s in stops),
+                    array(self._typecode, (s['arr'] for s in stops)))
+
+    def _service_day(self, trip, times, i, reported, timestamp):
+        """
+        Return the POSIX time of noon on the trip's service day (which GTFS
+        times are relative to), for converting a time reported at stop i.
+        """
+        tz = self.provider._timezone
+        if trip.start_date is not None:
+            days = [trip.start_date]
+        else:
+            # the service day that puts the report closest to the schedule
+            today = arrow.get(timestamp or time.time()).to(tz).date()
+            days = [today - datetime.timedelta(days=1), today]
+        noons = [arrow.Arrow.fromdate(day, tzinfo=tz).replace(
+            hours=12).timestamp for day in days]
+        return min(noons, key=lambda noon: abs(reported - noon - times[i]))
+
+    def _propagate(self, trip, schedule, timestamp):
+        sequences, stop_ids, times = schedule
+        positions = dict((seq, i) for i, seq in enumerate(sequences))
+        n = len(sequences)
+        steps = array(self._typecode, [0]) * n
+        flags = array('b', [0]) * n
+
+        points = []
+        # updates come in stop order, so a stop a trip visits more than once
+        # (e.g. on a loop) is matched by stop_id from the last stop matched
+        last = 0
+        for update in trip.stops:
+            if update.stop_sequence is not None:
+                i = positions.get(update.stop_sequence)
+            else:
+                try:
+                    i = stop_ids.index(update.stop_id, last)
+                except ValueError:
+                    i = None
+            if i is None:
+                continue
+            last = i
+            if update.skipped:
+                flags[i] = self._skipped
+            elif update.time is not None:
+                noon = self._service_day(trip, times, i, update.time,
+                                         timestamp)
+                points.append((i, update.time - noon - times[i]))
+            elif update.delay is not None:
+                points.append((i, update.delay))
+            else:
+                flags[i] = self._no_data
+        points.sort()
+
+        # the trip's delay applies from the start until the first report
+        first = 0 if trip.delay is not None else (
+            points[0][0] if points else n)
+        previous = trip.delay or 0
+        steps[0] = previous
+        for i, delay in points:
+            steps[i] += delay - previous
+            previous = delay
+        delays = array(self._typecode, _accumulate(steps))
+        for i in range(first):
+            delays[i] = self._unknown
+        return positions, delays, flags
+
+
+class GTFSRealtimeArrivalGenerator(GTFSArrivalGenerator):
+    """
+    Scheduled arrivals from the GTFS feed, with the provider's TripUpdates
+    applied: canceled trips and skipped stops are left out, and the times of
+    trips with updates are predicted from them.
+    """
+    realtime = True
+
+    def __init__(self, provider, stops, routes, start, end):
+        super(GTFSRealtimeArrivalGenerator, self).__init__(
+            provider, stops, routes, start, end)
+        self.trips, timestamp, self.delays = provider._refresh_trip_updates()
+        self.timestamp = arrow.get(timestamp or time.time())
+        # a late trip may be scheduled before the window, and an early one
+        # after it
+        earliest, latest = self.delays.extent()
+        self._window = (
+            self.start - datetime.timedelta(seconds=max(latest, 0)),
+            self.end + datetime.timedelta(seconds=max(-earliest, 0)))
+
+    def _applies(self, trip, day, time):
+        if trip.start_date is not None:
+            return trip.start_date == day.date()
+        # without a start date, assume the update is for the occurrence of
+        # the trip closest to when the feed was generated
+        return abs(time - self.timestamp) < datetime.timedelta(hours=12)
+
+    def _lookup_window(self):
+        return self._window
+
+    def _build_arrival(self, stop, route, stop_time, day, offset=None):
+        arr = super(GTFSRealtimeArrivalGenerator, self)._build_arrival(
+            stop, route, stop_time, day, offset, self._window)
+        if arr is None:
+            return None
+        delay = None
+        trip = self.trips.get(stop_time['trip_id'])
+        if trip is not None and self._applies(trip, day, arr.time):
+            delay = self.delays.delay(stop_time['trip_id'],
+                                      stop_time['stop_sequence'])
+        if delay is False:
+            return None
+        if delay is None:
+            return arr if self.start <= arr.time <= self.end else None
+        delay = datetime.timedelta(seconds=delay)
+        predicted = arr.time + delay
+        if not (self.start <= predicted <= self.end):
+            return None
+        dep = arr.departure_time + delay if arr.departure_time else None
+        return busbus.Arrival(self.provider, stop=stop, route=route,
+                              time=predicted, departure_time=dep,
+                              headsign=arr.headsign,
+                              short_name=arr.short_name,
+                              bikes_ok=arr.bikes_ok, realtime=True,
+                              _trip_id=arr._trip_id)
+
+
+class GTFSRealtimeMixin(object):
+    """
+    Mixin for GTFSMixin providers to add realtime arrivals from a
+    GTFS-Realtime TripUpdates feed. It goes before GTFSMixin:
+
+        class MyProvider(GTFSRealtimeMixin, GTFSMixin, ProviderBase):
+            trip_updates_url = 'http://example.com/gtfs-rt/TripUpdates.pb'
+
+    trip_updates_url is fetched (or read, if it is a local path) at most
+    once every trip_updates_interval seconds, when arrivals are requested.
+
+    GTFS-Realtime is defined at
+    https://developers.google.com/transit/gtfs-realtime/
+    """
+
+    trip_updates_url = None
+    trip_updates_interval = 30
+    # seconds to wait for trip_updates_url to respond
+    trip_updates_timeout = 10
+
+    def __init__(self, *args, **kwargs):
+        super(GTFSRealtimeMixin, self).__init__(*args, **kwargs)
+        self._trip_updates = TripUpdateIndex()
+        self._trip_delays = TripDelays(self)
+        self._trip_updates_lock = threading.RLock()
+        self._trip_updates_fetched = None
+
+    def update_trip_updates(self, data=None):
+        """
+        Apply a TripUpdates snapshot (fetched from trip_updates_url if data
+        isn't given) and return the set of trip ids that changed.
+        """
+        if data is None:
+            data = self._fetch_trip_updates()
+        changed = self._apply_trip_updates(data)
+        if changed:
+            self._updated()
+        return changed
+
+    def _fetch_trip_updates(self):
+        url = self.trip_updates_url
+        try:
+            if url.startswith(('http://', 'https://')):
+                resp = self._requests.get(url,
+                                          timeout=self.trip_updates_timeout)
+                resp.raise_for_status()
+                return resp.content
+            with open(url, 'rb') as f:
+                return f.read()
+        except (requests.RequestException, IOError) as exc:
+            log.warning('could not fetch %s: %s', url, exc)
+            return None
+
+    def _apply_trip_updates(self, data):
+        # a failed fetch or a bad feed keeps the previous snapshot until the
+        # next try
+        if data is None:
+            return set()
+        with self._trip_updates_lock:
+            try:
+                changed = self._trip_updates.update(data)
+            except DecodeError as exc:
+                log.warning('could not parse TripUpdates from %s: %s',
+                            self.trip_updates_url, exc)
+                return set()
+            self._trip_delays = self._trip_delays.update(self._trip_updates,
+                                                         changed)
+        return changed
+
+    def _refresh_trip_updates(self):
+        changed = None
+        with self._trip_updates_lock:
+            due = self.trip_updates_url is not None and (
+                self._trip_updates_fetched is None or
+                time.time() - self._trip_updates_fetched >=
+                self.trip_updates_interval)
+            if due:
+                # claim this fetch; other queries use the current snapshot
+                # rather than waiting on the network
+                self._trip_updates_fetched = time.time()
+        if due:
+            changed = self._apply_trip_updates(self._fetch_trip_updates())
+        with self._trip_updates_lock:
+            result = (self._trip_updates.trips, self._trip_updates.timestamp,
+                      self._trip_delays)
+        # subscriptions are told outside the lock, since they query arrivals
+        # (and so take the lock) themselves
+        if changed:
+            self._updated()
+        return result
+
+    @property
+    def arrivals(self):
+        return ArrivalQueryable(self, (GTFSRealtimeArrivalGenerator,
+                                       GTFSArrivalGenerator))
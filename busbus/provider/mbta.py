@@ -1,14 +1,19 @@
 import busbus
 from busbus.provider import ProviderBase
 from busbus.provider.gtfs import GTFSMixin, GTFSArrivalGenerator
-from busbus.util import RateLimitRequests
+from busbus.util import RateLimitRequests, profiling
+from busbus.util.realtime import RealtimePoller
 from busbus.util.arrivals import ArrivalQueryable, ArrivalGeneratorBase
 
 import arrow
 import collections
 import heapq
-import itertools
+from multiprocessing.pool import ThreadPool
 import six
+from six.moves import queue
+import sys
+import threading
+import time
 
 
 class MBTAArrivalGenerator(ArrivalGeneratorBase):
@@ -23,31 +28,36 @@ class MBTAArrivalGenerator(ArrivalGeneratorBase):
                              'data, or set realtime=False')
         elif self.routes is None:
             def yield_predictions_by_stop(stop):
-                cur = self.provider.conn.cursor()
-                routes = stop.routes
+                routes = list(stop.routes)
+
+                indexed = [self.provider._indexed_predictions(route.id)
+                           for route in routes]
+                if routes and all(x is not None for x in indexed):
+                    # every route is kept up to date by the poller
+                    its = [self._merge_arrivals(stop, route,
+                                                by_stop.get(stop.id, {}))
+                           for route, by_stop in zip(routes, indexed)]
+                    return heapq.merge(*its)
 
                 resp = self.provider._mbta_realtime_call('predictionsbystop',
                                                          {'stop': stop.id})
                 if resp.status_code == 200:
+                    predictions = [(route['route_id'], trip)
+                                   for mode in resp.json()['mode']
+                                   for route in mode['route']
+                                   for direction in route['direction']
+                                   for trip in direction['trip']]
+                    known = self._known_trips(
+                        stop, set(trip['trip_id'] for _, trip in predictions))
                     trips = {}
-                    for mode in resp.json()['mode']:
-                        for route in mode['route']:
-                            for direction in route['direction']:
-                                for trip in direction['trip']:
-                                    query = cur.execute(
-                                        '''select null from stop_times where
-                                        stop_id=? and trip_id=? and _feed=?''',
-                                        (stop.id, trip['trip_id'],
-                                         self.provider.feed_id))
-                                    # if the query returns anything it's
-                                    # guaranteed to be 1 row
-                                    for row in query:
-                                        trips[trip['trip_id']] = {
-                                            'pre_dt': trip['pre_dt'],
-                                            'headsign': trip['trip_headsign'],
-                                            'route_id': route['route_id'],
-                                            'stop_id': stop.id,
-                                        }
+                    for route_id, trip in predictions:
+                        if trip['trip_id'] in known:
+                            trips[trip['trip_id']] = {
+                                'pre_dt': trip['pre_dt'],
+                                'headsign': trip['trip_headsign'],
+                                'route_id': route_id,
+                                'stop_id': stop.id,
+                            }
                     its = [self._merge_arrivals(stop, route, trips)
                            for route in routes]
                 else:
@@ -55,8 +65,19 @@ class MBTAArrivalGenerator(ArrivalGeneratorBase):
                            for route in routes]
                 return heapq.merge(*its)
 
-            its = list(six.moves.map(yield_predictions_by_stop,
-                                     busbus.Stop.add_children(self.stops)))
+            def schedule_by_stop(stop):
+                return heapq.merge(*[self._merge_arrivals(stop, route, None)
+                                     for route in stop.routes])
+
+            # fetch each stop's predictions concurrently (see
+            # MBTAProvider.realtime_workers and realtime_timeout); only the
+            # request, parsing it and checking its trips happen in the pool,
+            # as the arrivals returned are generated (see _merge_arrivals) on
+            # the thread reading the query, so that a query that's only
+            # partly read stops generating early; the same goes for routes
+            its = self.provider._realtime_map(
+                yield_predictions_by_stop, schedule_by_stop,
+                list(busbus.Stop.add_children(self.stops)))
         else:
             def yield_predictions_by_route(route):
                 if self.stops is None:
@@ -65,21 +86,19 @@ class MBTAArrivalGenerator(ArrivalGeneratorBase):
                     stops = self.stops
                 stops = list(busbus.Stop.add_children(stops))
 
-                resp = self.provider._mbta_realtime_call('predictionsbyroute',
-                                                         {'route': route.id})
-                if resp.status_code == 200:
-                    trips = {stop.id: dict() for stop in stops}
-                    for dir in resp.json()['direction']:
-                        for trip in dir['trip']:
-                            for stop in trip['stop']:
-                                if (stop['stop_sequence'] != '0' and
-                                        stop['stop_id'] in trips):
-                                    trips[stop['stop_id']][trip['trip_id']] = {
-                                        'pre_dt': stop['pre_dt'],
-                                        'headsign': trip['trip_headsign'],
-                                        'route_id': route.id,
-                                        'stop_id': stop['stop_id'],
-                                    }
+                by_stop = self.provider._indexed_predictions(route.id)
+                if by_stop is None:
+                    resp = self.provider._mbta_realtime_call(
+                        'predictionsbyroute', {'route': route.id})
+                    if resp.status_code == 200:
+                        by_stop = collections.defaultdict(dict)
+                        for stop_id, trip_id, trip in (
+                                self.provider._parse_predictions_by_route(
+                                    route.id, resp.json())):
+                            by_stop[stop_id][trip_id] = trip
+                if by_stop is not None:
+                    trips = {stop.id: by_stop.get(stop.id, {})
+                             for stop in stops}
                     its = [self._merge_arrivals(stop, route, trips[stop.id])
                            for stop in stops if trips[stop.id]]
                 else:
@@ -87,18 +106,57 @@ class MBTAArrivalGenerator(ArrivalGeneratorBase):
                            for stop in stops]
                 return heapq.merge(*its)
 
-            its = list(six.moves.map(yield_predictions_by_route, self.routes))
+            def schedule_by_route(route):
+                stops = route.stops if self.stops is None else self.stops
+                return heapq.merge(*[
+                    self._merge_arrivals(stop, route, None)
+                    for stop in busbus.Stop.add_children(stops)])
+
+            its = self.provider._realtime_map(
+                yield_predictions_by_route, schedule_by_route,
+                list(self.routes))
         return heapq.merge(*its)
 
+    # SQLite allows at most 999 parameters per statement
+    _max_trips_per_query = 500
+
+    def _known_trips(self, stop, trip_ids):
+        """
+        Return the subset of trip_ids that the feed has stopping at stop.
+        """
+        cur = self.provider.conn.cursor()
+        trip_ids = list(trip_ids)
+        known = set()
+        for i in range(0, len(trip_ids), self._max_trips_per_query):
+            chunk = trip_ids[i:i + self._max_trips_per_query]
+            query = '''select trip_id from stop_times where stop_id=? and
+                _feed=? and trip_id in ({0})'''.format(
+                ', '.join('?' * len(chunk)))
+            known.update(row['trip_id'] for row in cur.execute(
+                query, [stop.id, self.provider.feed_id] + chunk))
+        return known
+
     def _merge_arrivals(self, stop, route, trips):
-        arrs = collections.defaultdict(list)
-        for tid, arr in self._build_scheduled_arrivals(stop, route):
-            arrs[tid].append(arr)
+        """
+        Stream the arrivals at a stop on a route in time order: the scheduled
+        arrivals, except that every arrival of a trip with a realtime
+        prediction is replaced by the prediction.
+
+        Only the predictions are buffered (to sort them and to look up which
+        trips they replace); the schedule is merged in as it's generated,
+        which happens on the thread iterating over the result rather than
+        the one calling this.
+        """
+        realtime = []
         if trips is not None:
-            for tid, arr in self._build_realtime_arrivals(stop, route, trips):
-                arrs[tid] = [arr]
-        arrs = itertools.chain(*arrs.values())
-        return sorted(arrs)
+            realtime = sorted(
+                arr for _, arr in
+                self._build_realtime_arrivals(stop, route, trips))
+        predicted = set(arr._trip_id for arr in realtime)
+        scheduled = self._build_scheduled_arrivals(stop, route)
+        scheduled = (arr for arr in scheduled
+                     if arr._trip_id not in predicted)
+        return heapq.merge(scheduled, realtime)
 
     def _build_realtime_arrivals(self, stop, route, trips):
         for trip_id, trip in trips.items():
@@ -108,14 +166,12 @@ class MBTAArrivalGenerator(ArrivalGeneratorBase):
                     arr = busbus.Arrival(self.provider, realtime=True,
                                          stop=stop, route=route,
                                          time=time, departure_time=time,
-                                         headsign=trip['headsign'])
+                                         headsign=trip['headsign'],
+                                         _trip_id=trip_id)
                     yield (trip_id, arr)
 
     def _build_scheduled_arrivals(self, stop, route):
-        for stop_time in self.gtfs_gen._stop_times(stop, route):
-            for arr in self.gtfs_gen._build_arrivals(stop, route, stop_time):
-                if self.start <= arr.time <= self.end:
-                    yield (stop_time['trip_id'], arr)
+        return self.gtfs_gen._scheduled_arrivals(stop, route)
 
 
 class MBTAProvider(GTFSMixin, ProviderBase):
@@ -144,18 +200,127 @@ class MBTAProvider(GTFSMixin, ProviderBase):
     gtfs_url = "http://www.mbta.com/uploadedfiles/MBTA_GTFS.zip"
     mbta_realtime_url = "http://realtime.mbta.com/developer/api/v2/"
 
+    # how many MBTA-realtime requests an arrivals query may have in flight at
+    # once (e.g. one per child stop of a station)
+    realtime_workers = 8
+
+    # seconds an arrivals query waits for its MBTA-realtime requests; the
+    # stops or routes whose requests take longer get scheduled arrivals only
+    realtime_timeout = 10
+
     def __init__(self, mbta_api_key, engine=None):
         super(MBTAProvider, self).__init__(engine, self.gtfs_url)
         self.mbta_api_key = mbta_api_key
 
         # MBTA requires that "the same polling command" is not to be called
         # more often than every 10 seconds (API docs, "Use of MBTA data").
-        self._requests = RateLimitRequests(url_interval=10)
+        self._requests = RateLimitRequests(
+            url_interval=10,
+            shared_path=self.engine.config['rate_limit_db_path'])
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._poller = None
+
+    @property
+    def _realtime_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.realtime_workers)
+            return self._pool
+
+    def _realtime_map(self, func, fallback, items):
+        """
+        Yield func(item) for each item, run concurrently in the realtime pool,
+        in the order the calls finish. Once realtime_timeout seconds have
+        passed, fallback(item) is yielded instead for the items still
+        waiting, so that a slow response doesn't hold up the whole query.
+        """
+        done = queue.Queue()
+
+        def call(index, item):
+            try:
+                done.put((index, func(item), None))
+            except Exception:
+                done.put((index, None, sys.exc_info()))
+
+        for index, item in enumerate(items):
+            self._realtime_pool.apply_async(profiling.bind(call),
+                                            (index, item))
+        deadline = time.time() + self.realtime_timeout
+        pending = set(range(len(items)))
+        while pending:
+            try:
+                index, result, exc_info = done.get(
+                    timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            pending.discard(index)
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            yield result
+        for index in sorted(pending):
+            yield fallback(items[index])
 
     def _mbta_realtime_call(self, query, params):
         url = self.mbta_realtime_url + query
         params.update({'api_key': self.mbta_api_key, 'format': 'json'})
-        return self._requests.get(url, params=params)
+        with profiling.span('mbta.realtime_call'):
+            return self._requests.get(url, params=params)
+
+    @staticmethod
+    def _parse_predictions_by_route(route_id, data):
+        """
+        Yield (stop_id, trip_id, trip) for each prediction in a
+        predictionsbyroute response.
+        """
+        for dir in data['direction']:
+            for trip in dir['trip']:
+                for stop in trip['stop']:
+                    if stop['stop_sequence'] != '0':
+                        yield (stop['stop_id'], trip['trip_id'], {
+                            'pre_dt': stop['pre_dt'],
+                            'headsign': trip['trip_headsign'],
+                            'route_id': route_id,
+                            'stop_id': stop['stop_id'],
+                        })
+
+    def _poll_route(self, route_id):
+        resp = self._mbta_realtime_call('predictionsbyroute',
+                                        {'route': route_id})
+        if resp.status_code != 200:
+            return None
+        return self._parse_predictions_by_route(route_id, resp.json())
+
+    def start_poller(self, route_ids, interval=10):
+        """
+        Start refreshing the predictions for the given routes in a background
+        thread every interval seconds (at least 10, MBTA's limit for
+        repeating a request). Arrival queries covering only these routes are
+        then answered without waiting on the MBTA-realtime API.
+        """
+        self.stop_poller()
+        self._poller = RealtimePoller(self._poll_route, route_ids,
+                                      max(interval, 10),
+                                      on_update=self._updated)
+        self._poller.start()
+        return self._poller
+
+    def stop_poller(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def _indexed_predictions(self, route_id):
+        """
+        Return the poller's current {stop_id: {trip_id: trip}} predictions
+        for a route, or None if the route isn't polled (or its predictions
+        are out of date).
+        """
+        poller = self._poller
+        if poller is None:
+            return None
+        return poller.index.route(route_id, poller.max_age)
 
     @property
     def arrivals(self):
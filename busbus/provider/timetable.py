@@ -0,0 +1,281 @@
+"""
+Compact, memory-mapped timetables of GTFS feeds.
+
+A timetable file holds a feed's scheduled stop times as fixed-width integer
+records, grouped by stop and route and sorted by arrival time, along with a
+bitmap of the days each service runs. The arrivals at a stop on a route in a
+time window are then found with a binary search, without SQL. The file is
+mapped read-only, so processes serving the same feed share its pages.
+
+File layout (little-endian):
+    header: magic, format version, metadata offset and length, records offset
+            and count, service days offset
+    metadata: JSON -- trips, services, frequencies and the first record,
+              record count and frequency trips' records of each stop and
+              route
+    records: (arrival, departure, trip index, stop_sequence), 16 bytes each;
+             times are seconds relative to noon, as in the database
+    service days: one bit per day from the first day, a row per service
+"""
+
+from __future__ import division
+
+import bisect
+import datetime
+import errno
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'BBTT'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sIQQQQQ')
+_RECORD = struct.Struct('<iiii')
+_INT = struct.Struct('<i')
+_BYTE = struct.Struct('<B')
+
+# departure time of a record without one
+_NO_TIME = -2 ** 31
+
+
+class _Column(object):
+    """A sequence view of one field of the records, for bisect."""
+
+    def __init__(self, buf, offset, count, field):
+        self._buf = buf
+        self._offset = offset + field * _INT.size
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return _INT.unpack_from(self._buf, self._offset + i * _RECORD.size)[0]
+
+
+class Timetable(object):
+    """A timetable file opened read-only; see build_timetable."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map.size() < _HEADER.size:
+            raise ValueError('{0} is not a timetable'.format(path))
+        (magic, version, meta_offset, meta_length, self._records,
+         count, self._days) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0} is not a version {1} timetable'.format(
+                path, VERSION))
+        meta = json.loads(
+            self._map[meta_offset:meta_offset + meta_length].decode('utf-8'))
+        self._trips = meta['trips']
+        self._services = {service_id: i for i, service_id
+                          in enumerate(meta['services'])}
+        self._service_ids = meta['services']
+        self._frequencies = meta['frequencies']
+        self._pairs = meta['pairs']
+        self._first_day = meta['first_day']
+        self._num_days = meta['num_days']
+        self._row_bytes = (self._num_days + 7) // 8
+        self._arrivals = _Column(self._map, self._records, count, 0)
+
+    def close(self):
+        self._map.close()
+
+    def _stop_time(self, i):
+        arr, dep, trip, seq = _RECORD.unpack_from(
+            self._map, self._records + i * _RECORD.size)
+        trip_id, service, headsign, short_name, bikes, min_arr = (
+            self._trips[trip])
+        return {
+            'trip_id': trip_id,
+            'service_id': self._service_ids[service],
+            'trip_headsign': headsign,
+            'trip_short_name': short_name,
+            'bikes_allowed': bikes,
+            '_min_arrival_time': (datetime.timedelta(seconds=min_arr)
+                                  if min_arr is not None else None),
+            'arr': arr,
+            'departure_time': (datetime.timedelta(seconds=dep)
+                               if dep != _NO_TIME else None),
+            'stop_sequence': seq,
+        }
+
+    def stop_times(self, stop_id, route_id, start=None, end=None):
+        """
+        Yield the stop times at a stop on a route, in arrival order, with
+        start <= arrival time <= end (in seconds relative to noon) if given.
+        They are dicts like the rows of GTFSArrivalGenerator._stop_times.
+        """
+        first, count, _ = self._pair(stop_id, route_id)
+        lo, hi = first, first + count
+        if start is not None:
+            lo = bisect.bisect_left(self._arrivals, start, lo, hi)
+        if end is not None:
+            hi = bisect.bisect_right(self._arrivals, end, lo, hi)
+        for i in range(lo, hi):
+            yield self._stop_time(i)
+
+    def _pair(self, stop_id, route_id):
+        return self._pairs.get(stop_id, {}).get(route_id, (0, 0, ()))
+
+    def frequency_stop_times(self, stop_id, route_id):
+        """Yield the stop times at a stop on a route of frequency trips."""
+        for i in self._pair(stop_id, route_id)[2]:
+            yield self._stop_time(i)
+
+    def has_frequencies(self, trip_id):
+        return trip_id in self._frequencies
+
+    def frequencies(self, trip_id):
+        """
+        Return a trip's frequencies, like the rows of
+        GTFSArrivalGenerator._frequencies.
+        """
+        return [{'start_time': datetime.timedelta(seconds=start),
+                 'end_time': datetime.timedelta(seconds=end),
+                 'headway_secs': datetime.timedelta(seconds=headway)}
+                for start, end, headway in self._frequencies.get(trip_id, ())]
+
+    def runs(self, service_id, date):
+        """Whether a service runs on a date."""
+        service = self._services.get(service_id)
+        if service is None:
+            return False
+        day = date.toordinal() - self._first_day
+        if not 0 <= day < self._num_days:
+            return False
+        byte = _BYTE.unpack_from(
+            self._map, self._days + service * self._row_bytes + day // 8)[0]
+        return bool(byte & (1 << (day % 8)))
+
+
+def _service_days(conn, feed_id):
+    """
+    Return the set of days (ordinals) each service runs. This follows
+    GTFSArrivalGenerator._valid_date_filter: a day outside the service's
+    calendar range never runs.
+    """
+    days = {}
+    weekdays = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                'saturday', 'sunday')
+    for row in conn.cursor().execute(
+            'select * from calendar where _feed=?', (feed_id,)):
+        start, end = row['start_date'].toordinal(), row['end_date'].toordinal()
+        days[row['service_id']] = (start, end, set(
+            day for day in range(start, end + 1)
+            if row[weekdays[datetime.date.fromordinal(day).weekday()]]))
+    for row in conn.cursor().execute(
+            '''select service_id, date, exception_type from calendar_dates
+            where _feed=?''', (feed_id,)):
+        day = row['date'].toordinal()
+        # services only defined by calendar_dates have no range
+        start, end, running = days.setdefault(row['service_id'],
+                                              (None, None, set()))
+        if row['exception_type'] == 1 and (start is None or
+                                           start <= day <= end):
+            running.add(day)
+        elif row['exception_type'] == 2:
+            running.discard(day)
+    return {service_id: running
+            for service_id, (_, _, running) in days.items()}
+
+
+def build_timetable(conn, feed_id, path):
+    """
+    Write the timetable of a feed in the database to path. The file is
+    written under a temporary name and renamed, so that processes building
+    the same timetable at once don't see each other's partial files.
+    """
+    services = []
+    service_index = {}
+    trips = []
+    trip_index = {}
+    for row in conn.cursor().execute(
+            '''select trip_id, service_id, trip_headsign, trip_short_name,
+            bikes_allowed, cast(_min_arrival_time as integer) as min_arr
+            from trips where _feed=? order by trip_id''', (feed_id,)):
+        if row['service_id'] not in service_index:
+            service_index[row['service_id']] = len(services)
+            services.append(row['service_id'])
+        trip_index[row['trip_id']] = len(trips)
+        trips.append((row['trip_id'], service_index[row['service_id']],
+                      row['trip_headsign'], row['trip_short_name'],
+                      row['bikes_allowed'], row['min_arr']))
+
+    frequencies = {}
+    for row in conn.cursor().execute(
+            '''select trip_id, cast(start_time as integer) as start,
+            cast(end_time as integer) as end,
+            cast(headway_secs as integer) as headway from frequencies
+            where _feed=? order by start_time asc''', (feed_id,)):
+        frequencies.setdefault(row['trip_id'], []).append(
+            (row['start'], row['end'], row['headway']))
+
+    records = bytearray()
+    pairs = {}
+    count = 0
+    for row in conn.cursor().execute(
+            '''select st.stop_id, t.route_id, st.trip_id, st.stop_sequence,
+            coalesce(st.arrival_time, st._arrival_interpolate) as arr,
+            cast(st.departure_time as integer) as dep
+            from stop_times as st join trips as t
+            on st.trip_id=t.trip_id and st._feed=t._feed
+            where st._feed=? and
+            coalesce(st.arrival_time, st._arrival_interpolate) is not null
+            order by st.stop_id, t.route_id, arr, st.trip_id''', (feed_id,)):
+        # first record, record count and records of frequency trips
+        pair = pairs.setdefault(row['stop_id'], {}).setdefault(
+            row['route_id'], [count, 0, []])
+        pair[1] += 1
+        if row['trip_id'] in frequencies:
+            pair[2].append(count)
+        dep = row['dep'] if row['dep'] is not None else _NO_TIME
+        records += _RECORD.pack(row['arr'], dep, trip_index[row['trip_id']],
+                                row['stop_sequence'])
+        count += 1
+
+    running = _service_days(conn, feed_id)
+    all_days = [day for days in running.values() for day in days]
+    first_day = min(all_days) if all_days else 0
+    num_days = max(all_days) - first_day + 1 if all_days else 0
+    row_bytes = (num_days + 7) // 8
+    days = bytearray(row_bytes * len(services))
+    for i, service_id in enumerate(services):
+        for day in running.get(service_id, ()):
+            day -= first_day
+            days[i * row_bytes + day // 8] |= 1 << (day % 8)
+
+    meta = json.dumps({
+        'trips': trips,
+        'services': services,
+        'frequencies': frequencies,
+        'pairs': pairs,
+        'first_day': first_day,
+        'num_days': num_days,
+    }).encode('utf-8')
+    meta_offset = _HEADER.size
+    # align the records for the page cache's sake
+    records_offset = (meta_offset + len(meta) + 15) // 16 * 16
+    days_offset = records_offset + len(records)
+    header = _HEADER.pack(MAGIC, VERSION, meta_offset, len(meta),
+                          records_offset, count, days_offset)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(meta)
+            f.write(b'\0' * (records_offset - meta_offset - len(meta)))
+            f.write(records)
+            f.write(days)
+        os.rename(tmp_path, path)
+    except OSError as exc:
+        os.remove(tmp_path)
+        # another process finished the same timetable first (Windows)
+        if exc.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,186 @@
+from busbus.queryable import Queryable
+
+import arrow
+import collections
+import datetime
+import threading
+
+
+def _arrival_key(arrival):
+    return (arrival.provider.id, arrival.route.id, arrival.stop.id,
+            arrival._trip_id)
+
+
+def _arrival_state(arrival):
+    return (arrival.time, arrival.departure_time, arrival.realtime,
+            arrival.headsign, arrival.short_name, arrival.bikes_ok)
+
+
+def _alert_key(alert):
+    return (alert.provider.id, alert.id)
+
+
+def _alert_state(alert):
+    return (alert.text,)
+
+
+class Subscription(object):
+    """
+    A standing query of an engine's arrivals or alerts (see
+    Engine.subscribe). Whenever its results change, callback(added, changed,
+    removed) is called with lists of entities; changed holds the new versions
+    of the entities and removed the last versions.
+
+    Arrivals are kept for a window from now to horizon seconds ahead. When
+    the window moves (Engine.advance), the arrivals that have passed are
+    removed and only the part of the window that is new is queried. When a
+    provider's data changes (ProviderBase._updated), only that provider's
+    arrivals -- or only those on the routes it says changed -- are queried
+    again and compared.
+    """
+
+    def __init__(self, engine, entity, callback, horizon=3600, **kwargs):
+        if entity not in ('arrivals', 'alerts'):
+            raise ValueError('cannot subscribe to {0}'.format(entity))
+        self.engine = engine
+        self.entity = entity
+        self.callback = callback
+        self.horizon = datetime.timedelta(seconds=horizon)
+        self.kwargs = kwargs
+        self.active = True
+        self.start = self.end = None
+        self._timed = entity == 'arrivals'
+        if self._timed:
+            self._key, self._state = _arrival_key, _arrival_state
+        else:
+            self._key, self._state = _alert_key, _alert_state
+        # {key: [entity, ...]}, in time order; an arrival's key (its trip,
+        # stop and route) isn't unique when its trip runs more than once in
+        # the window, so entities with the same key are matched up in order
+        self._entries = {}
+        # held while the callback runs, so that the callback and code
+        # iterating over the subscription under it see consistent results;
+        # reentrant, as querying a provider may make it report an update
+        self.lock = threading.RLock()
+
+    def __iter__(self):
+        with self.lock:
+            entities = [e for es in self._entries.values() for e in es]
+        if self._timed:
+            entities.sort()
+        return iter(entities)
+
+    def cancel(self):
+        self.active = False
+        self.engine._unsubscribe(self)
+
+    def _route_id(self):
+        if 'route' in self.kwargs:
+            return self.kwargs['route'].id
+        return self.kwargs.get('route.id')
+
+    def _query(self, provider, route_id=None, start=None):
+        kwargs = dict(self.kwargs)
+        if route_id is not None:
+            kwargs['route.id'] = route_id
+        if not self._timed:
+            return list(Queryable(provider.alerts).where(**kwargs))
+        kwargs.update(start_time=start or self.start, end_time=self.end)
+        return list(provider.arrivals.where(**kwargs))
+
+    def _replace(self, keys, entities):
+        """
+        Replace the entries with the given keys by entities (in time order)
+        and return the lists of added, changed and removed entities.
+        """
+        grouped = collections.defaultdict(list)
+        for entity in entities:
+            grouped[self._key(entity)].append(entity)
+        added, changed, removed = [], [], []
+        for key in set(keys) | set(grouped):
+            old = self._entries.pop(key, [])
+            new = grouped.get(key, [])
+            changed.extend(n for o, n in zip(old, new)
+                           if self._state(o) != self._state(n))
+            added.extend(new[len(old):])
+            removed.extend(old[len(new):])
+            if new:
+                self._entries[key] = new
+        return added, changed, removed
+
+    def _notify(self, added, changed, removed):
+        if self.active and (added or changed or removed):
+            if self._timed:
+                for arrivals in (added, changed, removed):
+                    arrivals.sort()
+            self.callback(added, changed, removed)
+
+    def _move_window(self, now):
+        now = arrow.now() if now is None else arrow.get(now)
+        self.start, self.end = now, now + self.horizon
+
+    def refresh(self, now=None):
+        """Query every ready provider again."""
+        with self.lock:
+            if now is not None or self.start is None:
+                self._move_window(now)
+            entities = []
+            for provider in self.engine._ready_providers():
+                entities.extend(self._query(provider))
+            self._notify(*self._replace(list(self._entries), entities))
+
+    def advance(self, now=None):
+        """Move the window to start at now (the current time by default)."""
+        now = arrow.now() if now is None else arrow.get(now)
+        with self.lock:
+            if not self._timed or self.start is None or now < self.start:
+                # there's no earlier window to build on
+                return self.refresh(now)
+            old_end = self.end
+            self._move_window(now)
+
+            removed = []
+            for key, arrivals in list(self._entries.items()):
+                passed = [a for a in arrivals if a.time < self.start]
+                if passed:
+                    removed.extend(passed)
+                    del arrivals[:len(passed)]
+                    if not arrivals:
+                        del self._entries[key]
+
+            added = []
+            if self.end > old_end:
+                start = max(self.start, old_end)
+                for provider in self.engine._ready_providers():
+                    for arrival in self._query(provider, start=start):
+                        # those at the old end of the window are known
+                        if arrival.time > old_end:
+                            self._entries.setdefault(
+                                self._key(arrival), []).append(arrival)
+                            added.append(arrival)
+            self._notify(added, [], removed)
+
+    def update(self, provider, route_ids=None):
+        """
+        Query a provider again, or only the given routes of it, and report
+        the differences.
+        """
+        with self.lock:
+            if not self.active or self.start is None:
+                return
+            route_id = self._route_id()
+            if not self._timed or route_ids is None or route_id is not None:
+                if route_id is not None and route_ids is not None and (
+                        route_id not in route_ids):
+                    return
+                keys = [k for k in self._entries if k[0] == provider.id]
+                entities = self._query(provider) if provider.ready else []
+            else:
+                route_ids = set(route_ids)
+                keys = [k for k in self._entries
+                        if k[0] == provider.id and k[1] in route_ids]
+                entities = []
+                if provider.ready:
+                    for route_id in route_ids:
+                        entities.extend(self._query(provider, route_id))
+            self._notify(*self._replace(keys, entities))
@@ -1,10 +1,14 @@
 from abc import ABCMeta, abstractmethod
+import apsw
 import collections
-from datetime import datetime, timedelta
+import hashlib
+import json
 import math
 import os
 import requests
 import six
+import sys
+import threading
 import time
 
 import busbus.entity
@@ -43,6 +47,52 @@ class Config(collections.defaultdict):
             return os.path.join(self['busbus_dir'], 'cache')
         elif key == 'gtfs_db_path':
             return os.path.join(self['busbus_dir'], 'gtfs.sqlite3')
+        elif key == 'gtfs_db_dir':
+            # if set, each GTFS feed is stored in its own database file in
+            # this directory instead of all of them in gtfs_db_path
+            return None
+        elif key == 'web_cache_size':
+            # bytes of serialized responses kept by busbus.web.Engine
+            return 64 * 1024 * 1024
+        elif key == 'web_stream_cache_max':
+            # bytes of a streamed response that busbus.web.Engine buffers for
+            # its cache; longer responses are streamed without being cached
+            return 1024 * 1024
+        elif key == 'web_arrivals_ttl':
+            # seconds a cached arrivals or alerts response stays fresh
+            return 15
+        elif key == 'web_coalesce_timeout':
+            # seconds a request waits for an identical request in progress
+            # before building its own response
+            return 30
+        elif key == 'rate_limit_db_path':
+            # SQLite database for sharing realtime API rate limits and
+            # responses between processes (see RateLimitRequests)
+            return None
+        elif key == 'gtfs_timetable_dir':
+            # if set, GTFS providers answer scheduled arrivals from timetable
+            # files in this directory (see busbus.provider.timetable)
+            return None
+        elif key == 'snapshot_dir':
+            # if set, providers keep their static entities in memory and
+            # snapshot them in this directory, for fast start-up
+            return None
+        elif key == 'web_live_interval':
+            # seconds between moving the windows of busbus.web.Engine's live
+            # boards forward (and between keep-alives to idle clients)
+            return 15
+        elif key == 'web_admin':
+            # serve statistics (e.g. /admin/statements) from busbus.web.Engine
+            return False
+        elif key == 'profiling':
+            # time busbus's hot paths for the whole process (see
+            # busbus.util.profiling); busbus.web.Engine then serves the
+            # totals at /admin/profile and a breakdown with _timing
+            return False
+        elif key == 'background_init':
+            # load provider data (e.g. GTFS feeds) in background threads so
+            # that constructing a provider returns immediately
+            return False
         else:
             raise KeyError(key)
 
@@ -52,31 +102,313 @@ class RateLimitRequests(requests.Session):
     requests.Session subclass that implements rate limiting, both for all
     requests on this session as well as separate rate limits for each
     individual request.
+
+    It can be shared between threads: identical requests made at the same
+    time result in a single request, and requests on the session are spaced
+    at least interval seconds apart. Responses are kept for url_interval
+    seconds in an LRU cache of cache_size entries.
+
+    If shared_path is given, the rate limits and cached responses are also
+    shared (through a SQLite database at that path) with every other
+    RateLimitRequests using the same path, including in other processes.
     """
 
-    def __init__(self, interval=0, url_interval=0):
-        self._cache = {}
-        self._last_request = datetime.min
-        self._interval = timedelta(seconds=interval)
-        self._url_interval = timedelta(seconds=url_interval)
+    def __init__(self, interval=0, url_interval=0, cache_size=256,
+                 shared_path=None):
+        self._interval = interval
+        self._url_interval = url_interval
+        self._cache = LRUCache(cache_size, ttl=url_interval)
+        self._shared = (None if shared_path is None
+                        else SharedRequestCache(shared_path))
+        self._last_request = 0
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
 
         super(RateLimitRequests, self).__init__()
 
     def request(self, *args, **kwargs):
         key = freezehash((args, kwargs))
-        if key in self._cache:
-            t, resp = self._cache[key]
-            if datetime.now() - t <= self._url_interval:
+        resp = self._cache.get(key)
+        if resp is not None:
+            return resp
+        return self._flights.do(key, self._request, key, *args, **kwargs)
+
+    def _request(self, key, *args, **kwargs):
+        if self._shared is not None:
+            shared_key = stablehash((args, kwargs))
+            resp, ttl = self._shared.get(shared_key)
+            if resp is not None:
+                self._cache.set(key, resp, ttl)
                 return resp
-        time.sleep(max((self._last_request + self._interval -
-                        datetime.now()).total_seconds(), 0))
+            wait = self._shared.reserve(self._interval)
+        else:
+            with self._lock:
+                # reserve the next slot, then wait for it outside the lock
+                now = time.time()
+                slot = max(self._last_request + self._interval, now)
+                self._last_request = slot
+            wait = slot - now
+        time.sleep(wait)
+
         resp = super(RateLimitRequests, self).request(*args, **kwargs)
-        t = datetime.now()
-        self._cache[key] = (t, resp)
-        self._last_request = t
+        if self._url_interval > 0:
+            self._cache.set(key, resp)
+            if self._shared is not None:
+                self._shared.set(shared_key, resp, self._url_interval)
+        with self._lock:
+            self._last_request = max(self._last_request, time.time())
         return resp
 
 
+class SharedRequestCache(object):
+    """
+    Responses and the time of the next allowed request for RateLimitRequests,
+    kept in a SQLite database so that several processes can share them.
+
+    Only plain data is stored (each response's status code, URL, headers and
+    body), so that whoever can write to the database can't make its readers
+    run code.
+    """
+
+    def __init__(self, path):
+        self.conn = apsw.Connection(path)
+        self.conn.setbusytimeout(10000)
+        self._lock = threading.Lock()
+        self.conn.cursor().execute(
+            """create table if not exists response_data (
+                key text primary key, expires real, status integer,
+                url text, headers text, content blob);
+            create table if not exists clock (id integer primary key,
+                next real)""")
+
+    def _transaction(self, func, *args):
+        # begin immediate takes the write lock up front, so that concurrent
+        # read-modify-writes from other processes wait rather than fail
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute('begin immediate')
+            try:
+                result = func(cur, *args)
+            except BaseException:
+                cur.execute('rollback')
+                raise
+            cur.execute('commit')
+            return result
+
+    def get(self, key):
+        """
+        Return (response, seconds until it expires), or (None, None) if there
+        is no current response for key.
+        """
+        with self._lock:
+            rows = list(self.conn.cursor().execute(
+                'select expires, status, url, headers, content '
+                'from response_data where key=?', (key,)))
+        now = time.time()
+        if not rows or rows[0][0] <= now:
+            return None, None
+        expires, status, url, headers, content = rows[0]
+        resp = requests.Response()
+        resp.status_code = status
+        resp.url = url
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            json.loads(headers))
+        resp.encoding = requests.utils.get_encoding_from_headers(
+            resp.headers)
+        resp._content = bytes(content)
+        return resp, expires - now
+
+    def set(self, key, response, ttl):
+        row = (response.status_code, response.url,
+               json.dumps(dict(response.headers)), response.content)
+
+        def _store(cur):
+            now = time.time()
+            cur.execute('delete from response_data where expires<=?',
+                        (now,))
+            cur.execute('insert or replace into response_data '
+                        'values (?, ?, ?, ?, ?, ?)', (key, now + ttl) + row)
+        self._transaction(_store)
+
+    def reserve(self, interval):
+        """
+        Reserve the next request slot, at least interval seconds after the
+        previous one made by any user of the database, and return how many
+        seconds to wait for it.
+        """
+        def reserve(cur):
+            now = time.time()
+            rows = list(cur.execute('select next from clock where id=0'))
+            slot = max(rows[0][0], now) if rows else now
+            cur.execute('insert or replace into clock values (0, ?)',
+                        (slot + interval,))
+            return slot - now
+        return self._transaction(reserve)
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache that evicts the least recently used entries once the
+    total size of its values exceeds maxsize, and drops entries older than
+    their time-to-live (in seconds; None means they never expire).
+
+    Each value counts as 1 towards maxsize unless a getsizeof function is
+    given. Values larger than maxsize are never stored.
+    """
+
+    def __init__(self, maxsize, ttl=None, getsizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.getsizeof = getsizeof or (lambda value: 1)
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, size, expires = self._data.pop(key)
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (value, size, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        size = self.getsizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.maxsize:
+                return
+            self._data[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, old_size, _) = self._data.popitem(last=False)
+                self.size -= old_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value, size, _ = self._data.pop(key)
+        self.size -= size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent work on the same key.
+
+    The first caller to acquire() a key is its leader, and must release() it
+    with the result (or the exception it raised). Callers that acquire the key
+    while the leader is working get the same call object and wait() on it for
+    that result instead of repeating the work.
+
+    stats counts the calls that did the work ('leaders') and those that were
+    coalesced into another ('coalesced').
+    """
+
+    class Call(object):
+
+        def __init__(self):
+            self.result = None
+            self.exc_info = None
+            self._done = threading.Event()
+
+        def wait(self, timeout=None):
+            """
+            Return the leader's result, or None if it hasn't released the key
+            within timeout seconds.
+            """
+            if not self._done.wait(timeout):
+                return None
+            if self.exc_info is not None:
+                six.reraise(*self.exc_info)
+            return self.result
+
+    def __init__(self):
+        self.stats = collections.Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Returns a (call, is_leader) tuple."""
+        with self._lock:
+            if key in self._calls:
+                self.stats['coalesced'] += 1
+                return self._calls[key], False
+            call = self._calls[key] = SingleFlight.Call()
+            self.stats['leaders'] += 1
+            return call, True
+
+    def release(self, key, result=None, exc_info=None):
+        with self._lock:
+            call = self._calls.pop(key)
+        call.result = result
+        call.exc_info = exc_info
+        call._done.set()
+
+    def do(self, key, func, *args, **kwargs):
+        call, leader = self.acquire(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            self.release(key, exc_info=sys.exc_info())
+            raise
+        self.release(key, result)
+        return result
+
+
+class StatementStats(object):
+    """
+    Number of executions, total time spent in SQLite (in seconds) and number
+    of rows returned for each SQL statement. It can be updated from several
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # sql -> [count, time, rows]
+
+    def record(self, sql, seconds, rows):
+        with self._lock:
+            stat = self._stats.get(sql)
+            if stat is None:
+                stat = self._stats[sql] = [0, 0.0, 0]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] += rows
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def statements(self):
+        """Return the statistics of each statement, most total time first."""
+        with self._lock:
+            stats = [{'sql': sql, 'count': count, 'time': seconds,
+                      'rows': rows}
+                     for sql, (count, seconds, rows) in self._stats.items()]
+        return sorted(stats, key=lambda s: s['time'], reverse=True)
+
+
 def entity_type(obj):
     """Return the type just above BaseEntity in method resolution order."""
     if not isinstance(obj, type):
@@ -96,6 +428,24 @@ def clsname(obj):
     return '{0}.{1}'.format(type(obj).__module__, type(obj).__name__)
 
 
+def stablehash(obj):
+    """
+    Like freezehash, but the same in every process (hash() of a string is
+    randomized per process on Python 3). Only dicts and sets are unordered;
+    the order of tuples and lists (e.g. positional arguments) matters.
+    """
+    def freeze(obj):
+        if isinstance(obj, (dict, collections.Mapping)):
+            return sorted(((k, freeze(v)) for k, v in obj.items()), key=repr)
+        elif isinstance(obj, (set, frozenset)):
+            return sorted((freeze(x) for x in obj), key=repr)
+        elif isinstance(obj, (tuple, list)):
+            return [freeze(x) for x in obj]
+        else:
+            return obj
+    return hashlib.sha1(repr(freeze(obj)).encode('utf-8')).hexdigest()
+
+
 def freezehash(obj):
     if isinstance(obj, (dict, collections.Mapping)):
         return hash(frozenset((k, freezehash(v)) for k, v in obj.items()))
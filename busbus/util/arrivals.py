@@ -1,6 +1,7 @@
 import busbus
 from busbus.queryable import Queryable
 from busbus import util
+from busbus.util import profiling
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 import arrow
@@ -94,9 +95,9 @@ class ArrivalQueryable(Queryable):
         start = kwargs.pop('start_time', None)
         end = kwargs.pop('end_time', None)
 
-        it = heapq.merge(*[gen(provider, stops, routes, start, end)
-                           for gen in self.arrival_gens
-                           if gen.realtime == realtime])
+        it = profiling.timed('arrivals.merge', heapq.merge(
+            *[gen(provider, stops, routes, start, end)
+              for gen in self.arrival_gens if gen.realtime == realtime]))
         super(ArrivalQueryable, self).__init__(it, query_funcs, **kwargs)
 
     def _new(self, query_funcs, kwargs):
@@ -0,0 +1,221 @@
+"""
+Span timers and counters for busbus's hot paths: SQL statements, arrival
+generation and merging, realtime API calls and JSON encoding.
+
+Instrumentation does nothing unless a Registry is active, either for the
+whole process (enable) or for the current thread (record, e.g. for one web
+request). Spans are named with dotted names like 'gtfs.stop_times'. For each
+span name a registry keeps the number of spans, their total time and their
+self time (the total minus the time spent in spans nested in them), so that
+the self times of a request add up to the time spent in instrumented code.
+"""
+
+import contextlib
+import threading
+import timeit
+
+timer = timeit.default_timer
+
+_registry = None
+_local = threading.local()
+
+
+class Registry(object):
+    """
+    Span and counter totals by name. It can be updated from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}  # name -> [count, time, self time]
+        self._counters = {}
+
+    def add(self, name, seconds, self_seconds=None, count=1):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = [0, 0.0, 0.0]
+            span[0] += count
+            span[1] += seconds
+            span[2] += seconds if self_seconds is None else self_seconds
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+            self._counters.clear()
+
+    def export(self):
+        """Return the totals as a JSON-compatible dict."""
+        with self._lock:
+            return {
+                'spans': {name: {'count': count, 'time': seconds,
+                                 'self_time': self_seconds}
+                          for name, (count, seconds, self_seconds)
+                          in self._spans.items()},
+                'counters': dict(self._counters),
+            }
+
+
+def enable(registry=None):
+    """Record every thread's spans in registry (a new one by default)."""
+    global _registry
+    _registry = Registry() if registry is None else registry
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def registry():
+    """The registry set with enable, or None."""
+    return _registry
+
+
+@contextlib.contextmanager
+def record(registry=None):
+    """
+    Also record the current thread's spans in registry (a new one by
+    default) within the with block, which gives the registry.
+    """
+    registry = Registry() if registry is None else registry
+    previous = getattr(_local, 'registry', None)
+    _local.registry = registry
+    try:
+        yield registry
+    finally:
+        _local.registry = previous
+
+
+def bind(func):
+    """
+    Wrap func so that, when run on another thread (e.g. in a thread pool), it
+    records into the calling thread's registry as well.
+    """
+    registry = getattr(_local, 'registry', None)
+    if registry is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with record(registry):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _registries():
+    local = getattr(_local, 'registry', None)
+    if local is None:
+        return () if _registry is None else (_registry,)
+    return (local,) if _registry is None else (_registry, local)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _pop(stack, frame):
+    # a span left open across a yield can be under a later span's frame
+    if stack[-1] is frame:
+        stack.pop()
+    else:
+        stack.remove(frame)
+
+
+class _Frame(object):
+    __slots__ = ('child',)
+
+    def __init__(self):
+        self.child = 0.0
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, name, registries):
+        self.name = name
+        self.registries = registries
+        self.frame = _Frame()
+
+    def __enter__(self):
+        self.stack = _stack()
+        self.stack.append(self.frame)
+        self.start = timer()
+
+    def __exit__(self, *exc_info):
+        elapsed = timer() - self.start
+        _pop(self.stack, self.frame)
+        if self.stack:
+            self.stack[-1].child += elapsed
+        for registry in self.registries:
+            registry.add(self.name, elapsed, elapsed - self.frame.child)
+
+
+def span(name):
+    """Return a context manager timing its block as a span."""
+    registries = _registries()
+    if not registries:
+        return _null_span
+    return _Span(name, registries)
+
+
+def timed(name, iterable):
+    """
+    Return an iterator over iterable that counts the time spent getting its
+    items as one span, recorded when it's exhausted or closed. Without an
+    active registry, iterable itself is returned.
+    """
+    registries = _registries()
+    if not registries:
+        return iterable
+    return _timed(name, iter(iterable), registries)
+
+
+def _timed(name, it, registries):
+    frame = _Frame()
+    seconds = self_seconds = 0.0
+    try:
+        while True:
+            stack = _stack()
+            stack.append(frame)
+            frame.child = 0.0
+            start = timer()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed = timer() - start
+                _pop(stack, frame)
+                if stack:
+                    stack[-1].child += elapsed
+                seconds += elapsed
+                self_seconds += elapsed - frame.child
+            yield item
+    finally:
+        for registry in registries:
+            registry.add(name, seconds, self_seconds)
+
+
+def incr(name, n=1):
+    """Add n to a counter."""
+    for registry in _registries():
+        registry.incr(name, n)
@@ -0,0 +1,115 @@
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class PredictionIndex(object):
+    """
+    Thread-safe index of realtime predictions keyed by (stop id, route id,
+    trip id).
+
+    Predictions are replaced a route at a time, so that readers always see
+    one complete refresh of a route.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(trips) for _, by_stop in self._routes.values()
+                       for trips in by_stop.values())
+
+    def update(self, route_id, predictions):
+        """
+        Replace the predictions for a route with an iterable of
+        (stop_id, trip_id, prediction) tuples.
+        """
+        by_stop = collections.defaultdict(dict)
+        for stop_id, trip_id, prediction in predictions:
+            by_stop[stop_id][trip_id] = prediction
+        with self._lock:
+            self._routes[route_id] = (time.time(), dict(by_stop))
+
+    def route(self, route_id, max_age=None):
+        """
+        Return the predictions for a route as a {stop_id: {trip_id:
+        prediction}} dict, or None if the route has not been indexed (or was
+        last updated more than max_age seconds ago).
+
+        The returned dict is never modified by the index and must not be
+        modified by the caller.
+        """
+        with self._lock:
+            entry = self._routes.get(route_id)
+        if entry is None:
+            return None
+        updated, by_stop = entry
+        if max_age is not None and time.time() - updated > max_age:
+            return None
+        return by_stop
+
+    def get(self, stop_id, route_id, trip_id, default=None):
+        by_stop = self.route(route_id)
+        if by_stop is None:
+            return default
+        return by_stop.get(stop_id, {}).get(trip_id, default)
+
+
+class RealtimePoller(threading.Thread):
+    """
+    Daemon thread that refreshes a PredictionIndex every interval seconds.
+
+    For each of its keys (e.g. route ids), fetch(key) is called and should
+    return an iterable of (stop_id, trip_id, prediction) tuples, or None if
+    no data is available right now, in which case the key's previous
+    predictions are kept until they are too old to use.
+
+    If given, on_update(keys) is called after each refresh with the keys
+    whose predictions were replaced.
+    """
+
+    def __init__(self, fetch, keys, interval, index=None, on_update=None):
+        super(RealtimePoller, self).__init__()
+        self.daemon = True
+        self.fetch = fetch
+        self.on_update = on_update
+        self.keys = list(keys)
+        self.interval = interval
+        self.index = PredictionIndex() if index is None else index
+        self._stopped = threading.Event()
+
+    @property
+    def max_age(self):
+        """How old predictions may be before readers stop using them."""
+        return 3 * self.interval
+
+    def poll(self):
+        updated = []
+        for key in self.keys:
+            try:
+                predictions = self.fetch(key)
+                if predictions is not None:
+                    self.index.update(key, predictions)
+                    updated.append(key)
+            except Exception:
+                # a failed refresh (e.g. a network error) shouldn't stop the
+                # poller; the key's predictions simply age out
+                log.exception('realtime fetch failed for %r', key)
+        if updated and self.on_update is not None:
+            try:
+                self.on_update(updated)
+            except Exception:
+                log.exception('realtime update callback failed')
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.poll()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
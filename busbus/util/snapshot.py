@@ -0,0 +1,64 @@
+"""
+Versioned snapshot files, for state that is expensive to rebuild on every
+start-up but never changes for a given key (e.g. a feed's hash).
+
+A snapshot is a header (magic, format version, key length), the key and the
+data as JSON, so only plain data (dicts, lists, strings, numbers, booleans
+and None) can be snapshotted, and reading one never runs code. Reading a
+snapshot with a different format version or key returns None, so that the
+caller rebuilds and rewrites it.
+"""
+
+import errno
+import json
+import os
+import struct
+import tempfile
+
+MAGIC = b'BBSNAP'
+VERSION = 2
+
+_HEADER = struct.Struct('<6sHI')
+
+
+def read(path, key):
+    """Return the data of the snapshot at path, or None if it's not usable."""
+    try:
+        with open(path, 'rb') as f:
+            blob = f.read()
+    except (IOError, OSError):
+        return None
+    if len(blob) < _HEADER.size:
+        return None
+    magic, version, key_length = _HEADER.unpack_from(blob)
+    start = _HEADER.size + key_length
+    if (magic != MAGIC or version != VERSION or
+            blob[_HEADER.size:start] != key.encode('utf-8')):
+        return None
+    try:
+        return json.loads(blob[start:].decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def write(path, key, data):
+    """
+    Write a snapshot to path. It's written under a temporary name and
+    renamed, so that readers never see a partial snapshot.
+    """
+    key = key.encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, len(key)))
+            f.write(key)
+            # sorted, so that the same data always gives the same file
+            f.write(json.dumps(data, separators=(',', ':'),
+                               sort_keys=True).encode('utf-8'))
+        os.rename(tmp_path, path)
+    except OSError as exc:
+        os.remove(tmp_path)
+        # another process wrote the same snapshot first (Windows)
+        if exc.errno != errno.EEXIST:
+            raise
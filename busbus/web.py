@@ -1,17 +1,52 @@
 import busbus
-from busbus.entity import BaseEntityJSONEncoder
+from busbus.entity import (BaseEntity, BaseEntityJSONEncoder, EncodedList,
+                           StreamingJSONEncoder)
 from busbus.provider import ProviderBase
 from busbus.queryable import Queryable
+from busbus import util
+from busbus.util import profiling
 
+import arrow
+import base64
+import binascii
 import cherrypy
+from cherrypy.lib import cptools
 import collections
+import functools
+import hashlib
 import itertools
+import json
+import json.encoder
+import logging
+import six
+from six.moves import queue
+import sys
+import threading
+import time
 import types
 
+encode_string = (json.encoder.c_encode_basestring_ascii or
+                 json.encoder.encode_basestring_ascii)
+
+
+def encode_json(value):
+    if cherrypy.serving.response.stream:
+        # With response.stream enabled in the CherryPy config, send the
+        # envelope and then each entity as the Queryable produces it instead
+        # of building the whole document in memory first.
+        return profiling.timed('web.json', (
+            chunk.encode('utf-8')
+            for chunk in StreamingJSONEncoder().stream(value)))
+    with profiling.span('web.json'):
+        return ''.join(StreamingJSONEncoder().stream(value)).encode('utf-8')
+
 
 def json_handler(*args, **kwargs):
     value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
-    return BaseEntityJSONEncoder().encode(value).encode('utf-8')
+    if isinstance(value, dict):
+        return encode_json(value)
+    # already encoded (e.g. a cached response)
+    return value
 cherrypy.config['tools.json_out.handler'] = json_handler
 
 
@@ -46,6 +81,103 @@ def unexpand(obj, to_expand):
     return obj
 
 
+def _encode_float(value):
+    if value != value or value in (float('inf'), float('-inf')):
+        return BaseEntityJSONEncoder().encode(value)
+    return repr(value)
+
+
+# JSON for values of exactly these types, as json.JSONEncoder would write it
+_PRIMITIVE_ENCODERS = {
+    type(None): lambda value: 'null',
+    bool: lambda value: 'true' if value else 'false',
+    float: _encode_float,
+}
+for _t in six.string_types + (six.text_type,):
+    _PRIMITIVE_ENCODERS[_t] = encode_string
+for _t in six.integer_types:
+    _PRIMITIVE_ENCODERS[_t] = str
+
+
+class Serializer(object):
+    """
+    Writes entities as JSON for one set of expanded entity types.
+
+    The output is identical to encoding the result of unexpand_init() with
+    BaseEntityJSONEncoder, but entities are written straight from their
+    attributes: the attribute list of each entity class is worked out once,
+    and no intermediate dicts or generators are built.
+
+    Use serializer_for() to get the (shared) instance for an _expand set.
+    """
+
+    def __init__(self, to_expand):
+        self.to_expand = frozenset(to_expand)
+        self._expanded = tuple(cls for name, cls in EXPAND_TYPES.items()
+                               if name in self.to_expand)
+        self._unexpanded = tuple(cls for name, cls in EXPAND_TYPES.items()
+                                 if name not in self.to_expand)
+        self._fields = {}
+        self._encoder = BaseEntityJSONEncoder()
+
+    def encode_all(self, result):
+        """Encode each item of result, like unexpand_init()."""
+        return EncodedList(six.moves.map(self.encode_item, result))
+
+    def encode_item(self, obj):
+        if isinstance(obj, BaseEntity):
+            return self._encode_entity(obj)
+        return self._encode_dict(dict(obj))
+
+    def encode_value(self, value):
+        """Encode a value nested within an item, like unexpand()."""
+        primitive = _PRIMITIVE_ENCODERS.get(type(value))
+        if primitive is not None:
+            return primitive(value)
+        elif isinstance(value, self._unexpanded):
+            return '{"id": ' + self.encode_value(value.id) + '}'
+        elif isinstance(value, self._expanded):
+            return self.encode_item(value)
+        elif isinstance(value, dict):
+            return self._encode_dict(value)
+        elif isinstance(value, (list, tuple, collections.Iterator)):
+            return '[' + ', '.join(self.encode_value(x) for x in value) + ']'
+        elif isinstance(value, arrow.Arrow):
+            return self.encode_value(value.timestamp)
+        return self._encoder.encode(value)
+
+    def _compile(self, cls):
+        fields = tuple((attr, encode_string(attr) + ': ')
+                       for attr in cls.__attrs__)
+        self._fields[cls] = fields
+        return fields
+
+    def _encode_entity(self, obj):
+        fields = self._fields.get(type(obj)) or self._compile(type(obj))
+        parts = ['"provider": ' + self.encode_value(obj.provider)]
+        for attr, prefix in fields:
+            value = getattr(obj, attr, None)
+            if value is not None:
+                parts.append(prefix + self.encode_value(value))
+        return '{' + ', '.join(parts) + '}'
+
+    def _encode_dict(self, obj):
+        if not all(isinstance(k, six.string_types) for k in obj):
+            return self._encoder.encode(unexpand(obj, self.to_expand))
+        return '{' + ', '.join(encode_string(k) + ': ' + self.encode_value(v)
+                               for k, v in obj.items()) + '}'
+
+
+_serializers = {}
+
+
+def serializer_for(to_expand):
+    to_expand = frozenset(to_expand)
+    if to_expand not in _serializers:
+        _serializers[to_expand] = Serializer(to_expand)
+    return _serializers[to_expand]
+
+
 class APIError(Exception):
 
     def __init__(self, msg, error_code=500):
@@ -61,8 +193,100 @@ class EndpointNotFoundError(APIError):
                 entity + '/' + action if action else entity), 404)
 
 
+class LiveBoard(object):
+    """
+    A subscription shared by the clients of busbus.web.Engine.live that make
+    the same query. Each change is encoded once, as a Server-Sent Event, and
+    queued for every client.
+    """
+
+    def __init__(self, engine, entity, kwargs, to_expand, horizon,
+                 max_queue=0):
+        self.entity = entity
+        self.max_queue = max_queue
+        self.serializer = serializer_for(to_expand)
+        self.clients = []
+        # failures in a row to move the subscription's window forward
+        self.failures = 0
+        self.subscription = engine.subscribe(entity, self._changed, horizon,
+                                             **kwargs)
+
+    def _event(self, name, **lists):
+        data = ', '.join(
+            '{0}: [{1}]'.format(encode_string(k), ', '.join(
+                self.serializer.encode_item(e) for e in v))
+            for k, v in sorted(lists.items()))
+        return 'event: {0}\ndata: {{{1}}}\n\n'.format(name, data).encode(
+            'utf-8')
+
+    def _changed(self, added, changed, removed):
+        if self.clients:
+            self._send(self._event('delta', added=added, changed=changed,
+                                   removed=removed))
+
+    def _send(self, event):
+        for client in list(self.clients):
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # the client isn't keeping up; end its stream rather than
+                # queue without bound (an EventSource reconnects and gets a
+                # new snapshot)
+                self.clients.remove(client)
+                try:
+                    while True:
+                        client.get_nowait()
+                except queue.Empty:
+                    pass
+                client.put_nowait(None)
+
+    def error(self, message):
+        """Send an error event to every client."""
+        data = '{{"error": {0}, "failures": {1}}}'.format(
+            encode_string(message), self.failures)
+        with self.subscription.lock:
+            self._send('event: error\ndata: {0}\n\n'.format(data).encode(
+                'utf-8'))
+
+    def attach(self):
+        """
+        Return a new client's queue of events, starting with a snapshot. None
+        is queued if the client is dropped for falling behind.
+        """
+        client = queue.Queue(self.max_queue)
+        with self.subscription.lock:
+            client.put(self._event('snapshot', **{
+                self.entity: list(self.subscription)}))
+            self.clients.append(client)
+        return client
+
+    def detach(self, client):
+        """Stop queueing events for a client; return whether any are left."""
+        with self.subscription.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            return bool(self.clients)
+
+
 class Engine(busbus.Engine):
 
+    # entities that depend on the current time or realtime data; responses
+    # for these are only cached for config['web_arrivals_ttl'] seconds
+    _realtime_entities = ('arrivals', 'alerts')
+
+    # entities that can be paged through with _cursor (an empty _cursor asks
+    # for the first page); _limit alone just cuts the results short
+    _pageable_entities = ('agencies', 'stops', 'routes', 'arrivals')
+
+    # failures in a row to update a live board after which its clients get
+    # an error event (and after every further this many, the failure is
+    # logged again)
+    _live_max_failures = 3
+
+    # events queued for a live board's client before it's dropped for not
+    # reading them
+    _live_max_queue = 100
+
     def __init__(self, *args, **kwargs):
         # perhaps fix this to use a decorator somehow?
         self._entity_actions = {
@@ -71,6 +295,16 @@ class Engine(busbus.Engine):
         }
         super(Engine, self).__init__(*args, **kwargs)
 
+        self._response_cache = util.LRUCache(
+            self.config['web_cache_size'],
+            getsizeof=lambda entry: len(entry[1]))
+        self._flights = util.SingleFlight()
+        self._boards = {}
+        self._boards_lock = threading.Lock()
+        # {key: lock held while the key's board is built}
+        self._board_inits = {}
+        self._board_ticker = None
+
     @cherrypy.popargs('entity', 'action')
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -102,51 +336,569 @@ class Engine(busbus.Engine):
                     raise APIError('_limit must be a positive integer', 422)
                 response['request']['limit'] = limit
 
-            if 'realtime' in kwargs:
-                if kwargs['realtime'] in ('y', 'Y', 'yes', 'Yes', 'YES',
-                                          'true', 'True', 'TRUE',
-                                          'on', 'On', 'ON'):
-                    kwargs['realtime'] = True
-                elif kwargs['realtime'] in ('n', 'N', 'no', 'No', 'NO',
-                                            'false', 'False', 'FALSE',
-                                            'off', 'Off', 'OFF'):
-                    kwargs['realtime'] = False
-                else:
-                    raise APIError('realtime is not a boolean', 422)
+            cursor = kwargs.pop('_cursor', None)
+            if cursor is not None:
+                if action or entity not in self._pageable_entities:
+                    raise APIError('_cursor is not supported for this '
+                                   'endpoint', 422)
+                response['request']['cursor'] = cursor
+
+            self._parse_realtime(kwargs)
+
+            if kwargs.pop('_timing', None) is not None:
+                if not self.config['profiling']:
+                    raise APIError('_timing needs profiling enabled', 422)
+                if action:
+                    response['request']['action'] = action
+                # not cached, as the breakdown is of this request
+                return self._timed_response(response, entity, action, kwargs,
+                                            to_expand, limit, cursor)
+
+            cache_key = self._cache_key(entity, action, kwargs, to_expand,
+                                        limit, cursor)
+            cached = self._cache_lookup(cache_key, entity)
+            if cached is not None:
+                return cached
 
             if action:
                 response['request']['action'] = action
-                if (entity, action) in self._entity_actions:
-                    func, entity = self._entity_actions[(entity, action)]
-                    result = func(**kwargs)
-                else:
-                    raise EndpointNotFoundError(entity, action)
+            return self._respond(cache_key, functools.partial(
+                self._build_response, response, entity, action, kwargs,
+                to_expand, limit, cursor))
+        except APIError as exc:
+            response['request']['status'] = 'error'
+            response['error'] = exc.msg
+            cherrypy.response.status = exc.error_code
+            return response
+
+    @staticmethod
+    def _parse_realtime(kwargs):
+        if 'realtime' in kwargs:
+            if kwargs['realtime'] in ('y', 'Y', 'yes', 'Yes', 'YES',
+                                      'true', 'True', 'TRUE',
+                                      'on', 'On', 'ON'):
+                kwargs['realtime'] = True
+            elif kwargs['realtime'] in ('n', 'N', 'no', 'No', 'NO',
+                                        'false', 'False', 'FALSE',
+                                        'off', 'Off', 'OFF'):
+                kwargs['realtime'] = False
             else:
-                if 'provider.id' in kwargs:
-                    provider_id = kwargs.pop('provider.id')
-                    if provider_id in self._providers:
-                        provider = self._providers[provider_id]
-                        entity_func = getattr(provider, entity, None)
-                    else:
-                        entity_func = Queryable(())
-                else:
-                    entity_func = getattr(self, entity, None)
-                if entity_func is not None:
-                    result = entity_func.where(**kwargs)
+                raise APIError('realtime is not a boolean', 422)
+
+    @cherrypy.expose
+    def live(self, entity=None, **kwargs):
+        """
+        Server-Sent Events for live arrival (or alert) boards. The first event
+        is a snapshot of the matching entities; after that, delta events list
+        the entities added, changed and removed as arrivals pass and
+        predictions change. _horizon is how many seconds ahead arrivals are
+        shown (an hour by default).
+
+        Clients making the same query share one subscription, so its changes
+        are worked out and encoded once for all of them.
+        """
+        response = {
+            'request': {
+                'status': 'ok',
+                'entity': entity,
+                'action': 'live',
+                'params': dict(kwargs),
+            }
+        }
+        try:
+            if entity not in self._realtime_entities:
+                raise EndpointNotFoundError('live/{0}'.format(entity))
+            to_expand = frozenset(kwargs.pop('_expand').split(',')
+                                  if '_expand' in kwargs else ())
+            try:
+                horizon = int(kwargs.pop('_horizon', 3600))
+                if horizon <= 0:
+                    raise ValueError()
+            except ValueError:
+                raise APIError('_horizon must be a positive integer', 422)
+            unsupported = [x for x in ('_limit', '_cursor', 'start_time',
+                                       'end_time') if x in kwargs]
+            if unsupported:
+                raise APIError('not supported for live: ' +
+                               ','.join(unsupported), 422)
+            self._parse_realtime(kwargs)
+            key = (entity, tuple(sorted(kwargs.items())), to_expand, horizon)
+            # attached here rather than in the generator, so that a failing
+            # first query is reported before the event stream starts
+            try:
+                board, client = self._attach_board(key)
+            except Exception as exc:
+                cherrypy.log('Starting the live board for {0} failed'.format(
+                    dict(kwargs)), 'LIVE', logging.ERROR, traceback=True)
+                raise APIError('starting the board failed: {0}'.format(exc),
+                               503)
+        except APIError as exc:
+            response['request']['status'] = 'error'
+            response['error'] = exc.msg
+            cherrypy.response.status = exc.error_code
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return encode_json(response)
+
+        detach = self._board_detacher(key, board, client)
+        # the generator's cleanup doesn't run if it's never started (e.g. the
+        # client goes away first), so also detach when the request ends
+        cherrypy.serving.request.hooks.attach('on_end_request', detach)
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return self._live_events(client, detach)
+    live._cp_config = {'response.stream': True}
+
+    def _live_events(self, client, detach):
+        try:
+            while True:
+                try:
+                    event = client.get(
+                        timeout=self.config['web_live_interval'])
+                except queue.Empty:
+                    # keeps proxies from closing the connection
+                    yield b': keepalive\n\n'
                 else:
-                    raise EndpointNotFoundError(entity)
+                    if event is None:
+                        # dropped for falling behind
+                        return
+                    yield event
+        finally:
+            detach()
 
-            if limit:
-                result = itertools.islice(result, limit)
+    def _attach_board(self, key):
+        """
+        Attach a client to the board for key, building the board first if
+        there isn't one. A board's first query runs under a lock of its own,
+        so it only holds up the clients of that query.
+        """
+        with self._boards_lock:
+            board = self._boards.get(key)
+            if board is not None:
+                return board, board.attach()
+            init = self._board_inits.setdefault(key, threading.Lock())
+        with init:
+            try:
+                with self._boards_lock:
+                    board = self._boards.get(key)
+                    if board is not None:
+                        # built while this request waited
+                        return board, board.attach()
+                entity, kwargs, to_expand, horizon = key
+                board = LiveBoard(self, entity, dict(kwargs), to_expand,
+                                  horizon, self._live_max_queue)
+                with self._boards_lock:
+                    existing = self._boards.setdefault(key, board)
+                    if existing is not board:
+                        # only if another request built one after an earlier
+                        # try failed
+                        board.subscription.cancel()
+                        board = existing
+                    if self._board_ticker is None:
+                        self._board_ticker = threading.Thread(
+                            target=self._advance_boards, name='busbus-live')
+                        self._board_ticker.daemon = True
+                        self._board_ticker.start()
+                    return board, board.attach()
+            finally:
+                with self._boards_lock:
+                    if self._board_inits.get(key) is init:
+                        del self._board_inits[key]
+
+    def _board_detacher(self, key, board, client):
+        """Return a function that detaches a client (only the first time)."""
+        detached = []
+
+        def detach():
+            with self._boards_lock:
+                if detached:
+                    return
+                detached.append(True)
+                if not board.detach(client):
+                    board.subscription.cancel()
+                    if self._boards.get(key) is board:
+                        del self._boards[key]
+        return detach
 
-            response[entity] = unexpand_init(result, to_expand)
+    def _advance_boards(self):
+        while True:
+            time.sleep(self.config['web_live_interval'])
+            with self._boards_lock:
+                boards = list(self._boards.values())
+            for board in boards:
+                self._advance_board(board)
+
+    def _advance_board(self, board):
+        try:
+            board.subscription.advance()
+        except Exception as exc:
+            # e.g. a provider failing to answer; the board catches up on the
+            # next tick that succeeds
+            board.failures += 1
+            if (board.failures == 1 or
+                    board.failures % self._live_max_failures == 0):
+                cherrypy.log('Updating the live board for {0} failed ({1} '
+                             'in a row)'.format(board.subscription.kwargs,
+                                                board.failures),
+                             'LIVE', logging.ERROR, traceback=True)
+            if board.failures == self._live_max_failures:
+                board.error('updating the board failed: {0}'.format(exc))
+        else:
+            board.failures = 0
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def admin(self, report=None, **kwargs):
+        """
+        Statistics for operators, served only if config['web_admin'] is set.
+        /admin/statements lists the SQL statements run by each provider, with
+        how often they ran, the total time spent in them and the rows they
+        returned. /admin/profile gives the profiling totals (see
+        busbus.util.profiling), if config['profiling'] is set.
+        """
+        response = {
+            'request': {
+                'status': 'ok',
+                'entity': 'admin',
+                'action': report,
+            }
+        }
+        try:
+            if not self.config['web_admin'] or report not in (
+                    'statements', 'profile'):
+                raise EndpointNotFoundError('admin', report)
+            if report == 'profile':
+                registry = profiling.registry()
+                response['profile'] = (registry.export()
+                                       if registry is not None else None)
+                return response
+            statements = []
+            for provider in self._providers.values():
+                stats = getattr(provider, 'statement_stats', None)
+                if stats is None:
+                    continue
+                for statement in stats.statements():
+                    statement['provider'] = provider.id
+                    statements.append(statement)
+            statements.sort(key=lambda s: s['time'], reverse=True)
+            response['statements'] = statements
+            return response
         except APIError as exc:
             response['request']['status'] = 'error'
             response['error'] = exc.msg
             cherrypy.response.status = exc.error_code
+            return response
 
+    def _timed_response(self, *args):
+        """
+        Build a response with a breakdown of the time spent in each profiled
+        span in its request block.
+        """
+        with profiling.record() as registry:
+            start = profiling.timer()
+            with profiling.span('web.response'):
+                response = self._build_response(*args)
+                # encode the entities now, so that their time is included
+                for key, value in response.items():
+                    if isinstance(value, EncodedList):
+                        response[key] = EncodedList(list(value))
+            timing = registry.export()
+            timing['total'] = profiling.timer() - start
+        response['request']['timing'] = timing
         return response
 
+    def _build_response(self, response, entity, action, kwargs, to_expand,
+                        limit, cursor=None):
+        if not action and entity in self._pageable_entities and (
+                cursor is not None):
+            result, next_cursor = self._page(
+                entity, dict(kwargs), self._decode_cursor(cursor, entity),
+                limit)
+            if next_cursor is not None:
+                response['request']['next_cursor'] = next_cursor
+            response[entity] = serializer_for(to_expand).encode_all(result)
+            return response
+
+        if action:
+            if (entity, action) in self._entity_actions:
+                func, entity = self._entity_actions[(entity, action)]
+                result = func(**kwargs)
+            else:
+                raise EndpointNotFoundError(entity, action)
+        else:
+            if 'provider.id' in kwargs:
+                provider = self._ready_provider(kwargs.pop('provider.id'))
+                if provider is not None:
+                    entity_func = getattr(provider, entity, None)
+                else:
+                    entity_func = Queryable(())
+            else:
+                entity_func = getattr(self, entity, None)
+            if entity_func is not None:
+                result = entity_func.where(**kwargs)
+            else:
+                raise EndpointNotFoundError(entity)
+
+        if limit:
+            result = itertools.islice(result, limit)
+
+        response[entity] = serializer_for(to_expand).encode_all(result)
+        return response
+
+    def _page(self, entity, kwargs, cursor, limit):
+        """
+        Return one page of results (up to limit, or all of them if limit is
+        None) starting from a decoded cursor, and the cursor for the next
+        page, or None if this is the last one.
+
+        Providers are visited in order of id and each provider's entities in
+        order of id (or, for arrivals, time), so that a cursor only has to
+        record where the previous page stopped.
+        """
+        if 'provider.id' in kwargs:
+            provider = self._ready_provider(kwargs.pop('provider.id'))
+            providers = [provider] if provider is not None else []
+        else:
+            providers = sorted(self._ready_providers(), key=lambda p: p.id)
+
+        if entity == 'arrivals':
+            if cursor is None:
+                # pin the time window so that later pages see the same one
+                start = (arrow.get(kwargs['start_time'])
+                         if 'start_time' in kwargs else arrow.now())
+                end = (arrow.get(kwargs['end_time'])
+                       if 'end_time' in kwargs else start.replace(hours=3))
+                window = (start.timestamp, end.timestamp)
+            else:
+                window = tuple(cursor['window'])
+            kwargs.pop('start_time', None)
+            kwargs.pop('end_time', None)
+
+        def resume(provider):
+            resuming = cursor is not None and provider.id == cursor['provider']
+            if entity != 'arrivals':
+                after = cursor['after'] if resuming else None
+                return provider._resume(entity, after).where(**kwargs)
+            start = cursor['time'] if resuming else window[0]
+            arrivals = provider.arrivals.where(
+                start_time=arrow.get(start), end_time=arrow.get(window[1]),
+                **kwargs)
+            if resuming:
+                # skip the arrivals at the cursor's time that were already
+                # on the previous page
+                seen = set(tuple(k) for k in cursor['seen'])
+                arrivals = (a for a in arrivals
+                            if not (a.time.timestamp == start and
+                                    self._arrival_key(a) in seen))
+            return arrivals
+
+        if cursor is not None:
+            providers = [p for p in providers if p.id >= cursor['provider']]
+        result = itertools.chain.from_iterable(resume(p) for p in providers)
+        if not limit:
+            return result, None
+
+        # fetch one extra to find out whether there is another page
+        page = list(itertools.islice(result, limit + 1))
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        last = page[-1]
+        state = {'entity': entity, 'provider': last.provider.id}
+        if entity == 'arrivals':
+            timestamp = last.time.timestamp
+            seen = [list(self._arrival_key(a)) for a in page
+                    if a.provider is last.provider and
+                    a.time.timestamp == timestamp]
+            if (cursor is not None and cursor['provider'] == state['provider']
+                    and cursor['time'] == timestamp):
+                seen = cursor['seen'] + seen
+            state.update(window=list(window), time=timestamp, seen=seen)
+        else:
+            state['after'] = last.id
+        return page, self._encode_cursor(state)
+
+    @staticmethod
+    def _arrival_key(arrival):
+        return (arrival._trip_id, arrival.stop.id, arrival.route.id)
+
+    @staticmethod
+    def _encode_cursor(state):
+        data = json.dumps(state, sort_keys=True, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor, entity):
+        if not cursor:
+            # None, or an empty _cursor for the first page
+            return None
+        try:
+            state = json.loads(base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError, binascii.Error):
+            raise APIError('_cursor is invalid', 422)
+        fields = (('provider', 'window', 'time', 'seen')
+                  if entity == 'arrivals' else ('provider', 'after'))
+        if (not isinstance(state, dict) or state.get('entity') != entity or
+                not all(f in state for f in fields)):
+            raise APIError('_cursor is invalid', 422)
+        return state
+
+    def _respond(self, cache_key, build):
+        """
+        Build, encode and cache a response.
+
+        Concurrent requests with the same cache key are coalesced: the first
+        one builds the response while the others wait for it and send the same
+        body (or raise the same error).
+        """
+        call, leader = self._flights.acquire(cache_key)
+        if not leader:
+            result = call.wait(self.config['web_coalesce_timeout'])
+            if result is not None:
+                etag, body = result
+                cherrypy.serving.response.headers['ETag'] = etag
+                return body
+            # the leader's streamed response was abandoned before it could be
+            # shared, or it is taking too long, so build our own (without
+            # coalescing)
+
+        try:
+            etag, body, ttl = self._encode_response(cache_key, build())
+        except BaseException:
+            if leader:
+                self._flights.release(cache_key, exc_info=sys.exc_info())
+            raise
+
+        if isinstance(body, six.binary_type):
+            self._response_cache.set(cache_key, (etag, body), ttl)
+            if leader:
+                self._flights.release(cache_key, (etag, body))
+            return body
+        return self._cache_stream(cache_key, etag, body, ttl, leader)
+
+    @property
+    def coalescing_stats(self):
+        """
+        How many requests computed their own response ('leaders') and how
+        many shared the response of an identical request already in progress
+        ('coalesced').
+        """
+        return {'leaders': self._flights.stats['leaders'],
+                'coalesced': self._flights.stats['coalesced']}
+
+    def _ready_provider(self, provider_id):
+        """
+        Return the provider with the given id, or None if there is no such
+        provider. Raises APIError if it hasn't finished loading.
+        """
+        provider = self._providers.get(provider_id)
+        if provider is not None and not provider.ready:
+            raise APIError('provider {0} is {1}'.format(
+                provider_id, provider.status), 503)
+        return provider
+
+    def _cache_key(self, entity, action, kwargs, to_expand, limit,
+                   cursor=None):
+        """
+        Key for a response in the response cache. Besides the request itself
+        it includes the feed loaded by each provider, so that responses are
+        not reused once a provider's data changes.
+        """
+        params = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in kwargs.items()))
+        feeds = tuple(sorted((p.id, p.ready, getattr(p, 'feed_id', None))
+                             for p in self._providers.values()))
+        return (entity, action, params, tuple(to_expand), limit, cursor,
+                feeds)
+
+    @staticmethod
+    def _etag(cache_key, salt=''):
+        key = repr(cache_key) + salt
+        return '"{0}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _cache_lookup(self, cache_key, entity):
+        """
+        Set the caching headers for a request and return the cached body if
+        there is one. Raises a 304 if the client's copy is still current.
+        """
+        headers = cherrypy.serving.response.headers
+        entry = self._response_cache.get(cache_key)
+        if entity in self._realtime_entities:
+            headers['Cache-Control'] = 'public, max-age={0}'.format(
+                self.config['web_arrivals_ttl'])
+            if entry is None:
+                return None
+        else:
+            # static data only changes along with the feed, which is part of
+            # the key; clients should revalidate with the ETag every time
+            headers['Cache-Control'] = 'public, no-cache'
+            if entry is None:
+                entry = (self._etag(cache_key), None)
+        headers['ETag'] = entry[0]
+        cptools.validate_etags()
+        return entry[1]
+
+    def _encode_response(self, cache_key, response):
+        """
+        Returns (etag, body, ttl), where body is bytes or, for a streamed
+        response, an iterator of bytes.
+        """
+        entity = response['request']['entity']
+        if entity in self._realtime_entities:
+            # responses for the same request made at different times differ
+            etag = self._etag(cache_key, repr(time.time()))
+            ttl = self.config['web_arrivals_ttl']
+        else:
+            etag = self._etag(cache_key)
+            ttl = None
+        cherrypy.serving.response.headers['ETag'] = etag
+        return etag, encode_json(response), ttl
+
+    def _cache_stream(self, cache_key, etag, chunks, ttl, leader):
+        """
+        Pass a streamed response through while keeping a copy for the cache
+        and for coalesced requests. The copy is dropped once it grows past
+        web_stream_cache_max bytes.
+        """
+        released = []
+        lock = threading.Lock()
+
+        def release(result=None):
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            self._flights.release(cache_key, result)
+
+        if leader:
+            # the body isn't read at all for a HEAD request or when the client
+            # goes away first, so also release the key when the request ends
+            cherrypy.serving.request.hooks.attach('on_end_request', release)
+        return self._stream(cache_key, etag, chunks, ttl,
+                            release if leader else None)
+
+    def _stream(self, cache_key, etag, chunks, ttl, release):
+        body = []
+        size = 0
+        limit = min(self.config['web_stream_cache_max'],
+                    self._response_cache.maxsize)
+        result = None
+        try:
+            for chunk in chunks:
+                if body is not None:
+                    body.append(chunk)
+                    size += len(chunk)
+                    if size > limit:
+                        body = None
+                yield chunk
+            if body is not None:
+                result = (etag, b''.join(body))
+                self._response_cache.set(cache_key, result, ttl)
+        finally:
+            if release is not None:
+                release(result)
+
     def help(self):
         return {
             'request': {
@@ -173,6 +925,8 @@ class Engine(busbus.Engine):
         missing = [x for x in expected if x not in kwargs]
         if missing:
             raise APIError('missing attributes: ' + ','.join(missing), 422)
-        provider = self._providers[kwargs['provider.id']]
+        provider = self._ready_provider(kwargs['provider.id'])
+        if provider is None:
+            raise APIError('provider not found', 404)
         route = provider.get(busbus.Route, kwargs['route.id'])
         return route.directions
@@ -1,7 +1,12 @@
+from .conftest import SampleGTFSProvider
+
 import busbus
 
+import arrow
+import mock
 import os
 import pytest
+import responses
 import tempfile
 
 
@@ -22,3 +27,49 @@ def test_engine_busbus_dir_other_error():
     os.chmod(outerdir, old_mode)
     os.rmdir(dir)
     os.rmdir(outerdir)
+
+
+@responses.activate
+def test_subscribe_arrivals(provider, gtfs_zip_data):
+    def callback(*changes):
+        events.append([[(a.stop.id, a.time.format('HH:mm')) for a in arrivals]
+                       for arrivals in changes])
+
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    engine = busbus.Engine({'gtfs_db_path': provider.conn})
+    p = SampleGTFSProvider(engine)
+    events = []
+    subscription = engine.subscribe('arrivals', callback, horizon=7200,
+                                    **{'route.id': u'AB'})
+
+    engine.advance(arrow.get('2007-06-03T07:30:00-07:00'))
+    assert events[-1] == [
+        [(u'BEATTY_AIRPORT', '08:00'), (u'BULLFROG', '08:10')], [], []]
+    with mock.patch.object(subscription, '_query',
+                           wraps=subscription._query) as query:
+        engine.advance(arrow.get('2007-06-03T08:05:00-07:00'))
+        assert events[-1] == [[], [], [(u'BEATTY_AIRPORT', '08:00')]]
+        # only the new part of the window is queried
+        query.assert_called_once_with(
+            p, start=arrow.get('2007-06-03T09:30:00-07:00'))
+    engine.advance(arrow.get('2007-06-03T11:00:00-07:00'))
+    assert events[-1] == [
+        [(u'BULLFROG', '12:05'), (u'BEATTY_AIRPORT', '12:15')], [],
+        [(u'BULLFROG', '08:10')]]
+    assert [a.time.format('HH:mm') for a in subscription] == [
+        '12:05', '12:15']
+
+    count = len(events)
+    engine.advance(arrow.get('2007-06-03T11:01:00-07:00'))
+    p._updated([u'CITY'])
+    p._updated([u'AB'])
+    subscription.cancel()
+    engine.advance(arrow.get('2007-06-03T13:00:00-07:00'))
+    assert len(events) == count
+
+
+def test_subscribe_invalid():
+    with pytest.raises(ValueError):
+        busbus.Engine().subscribe('stops', lambda *changes: None)
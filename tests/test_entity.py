@@ -1,5 +1,5 @@
 import busbus
-from busbus.entity import BaseEntityJSONEncoder
+from busbus.entity import BaseEntityJSONEncoder, StreamingJSONEncoder
 
 import json
 import pytest
@@ -46,3 +46,16 @@ def test_entity_to_json(provider):
 def test_bad_json():
     with pytest.raises(TypeError):
         BaseEntityJSONEncoder().encode(busbus.Engine)
+
+
+def test_streaming_json_matches_encode(provider):
+    def value():
+        return {'request': {'status': 'ok', 'params': {}},
+                'empty': iter(()),
+                'arrivals': (dict(a) for a in provider.arrivals)}
+
+    encoder = StreamingJSONEncoder()
+    encoder.chunk_size = 64
+    chunks = list(encoder.stream(value()))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == BaseEntityJSONEncoder().encode(value())
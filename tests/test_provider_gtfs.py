@@ -2,9 +2,11 @@ from .conftest import SampleGTFSProvider
 
 import busbus
 from busbus.provider import ProviderBase
+from busbus.provider import gtfs
 from busbus.provider.gtfs import SQLEntityMixin
 from busbus.util import Config
 
+import apsw
 import arrow
 from collections import OrderedDict
 import datetime
@@ -12,6 +14,8 @@ import mock
 import pytest
 import responses
 import six
+import threading
+import zipfile
 
 
 def test_provider_without_engine():
@@ -60,6 +64,265 @@ def test_already_imported(provider, gtfs_zip_data):
     assert len(list(provider.agencies)) == 1
 
 
+@responses.activate
+def test_revalidate_etag(gtfs_zip_data, tmpdir):
+    def callback(request):
+        if request.headers.get('If-None-Match') == etag:
+            return (304, {}, b'')
+        return (200, {'ETag': etag}, gtfs_zip_data)
+
+    etag = '"v1"'
+    responses.add_callback(responses.GET, SampleGTFSProvider.gtfs_url,
+                           callback=callback, content_type='application/zip')
+    e = busbus.Engine({'gtfs_db_path': ':memory:',
+                       'busbus_dir': str(tmpdir.join('1'))})
+    p = SampleGTFSProvider(e)
+
+    # a different url cache, so that the 304 comes straight from the server
+    e = busbus.Engine({'gtfs_db_path': p.conn,
+                       'busbus_dir': str(tmpdir.join('2'))})
+    with mock.patch('hashlib.sha256') as sha256:
+        assert SampleGTFSProvider(e).feed_id == p.feed_id
+        assert not sha256.called
+    assert responses.calls[-1].response.status_code == 304
+
+    # a new ETag for the same file is stored without another ingest
+    etag = '"v2"'
+    e = busbus.Engine({'gtfs_db_path': p.conn,
+                       'busbus_dir': str(tmpdir.join('3'))})
+    assert SampleGTFSProvider(e).feed_id == p.feed_id
+    assert p._stored_feed(p.gtfs_url)['etag'] == etag
+
+
+@responses.activate
+def test_revalidate_last_modified(gtfs_zip_data, tmpdir):
+    last_modified = 'Sun, 03 Jun 2007 00:00:00 GMT'
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip',
+                  adding_headers={'Last-Modified': last_modified,
+                                  'Content-Length': str(len(gtfs_zip_data))})
+    e = busbus.Engine({'gtfs_db_path': ':memory:',
+                       'busbus_dir': str(tmpdir)})
+    p = SampleGTFSProvider(e)
+    assert p._stored_feed(p.gtfs_url)['content_length'] == len(gtfs_zip_data)
+
+    e = busbus.Engine({'gtfs_db_path': p.conn, 'busbus_dir': str(tmpdir)})
+    with mock.patch('hashlib.sha256') as sha256:
+        assert SampleGTFSProvider(e).feed_id == p.feed_id
+        assert not sha256.called
+
+
+def test_schema_migration():
+    conn = apsw.Connection(':memory:')
+    conn.cursor().execute(
+        '''pragma user_version = 2026101901;
+        create table _feeds (id integer not null, url text not null,
+        sha256sum text not null, primary key (id));''')
+    with mock.patch.object(SampleGTFSProvider, '_load_feed'):
+        p = SampleGTFSProvider(busbus.Engine({'gtfs_db_path': conn}))
+    p._init_schema()
+    assert next(conn.cursor().execute('pragma user_version'))[
+        'user_version'] == gtfs.SCHEMA_USER_VERSION
+    assert p._stored_feed('url') is None
+
+
+@responses.activate
+def test_schema_migration_2015020201(gtfs_zip_data, tmpdir):
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    path = str(tmpdir.join('gtfs.sqlite3'))
+    p = SampleGTFSProvider(busbus.Engine({'gtfs_db_path': path}))
+    expected = [(d['headsign'], [s.id for s in d['stops']])
+                for d in p.get(busbus.Route, u'AB').directions]
+
+    # take the database back to the last released schema
+    conn = apsw.Connection(path)
+    conn.cursor().execute(
+        '''drop table _patterns; drop table _pattern_stops;
+        create table _old_feeds (
+            id integer not null,
+            url text not null,
+            sha256sum text not null,
+            primary key (id)
+        );
+        insert into _old_feeds select id, url, sha256sum from _feeds;
+        drop table _feeds;
+        alter table _old_feeds rename to _feeds;
+        pragma user_version = 2015020201;''')
+    conn.close()
+
+    p = SampleGTFSProvider(busbus.Engine({'gtfs_db_path': path}))
+    assert next(p.conn.cursor().execute('pragma user_version'))[
+        'user_version'] == gtfs.SCHEMA_USER_VERSION
+    assert [(d['headsign'], [s.id for s in d['stops']])
+            for d in p.get(busbus.Route, u'AB').directions] == expected
+
+
+def test_schema_too_old():
+    conn = apsw.Connection(':memory:')
+    conn.cursor().execute('pragma user_version = 2014010101')
+    with mock.patch.object(SampleGTFSProvider, '_load_feed'):
+        p = SampleGTFSProvider(busbus.Engine({'gtfs_db_path': conn}))
+    with pytest.raises(RuntimeError):
+        p._init_schema()
+
+
+@responses.activate
+def test_reader_connections(gtfs_zip_data, tmpdir):
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    e = busbus.Engine({'busbus_dir': str(tmpdir)})
+    p = SampleGTFSProvider(e)
+    assert next(p.conn.cursor().execute('pragma journal_mode'))[
+        'journal_mode'] == 'wal'
+    with pytest.raises(apsw.ReadOnlyError):
+        p.conn.cursor().execute('delete from _feeds')
+
+    conns = {}
+    stops = {}
+
+    def query(name):
+        conns[name] = p.conn
+        stops[name] = len(list(p.stops))
+
+    threads = [threading.Thread(target=query, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, conns.values()))) == 4
+    assert p.conn is p.conn
+    assert p.conn not in conns.values()
+    assert set(stops.values()) == set((len(list(p.stops)),))
+
+
+@responses.activate
+def test_sharded_feeds(gtfs_zip_data, tmpdir):
+    class OtherProvider(SampleGTFSProvider):
+        gtfs_url = 'http://busbus.invalid/other-feed.zip'
+
+    for url in (SampleGTFSProvider.gtfs_url, OtherProvider.gtfs_url):
+        responses.add(responses.GET, url, body=gtfs_zip_data, status=200,
+                      content_type='application/zip')
+    shard_dir = tmpdir.join('shards')
+    e = busbus.Engine({'busbus_dir': str(tmpdir),
+                       'gtfs_db_dir': str(shard_dir)})
+    p1 = SampleGTFSProvider(e)
+    p2 = OtherProvider(e)
+
+    assert len(shard_dir.listdir('*.sqlite3')) == 2
+    assert not tmpdir.join('gtfs.sqlite3').check()
+    for p in (p1, p2):
+        assert [r['url'] for r in p.conn.cursor().execute(
+            'select url from _feeds')] == [p.gtfs_url]
+    assert len(list(e.stops)) == len(list(p1.stops)) * 2
+
+
+@responses.activate
+def test_snapshot_catalog(provider, gtfs_zip_data, tmpdir):
+    def entities(p):
+        return (
+            [(a.id, a.name, a.timezone) for a in p.agencies],
+            [(s.id, s.name, s.timezone, s.parent and s.parent.id,
+              sorted(r.id for r in s.routes)) for s in p.stops],
+            [(r.id, r.name, r.agency.id, sorted(s.id for s in r.stops))
+             for r in p.routes],
+            p._timezone)
+
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    config = {'gtfs_db_path': provider.conn,
+              'busbus_dir': str(tmpdir.join('busbus')),
+              'snapshot_dir': str(tmpdir.join('snapshots'))}
+    p = SampleGTFSProvider(busbus.Engine(config))
+    assert len(tmpdir.join('snapshots').listdir('*.catalog')) == 1
+    assert entities(p) == entities(provider)
+    assert p.get(busbus.Stop, u'BEATTY_AIRPORT').name == (
+        u'Nye County Airport (Demo)')
+    assert p.get(busbus.Route, u'nope', 42) == 42
+
+    with mock.patch.object(SampleGTFSProvider, '_catalog_data') as data:
+        p = SampleGTFSProvider(busbus.Engine(config))
+        assert not data.called
+    # entities are built when they're first used
+    assert not p._catalog._entities[gtfs.GTFSStop]
+    p.statement_stats.clear()
+    assert entities(p) == entities(provider)
+    assert p.statement_stats.statements() == []
+
+
+@responses.activate
+def test_background_init(gtfs_zip_data):
+    class GatedProvider(SampleGTFSProvider):
+        gate = threading.Event()
+
+        def _load_feed(self, gtfs_url):
+            assert self.gate.wait(5)
+            super(GatedProvider, self)._load_feed(gtfs_url)
+
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    e = busbus.Engine({'gtfs_db_path': ':memory:', 'background_init': True})
+    p = GatedProvider(e)
+    assert not p.ready
+    assert p.status == 'loading'
+    assert list(e.providers) == [p]
+    assert list(e.stops) == []
+    assert not e.wait_ready(0.01)
+
+    GatedProvider.gate.set()
+    assert e.wait_ready(5)
+    assert p.status == 'ready'
+    assert len(list(e.stops)) == len(list(p.stops)) > 0
+
+
+@responses.activate
+def test_background_init_failed():
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=b'not a zip', status=200,
+                  content_type='application/zip')
+    e = busbus.Engine({'gtfs_db_path': ':memory:', 'background_init': True})
+    p = SampleGTFSProvider(e)
+    with pytest.raises(zipfile.BadZipfile):
+        p.wait_ready(5)
+    assert p.status == 'failed'
+    assert list(e.agencies) == []
+
+
+@pytest.mark.parametrize('background_init', (False, True))
+@responses.activate
+def test_load_after_construction(gtfs_zip_data, background_init):
+    class LateProvider(SampleGTFSProvider):
+        def __init__(self, engine=None):
+            super(LateProvider, self).__init__(engine)
+            self.late = True
+
+        def _load_feed(self, gtfs_url):
+            loaded.append(self.late)
+            super(LateProvider, self)._load_feed(gtfs_url)
+
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    e = busbus.Engine({'gtfs_db_path': ':memory:',
+                       'background_init': background_init})
+    loaded = []
+    registered = []
+    with mock.patch.object(e, '_register_provider',
+                           side_effect=lambda p: registered.append(p.ready)):
+        p = LateProvider(e)
+    assert p.wait_ready(5)
+    # not ready when the engine first sees it, and loaded only once the
+    # subclass's __init__ is done
+    assert registered == [False]
+    assert loaded == [True]
+
+
 @pytest.mark.parametrize('entity', (None, busbus.Stop, busbus.Arrival))
 def test_provider_get_default(provider, entity):
     assert provider.get(entity, u'The weather in london',
@@ -79,6 +342,52 @@ def test_sql_entity_mixin_build_select():
     assert (FakeEntity._build_select(['_feed_url', 'fake_id']) ==
             ('select ipsum as lorem, bar as foo from fake '
              'where _feed_url=? and fake_id=?'))
+    assert (FakeEntity._build_select(['fake_id'], named_params=True) is
+            FakeEntity._build_select(['fake_id'], named_params=True))
+
+
+def test_statement_stats(provider):
+    stats = provider.statement_stats
+    stats.clear()
+    stops = list(provider.stops)
+    list(provider.stops)
+    next(iter(provider.routes))
+    statements = {s['sql']: s for s in stats.statements()}
+    stops_sql = busbus.provider.gtfs.GTFSStop._build_select(
+        ['_feed'], named_params=True)
+    assert statements[stops_sql]['count'] == 2
+    assert statements[stops_sql]['rows'] == 2 * len(stops)
+    assert statements[stops_sql]['time'] > 0
+    # a partly read result counts the rows read so far
+    routes_sql = busbus.provider.gtfs.GTFSRoute._build_select(
+        ['_feed'], named_params=True)
+    assert statements[routes_sql]['rows'] == 1
+
+
+def test_gtfs_row():
+    conn = apsw.Connection(':memory:')
+    conn.setrowtrace(gtfs.gtfs_row_tracer)
+    cur = conn.cursor()
+    cur.execute("""create table t (d date, t gtfstime, n integer);
+                insert into t values ('2007-06-03', 3600, 1);
+                insert into t values (null, 60, 2);""")
+    rows = list(cur.execute('select * from t'))
+    assert rows[0]._columns is rows[1]._columns
+    assert list(rows[0]) == ['d', 't', 'n']
+    assert rows[0] == {'d': datetime.date(2007, 6, 3),
+                       't': datetime.timedelta(hours=1), 'n': 1}
+    assert rows[1]['d'] is None
+    assert dict(**rows[1])['t'] == datetime.timedelta(minutes=1)
+    with pytest.raises(KeyError):
+        rows[0]['x']
+
+    convert = mock.Mock(return_value='converted')
+    with mock.patch.dict(gtfs.ROW_CONVERTERS, {'gtfstime': convert}):
+        row = next(cur.execute('select t as lazy_t, n from t'))
+        # values are only converted when they are read
+        assert not convert.called
+        assert row['lazy_t'] == 'converted'
+        convert.assert_called_once_with(3600)
 
 
 def test_sql_entity_eq(provider):
@@ -188,6 +497,34 @@ def test_route_stops(provider):
                                                   u'NADAV', u'DADAN', u'EMSI'))
 
 
+def test_route_directions(provider):
+    directions = list(provider.get(busbus.Route, u'AB').directions)
+    assert len(directions) == 2
+    assert directions[0]['headsign'] == u'to Bullfrog'
+    assert ([stop.id for stop in directions[0]['stops']] ==
+            [u'BEATTY_AIRPORT', u'BULLFROG'])
+    assert ([stop.id for stop in directions[1]['stops']] ==
+            [u'BULLFROG', u'BEATTY_AIRPORT'])
+
+
+def test_route_directions_dedupe(provider):
+    # AAMV's four trips follow two patterns, each run twice a day
+    directions = [(d['headsign'], tuple(s.id for s in d['stops']))
+                  for d in provider.get(busbus.Route, u'AAMV').directions]
+    assert sorted(directions) == [
+        (u'to Airport', (u'AMV', u'BEATTY_AIRPORT')),
+        (u'to Amargosa Valley', (u'BEATTY_AIRPORT', u'AMV')),
+    ]
+
+
+@pytest.mark.parametrize('entity', ['agencies', 'stops', 'routes'])
+def test_resume(provider, entity):
+    ids = sorted(e.id for e in getattr(provider, entity))
+    assert [e.id for e in provider._resume(entity)] == ids
+    assert [e.id for e in provider._resume(entity, ids[0])] == ids[1:]
+    assert list(provider._resume(entity, ids[-1])) == []
+
+
 @pytest.mark.parametrize('time,stop_id,count', [
     # for STAGECOACH, 06:45-09:45:
     # STBA: 6 arrivals (every half hour)
@@ -212,6 +549,60 @@ def test_valid_arrivals(provider, time, stop_id, count):
             count)
 
 
+@pytest.fixture(scope='module')
+@responses.activate
+def timetable_provider(gtfs_zip_data, tmpdir_factory):
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    tmpdir = tmpdir_factory.mktemp('timetable')
+    return SampleGTFSProvider(busbus.Engine({
+        'gtfs_db_path': ':memory:',
+        'gtfs_timetable_dir': str(tmpdir.join('timetables'))}))
+
+
+def test_timetable_file(timetable_provider, tmpdir):
+    timetable = timetable_provider.timetable
+    assert timetable is not None
+    assert [s['trip_id'] for s in timetable.stop_times(
+        u'BEATTY_AIRPORT', u'AB')] == [u'AB1', u'AB2']
+    assert [s['trip_id'] for s in timetable.stop_times(
+        u'BEATTY_AIRPORT', u'AB', -5 * 3600, 0)] == [u'AB1']
+    assert list(timetable.stop_times(u'BEATTY_AIRPORT', u'nope')) == []
+    assert timetable.runs(u'FULLW', datetime.date(2007, 6, 3))
+    assert not timetable.runs(u'FULLW', datetime.date(2007, 6, 4))
+    assert not timetable.runs(u'FULLW', datetime.date(2000, 1, 1))
+    assert timetable.has_frequencies(u'STBA')
+    assert timetable.frequencies(u'STBA') == [{
+        'start_time': datetime.timedelta(hours=-6),
+        'end_time': datetime.timedelta(hours=10),
+        'headway_secs': datetime.timedelta(minutes=30)}]
+
+    bad = tmpdir.join('bad.timetable')
+    bad.write(b'not a timetable', mode='wb')
+    with pytest.raises(ValueError):
+        busbus.provider.timetable.Timetable(str(bad))
+
+
+@pytest.mark.parametrize('start,end', [
+    ('2007-06-03T06:45:00-07:00', '2007-06-03T09:45:00-07:00'),
+    ('2007-06-03T00:00:00-07:00', '2007-06-05T00:00:00-07:00'),
+    ('2007-06-05T06:45:00-07:00', '2007-06-05T23:00:00-07:00'),
+    ('2007-06-05T21:00:00-07:00', '2007-06-06T03:00:00-07:00'),
+])
+def test_timetable_arrivals(provider, timetable_provider, start, end):
+    def arrivals(p):
+        return sorted(
+            (a.time, a.stop.id, a.route.id, a.departure_time, a.headsign,
+             a.short_name, a.bikes_ok, a._trip_id)
+            for a in p.arrivals.where(start_time=arrow.get(start),
+                                      end_time=arrow.get(end)))
+
+    expected = arrivals(provider)
+    assert expected
+    assert arrivals(timetable_provider) == expected
+
+
 @pytest.mark.parametrize('time,count', [
     (arrow.get('2007-06-03T06:45:00-07:00'), 6),
     # becomes 2007-06-02T17:00:00-07:00
@@ -0,0 +1,290 @@
+from .conftest import SampleGTFSProvider
+
+import busbus
+
+from array import array
+import arrow
+import pytest
+import responses
+
+gtfs_realtime_pb2 = pytest.importorskip('google.transit.gtfs_realtime_pb2')
+gtfsrt = pytest.importorskip('busbus.provider.gtfsrt')
+
+
+class SampleRealtimeProvider(gtfsrt.GTFSRealtimeMixin, SampleGTFSProvider):
+    trip_updates_interval = 0
+
+
+@pytest.fixture(scope='module')
+@responses.activate
+def rt_provider(engine, gtfs_zip_data):
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    return SampleRealtimeProvider(engine)
+
+
+def feed(*trip_updates, **kwargs):
+    """
+    Build a serialized FeedMessage. Each trip update is (trip_id, fields,
+    stop_time_updates), where fields are set on the TripUpdate's trip
+    descriptor (or on the TripUpdate itself, for delay).
+    """
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = '1.0'
+    message.header.incrementality = kwargs.get(
+        'incrementality', gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+    message.header.timestamp = arrow.get(
+        '2007-06-03T07:30:00-07:00').timestamp
+    for trip_id, fields, updates in trip_updates:
+        entity = message.entity.add()
+        entity.id = trip_id
+        if fields.pop('is_deleted', False):
+            entity.is_deleted = True
+        trip_update = entity.trip_update
+        trip_update.trip.trip_id = trip_id
+        if 'delay' in fields:
+            trip_update.delay = fields.pop('delay')
+        for k, v in fields.items():
+            setattr(trip_update.trip, k, v)
+        for update in updates:
+            stop_time_update = trip_update.stop_time_update.add()
+            for k, v in update.items():
+                if k in ('delay', 'time'):
+                    setattr(stop_time_update.arrival, k, v)
+                else:
+                    setattr(stop_time_update, k, v)
+    return message.SerializeToString()
+
+
+def arrivals(provider, **kwargs):
+    kwargs.setdefault('route.id', u'AB')
+    kwargs.setdefault('start_time', arrow.get('2007-06-03T07:30:00-07:00'))
+    kwargs.setdefault('end_time', arrow.get('2007-06-03T13:00:00-07:00'))
+    return [(a.stop.id, a.time.format('HH:mm'), a.realtime)
+            for a in provider.arrivals.where(**kwargs)]
+
+
+def test_index_incremental():
+    index = gtfsrt.TripUpdateIndex()
+    ab1 = ('AB1', {}, [{'stop_sequence': 1, 'delay': 60}])
+    ab2 = ('AB2', {}, [{'stop_sequence': 1, 'delay': 120}])
+    assert index.update(feed(ab1, ab2)) == set(('AB1', 'AB2'))
+    assert index.update(feed(ab1, ab2)) == set()
+    trip = index.trips['AB1']
+    assert index.update(feed(
+        ('AB1', {}, [{'stop_sequence': 1, 'delay': 90}]), ab2)) == set(
+        ('AB1',))
+    assert index.trips['AB1'] is not trip
+    assert index.trips['AB1'].stops[0].delay == 90
+    assert index.update(feed(ab2)) == set(('AB1',))
+    assert set(index.trips) == set(('AB2',))
+    differential = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    assert index.update(feed(ab1, incrementality=differential)) == set(
+        ('AB1',))
+    assert len(index) == 2
+    assert index.update(feed(('AB2', {'is_deleted': True}, []),
+                             incrementality=differential)) == set(('AB2',))
+    assert set(index.trips) == set(('AB1',))
+
+
+def test_trip_delays(rt_provider):
+    skipped = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+    index = gtfsrt.TripUpdateIndex()
+    changed = index.update(feed(
+        ('CITY1', {}, [{'stop_sequence': 2, 'delay': 60},
+                       {'stop_sequence': 4,
+                        'schedule_relationship': skipped},
+                       {'stop_sequence': 5, 'delay': 180}]),
+        ('CITY2', {'delay': 30}, [{'stop_id': 'NADAV', 'delay': -30}]),
+        ('AB1', {'start_date': '20070603'}, [{
+            'stop_sequence': 1,
+            'time': arrow.get('2007-06-03T08:03:00-07:00').timestamp}]),
+        ('nope', {}, [{'stop_sequence': 1, 'delay': 60}])))
+    delays = gtfsrt.TripDelays(rt_provider).update(index, changed)
+    assert [delays.delay('CITY1', seq) for seq in range(1, 6)] == [
+        None, 60, 60, False, 180]
+    assert [delays.delay('CITY2', seq) for seq in range(1, 6)] == [
+        30, 30, -30, -30, -30]
+    assert [delays.delay('AB1', seq) for seq in (1, 2)] == [180, 180]
+    assert delays.delay('nope', 1) is None
+    assert delays.delay('AB2', 1) is None
+
+    changed = index.update(feed(
+        ('CITY1', {}, [{'stop_sequence': 2, 'delay': 60},
+                       {'stop_sequence': 4,
+                        'schedule_relationship': skipped},
+                       {'stop_sequence': 5, 'delay': 180}]),
+        ('CITY2', {'delay': 30}, [{'stop_id': 'NADAV', 'delay': 0}])))
+    assert changed == set(('CITY2', 'AB1', 'nope'))
+    new_delays = delays.update(index, changed)
+    assert new_delays.trips['CITY1'] is delays.trips['CITY1']
+    assert new_delays.delay('CITY2', 5) == 0
+    assert new_delays.delay('AB1', 1) is None
+    # the old version is unchanged
+    assert delays.delay('CITY2', 5) == -30
+
+
+def test_trip_delays_loop(rt_provider):
+    index = gtfsrt.TripUpdateIndex()
+    index.update(feed(('LOOP', {}, [{'stop_id': 'A', 'delay': 10},
+                                    {'stop_id': 'B', 'delay': 20},
+                                    {'stop_id': 'A', 'delay': 30}])))
+    # a loop trip, visiting stop A at its start and end
+    schedule = (array('l', (1, 2, 3, 4)), ('A', 'B', 'C', 'A'),
+                array('l', (0, 60, 120, 180)))
+    positions, delays, flags = gtfsrt.TripDelays(rt_provider)._propagate(
+        index.trips['LOOP'], schedule, None)
+    assert list(delays) == [10, 20, 20, 30]
+
+
+def test_no_updates(rt_provider):
+    rt_provider.update_trip_updates(feed())
+    assert arrivals(rt_provider) == [
+        (u'BEATTY_AIRPORT', '08:00', False),
+        (u'BULLFROG', '08:10', False),
+        (u'BULLFROG', '12:05', False),
+        (u'BEATTY_AIRPORT', '12:15', False),
+    ]
+
+
+def test_delay_propagates(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {'start_date': '20070603'},
+         [{'stop_sequence': 1, 'delay': 300}])))
+    assert arrivals(rt_provider) == [
+        (u'BEATTY_AIRPORT', '08:05', True),
+        (u'BULLFROG', '08:15', True),
+        (u'BULLFROG', '12:05', False),
+        (u'BEATTY_AIRPORT', '12:15', False),
+    ]
+
+
+def test_late_trip_scheduled_before_window(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {'start_date': '20070603'},
+         [{'stop_sequence': 1, 'delay': 600}])))
+    # AB1 is scheduled at BEATTY_AIRPORT at 08:00, before the window
+    assert arrivals(rt_provider, start_time=arrow.get(
+        '2007-06-03T08:05:00-07:00'))[:2] == [
+        (u'BEATTY_AIRPORT', '08:10', True),
+        (u'BULLFROG', '08:20', True),
+    ]
+
+
+def test_early_trip_scheduled_after_window(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {'start_date': '20070603'},
+         [{'stop_sequence': 1, 'delay': -600}])))
+    assert arrivals(rt_provider, end_time=arrow.get(
+        '2007-06-03T07:55:00-07:00')) == [(u'BEATTY_AIRPORT', '07:50', True)]
+
+
+def test_trip_delay_and_time(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {'delay': 120}, [{
+            'stop_sequence': 2,
+            'time': arrow.get('2007-06-03T08:20:00-07:00').timestamp}])))
+    assert arrivals(rt_provider)[:2] == [
+        (u'BEATTY_AIRPORT', '08:02', True),
+        (u'BULLFROG', '08:20', True),
+    ]
+
+
+def test_time_propagates(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {}, [{
+            'stop_sequence': 1,
+            'time': arrow.get('2007-06-03T07:58:00-07:00').timestamp}])))
+    assert arrivals(rt_provider)[:2] == [
+        (u'BEATTY_AIRPORT', '07:58', True),
+        (u'BULLFROG', '08:08', True),
+    ]
+
+
+def test_other_start_date(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {'start_date': '20070604'},
+         [{'stop_sequence': 1, 'delay': 300}])))
+    assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:00', False)
+
+
+def test_canceled_and_skipped(rt_provider):
+    canceled = gtfs_realtime_pb2.TripDescriptor.CANCELED
+    skipped = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {}, [{'stop_id': 'BULLFROG',
+                      'schedule_relationship': skipped}]),
+        ('AB2', {'schedule_relationship': canceled}, [])))
+    assert arrivals(rt_provider) == [(u'BEATTY_AIRPORT', '08:00', False)]
+
+
+def test_realtime_false(rt_provider):
+    rt_provider.update_trip_updates(feed(
+        ('AB1', {}, [{'stop_sequence': 1, 'delay': 300}])))
+    assert arrivals(rt_provider, realtime=False)[0] == (
+        u'BEATTY_AIRPORT', '08:00', False)
+
+
+def test_trip_updates_file(rt_provider, tmpdir):
+    path = tmpdir.join('TripUpdates.pb')
+    path.write(feed(('AB1', {}, [{'stop_sequence': 1, 'delay': 60}])),
+               mode='wb')
+    rt_provider.trip_updates_url = str(path)
+    try:
+        assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:01', True)
+    finally:
+        rt_provider.trip_updates_url = None
+
+
+@responses.activate
+def test_trip_updates_error(rt_provider):
+    url = 'http://busbus.invalid/TripUpdates.pb'
+    responses.add(responses.GET, url,
+                  body=feed(('AB1', {}, [{'stop_sequence': 1, 'delay': 60}])),
+                  status=200, content_type='application/octet-stream')
+    rt_provider.trip_updates_url = url
+    try:
+        assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:01', True)
+        responses.reset()
+        responses.add(responses.GET, url, body='<html>Bad Gateway</html>',
+                      status=502, content_type='text/html')
+        # the previous snapshot is kept
+        assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:01', True)
+        responses.reset()
+        responses.add(responses.GET, url, body=b'\xff not a FeedMessage',
+                      status=200, content_type='application/octet-stream')
+        assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:01', True)
+        # nothing registered: responses raises ConnectionError
+        responses.reset()
+        assert arrivals(rt_provider)[0] == (u'BEATTY_AIRPORT', '08:01', True)
+    finally:
+        rt_provider.trip_updates_url = None
+
+
+@responses.activate
+def test_subscription(provider, gtfs_zip_data):
+    def callback(*changes):
+        events.append([[(a.stop.id, a.time.format('HH:mm')) for a in arrivals]
+                       for arrivals in changes])
+
+    responses.add(responses.GET, SampleGTFSProvider.gtfs_url,
+                  body=gtfs_zip_data, status=200,
+                  content_type='application/zip')
+    p = SampleRealtimeProvider(busbus.Engine({'gtfs_db_path': provider.conn}))
+    events = []
+    p.engine.subscribe('arrivals', callback, **{'route.id': u'AB'})
+    p.engine.advance(arrow.get('2007-06-03T07:30:00-07:00'))
+    assert events == [[
+        [(u'BEATTY_AIRPORT', '08:00'), (u'BULLFROG', '08:10')], [], []]]
+
+    p.update_trip_updates(feed(('AB1', {}, [
+        {'stop_sequence': 1, 'delay': 300}])))
+    assert events[-1] == [
+        [], [(u'BEATTY_AIRPORT', '08:05'), (u'BULLFROG', '08:15')], []]
+    p.update_trip_updates(feed(('AB1', {'delay': 1800}, [])))
+    assert events[-1] == [
+        [], [(u'BEATTY_AIRPORT', '08:30')], [(u'BULLFROG', '08:15')]]
+    count = len(events)
+    p.update_trip_updates(feed(('AB1', {'delay': 1800}, [])))
+    assert len(events) == count
@@ -8,6 +8,7 @@ from pkg_resources import resource_string
 import pytest
 import responses
 from six.moves import urllib
+import time
 
 
 @pytest.fixture(scope='module')
@@ -141,3 +142,29 @@ def test_predictionsbyroute_children(mbta_provider):
         mbta_provider, '2015-05-01T15:08:18-05:00',
         stop_id='place-dwnxg', route_id='Orange'))
     assert len(arrs) > 0
+
+
+def test_realtime_map_timeout(mbta_provider):
+    def call(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    timeout = mbta_provider.realtime_timeout
+    mbta_provider.realtime_timeout = 0.3
+    try:
+        t = time.time()
+        results = list(mbta_provider._realtime_map(
+            call, lambda seconds: -seconds, [0.5, 0, 0.1]))
+    finally:
+        mbta_provider.realtime_timeout = timeout
+    # results come in as they finish; the slow one falls back
+    assert results == [0, 0.1, -0.5]
+    assert time.time() - t < 0.5
+
+
+def test_realtime_map_error(mbta_provider):
+    def call(item):
+        raise KeyError(item)
+
+    with pytest.raises(KeyError):
+        list(mbta_provider._realtime_map(call, None, [1]))
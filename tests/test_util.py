@@ -3,6 +3,9 @@ import busbus.entity
 from busbus import util
 
 import pytest
+import sys
+import threading
+import time
 
 
 def test_util_clsname():
@@ -16,3 +19,86 @@ def test_util_entity_type_error():
         busbus.util.entity_type(busbus.entity.BaseEntity)
     with pytest.raises(TypeError):
         busbus.util.entity_type(engine)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = util.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_getsizeof():
+    cache = util.LRUCache(10, getsizeof=len)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'x' * 6)
+    assert cache.get('a') is None
+    assert cache.size == 6
+    cache.set('c', 'x' * 11)
+    assert cache.get('c') is None
+    assert cache.get('b') == 'x' * 6
+
+
+def test_lru_cache_ttl():
+    cache = util.LRUCache(10, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=60)
+    assert cache.get('a') == 1
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_single_flight():
+    flight = util.SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(None)
+        release.wait(5)
+        return 42
+
+    threads = [threading.Thread(
+        target=lambda: results.append(flight.do('key', work)))
+        for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while flight.stats['coalesced'] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [42, 42, 42]
+    assert len(calls) == 1
+    assert flight.stats['leaders'] == 1
+    # the key is free again once the leader is done
+    assert flight.do('key', lambda: 43) == 43
+
+
+def test_single_flight_exception():
+    flight = util.SingleFlight()
+    call, leader = flight.acquire('key')
+    assert leader
+    follower, leader = flight.acquire('key')
+    assert follower is call and not leader
+    try:
+        raise ValueError('hi')
+    except ValueError:
+        flight.release('key', exc_info=sys.exc_info())
+    with pytest.raises(ValueError):
+        follower.wait()
+
+
+def test_stablehash():
+    assert util.stablehash({'a': 1, 'b': 2}) == util.stablehash(
+        {'b': 2, 'a': 1})
+    assert util.stablehash({1, 2, 3}) == util.stablehash({3, 2, 1})
+    assert util.stablehash(('a', 'b')) != util.stablehash(('b', 'a'))
+    assert util.stablehash(['a', 'b']) != util.stablehash(['b', 'a'])
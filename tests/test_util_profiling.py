@@ -0,0 +1,67 @@
+from busbus.util import profiling
+
+import threading
+
+
+def test_disabled():
+    items = [1, 2]
+    assert profiling.timed('test', items) is items
+    with profiling.span('test'):
+        profiling.incr('test')
+    assert profiling.registry() is None
+
+
+def test_nested_spans():
+    def inner():
+        for i in (1, 2):
+            with profiling.span('inner'):
+                pass
+            yield i
+
+    with profiling.record() as registry:
+        with profiling.span('outer'):
+            assert list(profiling.timed('items', inner())) == [1, 2]
+            profiling.incr('rows', 2)
+    stats = registry.export()
+    assert stats['counters'] == {'rows': 2}
+    spans = stats['spans']
+    assert set(spans) == set(('outer', 'items', 'inner'))
+    assert spans['items']['count'] == 1
+    assert spans['inner']['count'] == 2
+    assert spans['outer']['time'] >= spans['items']['time']
+    # self times exclude the nested spans
+    assert abs(spans['outer']['self_time'] - (
+        spans['outer']['time'] - spans['items']['time'])) < 1e-6
+    assert spans['items']['self_time'] <= spans['items']['time']
+
+
+def test_record_restores():
+    with profiling.record() as outer:
+        with profiling.record() as inner:
+            profiling.incr('inner')
+        profiling.incr('outer')
+    assert inner.export()['counters'] == {'inner': 1}
+    assert outer.export()['counters'] == {'outer': 1}
+    profiling.incr('nowhere')
+
+
+def test_bind():
+    with profiling.record() as registry:
+        func = profiling.bind(lambda: profiling.incr('thread'))
+    thread = threading.Thread(target=func)
+    thread.start()
+    thread.join()
+    assert registry.export()['counters'] == {'thread': 1}
+
+
+def test_enable():
+    registry = profiling.enable()
+    try:
+        assert profiling.registry() is registry
+        with profiling.record() as local:
+            profiling.incr('both')
+        profiling.incr('global')
+    finally:
+        profiling.disable()
+    assert registry.export()['counters'] == {'both': 1, 'global': 1}
+    assert local.export()['counters'] == {'both': 1}
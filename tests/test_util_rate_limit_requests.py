@@ -2,8 +2,10 @@ from busbus.util import RateLimitRequests
 
 from datetime import datetime, timedelta
 import httpbin
+import json
 import pytest
 import requests
+import threading
 import time
 from wsgi_intercept import requests_intercept, add_wsgi_intercept
 
@@ -58,6 +60,66 @@ def test_repeat_get_url_interval(url_prefix):
     assert resp1.json()['cookies'] != resp3.json()['cookies']
 
 
+def test_concurrent_url_interval(url_prefix):
+    session = RateLimitRequests(url_interval=1)
+    resps = []
+
+    def get():
+        resps.append(session.get(url_prefix + '/delay/0.2'))
+
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(resps) == 4
+    assert all(resp is resps[0] for resp in resps)
+
+
+def test_cache_size(url_prefix):
+    session = RateLimitRequests(url_interval=10, cache_size=1)
+    resp1 = session.get(url_prefix + '/get')
+    assert session.get(url_prefix + '/get') is resp1
+    session.get(url_prefix + '/ip')
+    assert session.get(url_prefix + '/get') is not resp1
+
+
+def test_shared_url_interval(url_prefix, tmpdir):
+    path = str(tmpdir.join('rate_limit.sqlite3'))
+    session1 = RateLimitRequests(url_interval=10, shared_path=path)
+    session2 = RateLimitRequests(url_interval=10, shared_path=path)
+    resp1 = session1.get(url_prefix + '/cookies')
+    session2.get(url_prefix + '/cookies/set?a=b')
+    resp2 = session2.get(url_prefix + '/cookies')
+    assert resp1.json()['cookies'] == resp2.json()['cookies']
+
+
+def test_shared_interval(url_prefix, tmpdir):
+    path = str(tmpdir.join('rate_limit.sqlite3'))
+    session1 = RateLimitRequests(interval=0.2, shared_path=path)
+    session2 = RateLimitRequests(interval=0.2, shared_path=path)
+    session1.get(url_prefix + '/get')
+    t = datetime.now()
+    session2.get(url_prefix + '/ip')
+    assert datetime.now() - t > timedelta(seconds=0.1)
+
+
 def test_post(url_prefix):
     session = RateLimitRequests()
     assert not session.post(url_prefix + '/post').json()['form']
+
+
+def test_shared_plain_data(url_prefix, tmpdir):
+    path = str(tmpdir.join('rate_limit.sqlite3'))
+    session1 = RateLimitRequests(url_interval=10, shared_path=path)
+    session2 = RateLimitRequests(url_interval=10, shared_path=path)
+    resp1 = session1.get(url_prefix + '/json')
+    resp2 = session2.get(url_prefix + '/json')
+    assert resp2 is not resp1
+    assert resp2.status_code == resp1.status_code
+    assert resp2.headers['content-type'] == resp1.headers['content-type']
+    assert resp2.content == resp1.content
+    assert resp2.json() == resp1.json()
+    headers = session1._shared.conn.cursor().execute(
+        'select headers from response_data').fetchall()[0][0]
+    assert json.loads(headers)['Content-Type'] == 'application/json'
@@ -0,0 +1,96 @@
+from busbus.util.realtime import PredictionIndex, RealtimePoller
+
+import threading
+import time
+
+
+def test_prediction_index():
+    index = PredictionIndex()
+    assert index.route('1') is None
+    index.update('1', [('A', 't1', 'a1'), ('B', 't1', 'b1'),
+                       ('A', 't2', 'a2')])
+    assert len(index) == 3
+    assert index.route('1') == {'A': {'t1': 'a1', 't2': 'a2'},
+                                'B': {'t1': 'b1'}}
+    assert index.get('A', '1', 't2') == 'a2'
+    assert index.get('A', '2', 't2') is None
+    assert index.get('C', '1', 't1', 'default') == 'default'
+
+
+def test_prediction_index_replaces_route():
+    index = PredictionIndex()
+    index.update('1', [('A', 't1', 'a1')])
+    index.update('2', [('A', 't3', 'a3')])
+    index.update('1', [('B', 't2', 'b2')])
+    assert index.route('1') == {'B': {'t2': 'b2'}}
+    assert index.get('A', '2', 't3') == 'a3'
+
+
+def test_prediction_index_max_age():
+    index = PredictionIndex()
+    index.update('1', [('A', 't1', 'a1')])
+    time.sleep(0.1)
+    assert index.route('1', max_age=0.05) is None
+    assert index.route('1', max_age=10) is not None
+
+
+def test_poller_poll():
+    def fetch(route_id):
+        if route_id == 'broken':
+            raise IOError()
+        elif route_id == 'unavailable':
+            return None
+        return [('A', route_id + '-trip', 'prediction')]
+
+    poller = RealtimePoller(fetch, ['1', 'broken', 'unavailable'], 10)
+    poller.poll()
+    assert poller.index.get('A', '1', '1-trip') == 'prediction'
+    assert poller.index.route('broken') is None
+    assert poller.index.route('unavailable') is None
+
+
+def test_poller_thread():
+    polled = threading.Event()
+
+    def fetch(route_id):
+        polled.set()
+        return []
+
+    poller = RealtimePoller(fetch, ['1'], 0.05)
+    assert poller.daemon
+    poller.start()
+    assert polled.wait(5)
+    poller.stop()
+    poller.join(5)
+    assert not poller.is_alive()
+    assert poller.index.route('1') == {}
+
+
+def test_poller_on_update():
+    updates = []
+    poller = RealtimePoller(lambda route_id: [] if route_id != '2' else None,
+                            ['1', '2', '3'], 10, on_update=updates.append)
+    poller.poll()
+    assert updates == [['1', '3']]
+
+
+def test_poller_on_update_error():
+    updates = []
+
+    def on_update(keys):
+        updates.append(keys)
+        if len(updates) == 1:
+            raise ValueError()
+
+    poller = RealtimePoller(lambda route_id: [], ['1'], 0.05,
+                            on_update=on_update)
+    poller.start()
+    try:
+        deadline = time.time() + 5
+        while len(updates) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert poller.is_alive()
+        assert updates[:2] == [['1'], ['1']]
+    finally:
+        poller.stop()
+        poller.join(5)
@@ -0,0 +1,39 @@
+from busbus.util import snapshot
+
+import json
+import pytest
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('test.snapshot'))
+    assert snapshot.read(path, 'key') is None
+    snapshot.write(path, 'key', {'a': [1, 2]})
+    assert snapshot.read(path, 'key') == {'a': [1, 2]}
+    assert snapshot.read(path, 'other key') is None
+    assert tmpdir.listdir() == [tmpdir.join('test.snapshot')]
+
+
+def test_snapshot_invalid(tmpdir):
+    path = tmpdir.join('test.snapshot')
+    path.write(b'garbage', mode='wb')
+    assert snapshot.read(str(path), 'key') is None
+    snapshot.write(str(path), 'key', 1)
+    path.write(path.read(mode='rb')[:-2], mode='wb')
+    assert snapshot.read(str(path), 'key') is None
+
+
+def test_snapshot_plain_data(tmpdir):
+    path = tmpdir.join('test.snapshot')
+    data = {'a': [1, 2.5, u'x', None, True]}
+    snapshot.write(str(path), 'key', data)
+    assert json.loads(path.read(mode='rb').split(b'key', 1)[1].decode(
+        'utf-8')) == data
+    with pytest.raises(TypeError):
+        snapshot.write(str(path), 'key', object())
+
+
+def test_snapshot_stable(tmpdir):
+    path1, path2 = tmpdir.join('1.snapshot'), tmpdir.join('2.snapshot')
+    snapshot.write(str(path1), 'key', {'b': 1, 'a': {'d': 2, 'c': 3}})
+    snapshot.write(str(path2), 'key', {'a': {'c': 3, 'd': 2}, 'b': 1})
+    assert path1.read(mode='rb') == path2.read(mode='rb')
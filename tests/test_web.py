@@ -1,12 +1,19 @@
 # coding=utf-8
 
+from busbus.entity import BaseEntityJSONEncoder, StreamingJSONEncoder
 from busbus.provider import ProviderBase
 from busbus.queryable import Queryable
+from busbus.util import profiling
 from .conftest import SampleGTFSProvider, mock_gtfs_zip
 
+import arrow
+import json
+import mock
 import pytest
 import responses
 import requests
+import threading
+import time
 from wsgi_intercept import requests_intercept, add_wsgi_intercept
 
 web = pytest.importorskip('busbus.web')
@@ -71,6 +78,16 @@ def url_prefix(request, web_engine):
     return 'http://{0}:{1}/'.format(host, port)
 
 
+@pytest.fixture(scope='module')
+def stream_url_prefix(url_prefix, web_engine):
+    host = 'busbus-stream.invalid'
+    port = 8080
+    config = {'/': {'response.stream': True}}
+    add_wsgi_intercept(host, port,
+                       lambda: cherrypy.Application(web_engine, config=config))
+    return 'http://{0}:{1}/'.format(host, port)
+
+
 @pytest.fixture(scope='module')
 def provider_id(web_engine):
     for id, provider in web_engine._providers.items():
@@ -133,6 +150,33 @@ def test_unexpand_dict():
     assert web.unexpand({1: 2}, ()) == {1: 2}
 
 
+@pytest.mark.parametrize('entity', ('providers', 'agencies', 'stops',
+                                    'routes', 'arrivals'))
+@pytest.mark.parametrize('to_expand', ([], ['agencies'], ['stops', 'routes'],
+                                       list(web.EXPAND_TYPES)))
+def test_serializer_matches_unexpand(web_engine, entity, to_expand):
+    expected = BaseEntityJSONEncoder().encode(
+        {entity: web.unexpand_init(getattr(web_engine, entity), to_expand)})
+    serializer = web.serializer_for(to_expand)
+    assert serializer is web.serializer_for(reversed(to_expand))
+    result = ''.join(StreamingJSONEncoder().stream(
+        {entity: serializer.encode_all(getattr(web_engine, entity))}))
+    assert result == expected
+
+
+def test_serializer_directions(web_engine, provider_id):
+    def directions():
+        return web_engine.routes_directions(**{'route.id': 'AB',
+                                               'provider.id': provider_id})
+
+    for to_expand in ([], ['stops']):
+        expected = BaseEntityJSONEncoder().encode(
+            list(web.unexpand_init(directions(), to_expand)))
+        result = ''.join(StreamingJSONEncoder().stream(
+            web.serializer_for(to_expand).encode_all(directions())))
+        assert result == expected
+
+
 def test_unexpand_agencies(url_prefix):
     data, resp = get(url_prefix + 'routes?_expand=agencies')
     assert 'timezone' in data['routes'][0]['agency']
@@ -154,6 +198,54 @@ def test_limit_on_action(url_prefix):
     assert len(data['stops']) == 1
 
 
+def page_through(url, entity):
+    pages = []
+    # an empty cursor starts paging
+    data, resp = get(url + '&_cursor=')
+    pages.append(data[entity])
+    while 'next_cursor' in data['request']:
+        data, resp = get(url + '&_cursor=' + data['request']['next_cursor'])
+        pages.append(data[entity])
+    return pages
+
+
+def test_cursor(url_prefix):
+    pages = page_through(url_prefix + 'stops?_limit=2', 'stops')
+    assert all(len(page) == 2 for page in pages[:-1])
+    ids = [(s['provider']['id'], s['id']) for page in pages for s in page]
+    data, resp = get(url_prefix + 'stops')
+    assert ids == sorted((s['provider']['id'], s['id'])
+                         for s in data['stops'])
+
+
+def test_cursor_arrivals(url_prefix, provider_id):
+    url = url_prefix + ('arrivals?stop.id=STAGECOACH&'
+                        'start_time=2007-06-03T06:45:00-07:00&'
+                        'provider.id={0}'.format(provider_id))
+    pages = page_through(url + '&_limit=3', 'arrivals')
+    assert len(pages) > 1
+    arrivals = [a for page in pages for a in page]
+    times = [a['time'] for a in arrivals]
+    assert times == sorted(times)
+    data, resp = get(url)
+    key = lambda a: (a['time'], a['stop']['id'], a['route']['id'])
+    assert sorted(map(key, arrivals)) == sorted(map(key, data['arrivals']))
+
+
+def test_limit_without_cursor(url_prefix):
+    data, resp = get(url_prefix + 'stops?_limit=2')
+    assert 'next_cursor' not in data['request']
+    assert data['stops'] == get(url_prefix + 'stops')[0]['stops'][:2]
+
+
+def test_cursor_invalid(url_prefix):
+    get(url_prefix + 'stops?_limit=2&_cursor=butts', 422)
+    data, resp = get(url_prefix + 'stops?_limit=2&_cursor=')
+    get(url_prefix + 'routes?_cursor=' + data['request']['next_cursor'], 422)
+    get(url_prefix + 'providers?_cursor=' + data['request']['next_cursor'],
+        422)
+
+
 def test_stops_find(url_prefix):
     data, resp = get(url_prefix + ('stops/find?latitude=36.914778&'
                                    'longitude=-116.767900&distance=100'))
@@ -172,6 +264,71 @@ def test_routes_directions(url_prefix, provider_id):
     assert len(data['directions']) == 2
 
 
+def test_admin_statements(url_prefix, web_engine, provider_id):
+    get(url_prefix + 'admin/statements', 404)
+    web_engine.config['web_admin'] = True
+    try:
+        get(url_prefix + 'stops?_limit=1')
+        data, resp = get(url_prefix + 'admin/statements')
+        statements = data['statements']
+        assert statements
+        assert set(statements[0]) == set(('sql', 'count', 'time', 'rows',
+                                          'provider'))
+        assert set(s['provider'] for s in statements) == set((provider_id,))
+        times = [s['time'] for s in statements]
+        assert times == sorted(times, reverse=True)
+        get(url_prefix + 'admin/invalid', 404)
+    finally:
+        del web_engine.config['web_admin']
+
+
+def test_timing(url_prefix, web_engine):
+    url = url_prefix + ('arrivals?stop.id=BULLFROG&_timing=1&'
+                        'start_time=2007-06-03T06:45:00-07:00')
+    get(url, 422)
+    web_engine.config['profiling'] = True
+    try:
+        data, resp = get(url)
+        timing = data['request']['timing']
+        assert set(('gtfs.stop_times', 'gtfs.build_arrivals',
+                    'arrivals.merge', 'web.response')) <= set(timing['spans'])
+        assert timing['counters']['gtfs.rows'] > 0
+        assert timing['spans']['web.response']['time'] <= timing['total']
+        assert data['arrivals'] == get(url.replace('_timing=1&', ''))[0][
+            'arrivals']
+    finally:
+        del web_engine.config['profiling']
+
+
+def test_admin_profile(url_prefix, web_engine):
+    web_engine.config['web_admin'] = True
+    try:
+        data, resp = get(url_prefix + 'admin/profile')
+        assert data['profile'] is None
+        registry = profiling.enable()
+        try:
+            get(url_prefix + 'stops?stop.id=BULLFROG')
+            data, resp = get(url_prefix + 'admin/profile')
+            assert data['profile']['spans']['web.json']['count'] >= 1
+        finally:
+            profiling.disable()
+    finally:
+        del web_engine.config['web_admin']
+
+
+def test_loading_provider(engine_config):
+    engine = web.Engine(engine_config)
+    provider = DumbUselessProvider(engine)
+    provider._ready.clear()
+    assert dict(provider)['status'] == 'loading'
+    with pytest.raises(web.APIError) as exc:
+        engine._ready_provider(provider.id)
+    assert exc.value.error_code == 503
+    assert engine._ready_provider('invalid') is None
+    provider._ready.set()
+    assert engine._ready_provider(provider.id) is provider
+
+
 def test_routes_directions_missing_attrs(url_prefix):
     data, resp = get(url_prefix + 'routes/directions', 422)
     assert data['error'].startswith('missing attributes')
@@ -208,3 +365,204 @@ def test_arrivals_provider_id(url_prefix, dumb_provider_id):
 def test_arrivals_invalid_provider_id(url_prefix):
     data, resp = get(url_prefix + 'arrivals?provider.id=butts')
     assert len(data['arrivals']) == 0
+
+
+def test_stream(url_prefix, stream_url_prefix):
+    url = 'stops?_expand=agencies'
+    data, resp = get(stream_url_prefix + url)
+    # streamed responses have no precomputed length
+    assert 'content-length' not in resp.headers
+    assert data == get(url_prefix + url)[0]
+
+
+def test_stream_head(web_engine, stream_url_prefix):
+    # the body of a HEAD request is never read, which must still let go of
+    # the request's coalescing key
+    url = stream_url_prefix + 'stops?_expand=agencies&_limit=2'
+    assert requests.head(url).status_code == 200
+    assert not web_engine._flights._calls
+    data, resp = get(url)
+    assert len(data['stops']) == 2
+
+
+def test_stream_cache_max(web_engine, stream_url_prefix):
+    web_engine._response_cache.clear()
+    web_engine.config['web_stream_cache_max'] = 16
+    try:
+        data, resp = get(stream_url_prefix + 'stops?_expand=agencies')
+        assert len(data['stops']) > 0
+        assert len(web_engine._response_cache) == 0
+    finally:
+        del web_engine.config['web_stream_cache_max']
+
+
+def test_etag_not_modified(url_prefix):
+    data, resp = get(url_prefix + 'routes')
+    assert resp.headers['cache-control'] == 'public, no-cache'
+    etag = resp.headers['etag']
+    resp = requests.get(url_prefix + 'routes',
+                        headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not resp.content
+
+
+def test_etag_varies_with_params(url_prefix):
+    data, resp1 = get(url_prefix + 'routes')
+    data, resp2 = get(url_prefix + 'routes?_limit=1')
+    assert resp1.headers['etag'] != resp2.headers['etag']
+
+
+def test_response_cache(web_engine, url_prefix):
+    web_engine._response_cache.clear()
+    data1, resp = get(url_prefix + 'stops?_expand=agencies')
+    assert len(web_engine._response_cache) == 1
+    data2, resp = get(url_prefix + 'stops?_expand=agencies')
+    assert data1 == data2
+    assert len(web_engine._response_cache) == 1
+
+
+def test_response_cache_errors(web_engine, url_prefix):
+    web_engine._response_cache.clear()
+    get(url_prefix + 'routes?_limit=-422', 422)
+    get(url_prefix + 'stops/find', 422)
+    assert len(web_engine._response_cache) == 0
+
+
+def test_arrivals_cache_control(web_engine, url_prefix):
+    data, resp = get(url_prefix + ('arrivals?stop.id=AMV&'
+                                   'start_time=2007-06-03T06:45:00-07:00'))
+    assert resp.headers['cache-control'] == 'public, max-age={0}'.format(
+        web_engine.config['web_arrivals_ttl'])
+    assert 'etag' in resp.headers
+
+
+def test_coalescing(web_engine):
+    release = threading.Event()
+    calls = []
+    bodies = []
+
+    def build():
+        calls.append(None)
+        release.wait(5)
+        return {'request': {'status': 'ok', 'entity': 'stops'}, 'stops': []}
+
+    def request():
+        bodies.append(web_engine._respond(('test_coalescing',), build))
+
+    before = web_engine.coalescing_stats
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while (web_engine.coalescing_stats['coalesced'] ==
+           before['coalesced']):
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert bodies[0] == bodies[1]
+    assert web_engine.coalescing_stats['leaders'] == before['leaders'] + 1
+
+
+def test_coalescing_timeout(web_engine):
+    web_engine.config['web_coalesce_timeout'] = 0.1
+    call, leader = web_engine._flights.acquire(('test_coalescing_timeout',))
+    try:
+        body = web_engine._respond(('test_coalescing_timeout',), lambda: {
+            'request': {'status': 'ok', 'entity': 'stops'}, 'stops': []})
+    finally:
+        web_engine._flights.release(('test_coalescing_timeout',))
+        del web_engine.config['web_coalesce_timeout']
+    assert json.loads(body.decode('utf-8'))['stops'] == []
+
+
+def test_live(web_engine):
+    def event(body):
+        name, data = next(body).decode('utf-8').split('\n')[:2]
+        return name[len('event: '):], json.loads(data[len('data: '):])
+
+    web_engine.config['web_live_interval'] = 3600
+    kwargs = {'stop.id': u'BULLFROG', 'route.id': u'AB', '_horizon': '7200'}
+    bodies = [web_engine.live('arrivals', **kwargs) for _ in range(2)]
+    for body in bodies:
+        assert event(body) == ('snapshot', {'arrivals': []})
+    assert cherrypy.response.headers['Content-Type'] == 'text/event-stream'
+    # both clients share one board
+    assert len(web_engine._boards) == 1
+
+    board, = web_engine._boards.values()
+    board.subscription.advance(arrow.get('2007-06-03T07:30:00-07:00'))
+    for body in bodies:
+        name, data = event(body)
+        assert name == 'delta'
+        assert [(a['stop']['id'], a['time']) for a in data['added']] == [
+            (u'BULLFROG', arrow.get('2007-06-03T08:10:00-07:00').timestamp)]
+        assert data['changed'] == data['removed'] == []
+    bodies[0].close()
+    assert len(board.clients) == 1
+    bodies[1].close()
+    assert web_engine._boards == {}
+    assert not board.subscription.active
+
+
+def test_live_advance_errors(web_engine):
+    web_engine.config['web_live_interval'] = 3600
+    body = web_engine.live('arrivals', **{'stop.id': u'BULLFROG'})
+    next(body)
+    board, = web_engine._boards.values()
+    client, = board.clients
+
+    with mock.patch.object(board.subscription, 'advance',
+                           side_effect=RuntimeError('provider down')), \
+            mock.patch('cherrypy.log') as log:
+        for _ in range(web_engine._live_max_failures):
+            web_engine._advance_board(board)
+    # logged on the first failure and once the clients are told
+    assert log.call_count == 2
+    name, data = client.get_nowait().decode('utf-8').split('\n')[:2]
+    assert name == 'event: error'
+    assert json.loads(data[len('data: '):]) == {
+        'error': 'updating the board failed: provider down',
+        'failures': web_engine._live_max_failures}
+
+    web_engine._advance_board(board)
+    assert board.failures == 0
+    body.close()
+
+
+def test_live_start_error(web_engine):
+    def subscribe(*args, **kwargs):
+        # the first query doesn't hold up other boards
+        assert web_engine._boards_lock.acquire(False)
+        web_engine._boards_lock.release()
+        raise RuntimeError('provider down')
+
+    with mock.patch.object(web_engine, 'subscribe', side_effect=subscribe), \
+            mock.patch('cherrypy.log'):
+        body = web_engine.live('arrivals', **{'stop.id': u'BULLFROG'})
+    # reported before the event stream starts
+    assert cherrypy.response.status == 503
+    assert json.loads(body)['error'] == 'starting the board failed: ' \
+        'provider down'
+    assert web_engine._boards == web_engine._board_inits == {}
+
+
+def test_live_slow_client(web_engine):
+    web_engine.config['web_live_interval'] = 3600
+    with mock.patch.object(web_engine, '_live_max_queue', 2):
+        body = web_engine.live('arrivals', **{'stop.id': u'BULLFROG'})
+    board, = web_engine._boards.values()
+    client, = board.clients
+    # the snapshot and one event fit; the next drops the client
+    board._send(b'event: one\n\n')
+    board._send(b'event: two\n\n')
+    assert board.clients == []
+    assert list(body) == []
+    assert web_engine._boards == {}
+    assert not board.subscription.active
+
+
+def test_live_errors(url_prefix):
+    get(url_prefix + 'live/stops', 404)
+    get(url_prefix + 'live/arrivals?_horizon=0', 422)
+    get(url_prefix + 'live/arrivals?start_time=0', 422)